@@ -0,0 +1,482 @@
+"""
+archive.py
+
+Day-partitioned Parquet archive and column store of the vehicle positions.
+
+Each archived day is one zstd-compressed Parquet file
+    <ARCHIVE_DIR>/day=YYYY-MM-DD/positions.parquet
+with the complete time series of that day (delta snapshots are reconstructed
+through vehicle_positions_full), so the files can be read without the
+dictionary tables. The table archived_days in the collector database lists
+the archived days; everything before the day after the last archived day
+lives only in the archive (see maintenance.py).
+
+Columns:
+    vehicle_id, gtfs_trip_id, gtfs_route_short_name, state_position (string),
+    route_type (int16), bearing, delay (float64), latitude, longitude (float64),
+    zone (int8, tariff zone id, see zones.py), stop_id, parent_station
+    (string), stop_distance (int32, metres; nearest stop, see stop_index.py),
+    ts (int64, epoch seconds).
+    Files archived before zone tagging have no zone column; scan() and
+    read_days() tag their rows while reading. Files archived before the stop
+    assignment read the stop columns as null.
+
+Complete days are also exported while their raw rows are still in the
+database (maintenance.py does it every night), so multi-day analyses can
+scan the column store instead of SQLite. scan() reads only the requested
+columns and pushes filters on ts, bounding box, state_position and
+route_type down to the Parquet reader; days without a file are read from
+SQLite with the same filters.
+
+Usage:
+    python archive.py export --start 2025-05-01 --end 2025-05-31
+    python archive.py scan --start "2025-05-01 00:00:00" --end "2025-05-07 23:59:59" \
+        --columns vehicle_id,latitude,longitude,ts --state at_stop > positions.arrows
+    scan writes an Arrow IPC stream to stdout.
+"""
+
+import argparse
+import os
+import logging
+import operator
+import sqlite3
+import sys
+from datetime import datetime, date, timedelta
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import schema
+import zones
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+# rows fetched from SQLite at a time
+CHUNK_ROWS = 500000
+# rows per Parquet row group; files are sorted by state, vehicle and time, so
+# state filters skip whole row groups
+ROW_GROUP_ROWS = 131072
+# string columns read dictionary-encoded and decoded once after filtering
+_DICTIONARY_COLUMNS = ["vehicle_id", "gtfs_trip_id", "gtfs_route_short_name", "state_position",
+                       "stop_id", "parent_station"]
+# comparisons a scan condition (see scan) may use
+_OPERATORS = {"=": operator.eq, "<>": operator.ne, "<": operator.lt, "<=": operator.le,
+              ">": operator.gt, ">=": operator.ge}
+# a day is exported once the collector's last batch of it is surely committed
+EXPORT_DELAY = timedelta(minutes=5)
+
+ARCHIVE_SCHEMA = pa.schema([
+    ("vehicle_id", pa.string()),
+    ("gtfs_trip_id", pa.string()),
+    ("route_type", pa.int16()),
+    ("gtfs_route_short_name", pa.string()),
+    ("bearing", pa.float64()),
+    ("delay", pa.float64()),
+    ("latitude", pa.float64()),
+    ("longitude", pa.float64()),
+    ("state_position", pa.string()),
+    ("zone", pa.int8()),
+    ("stop_id", pa.string()),
+    ("parent_station", pa.string()),
+    ("stop_distance", pa.int32()),
+    ("ts", pa.int64()),
+])
+
+
+def create_archive_table(conn):
+    """Create the archived_days bookkeeping table if it does not exist.
+
+    Args:
+        conn (sqlite3.Connection): Writable connection.
+    """
+    conn.execute("""CREATE TABLE IF NOT EXISTS archived_days (
+                        day TEXT PRIMARY KEY,
+                        rows INTEGER NOT NULL,
+                        path TEXT,
+                        archived_at TEXT NOT NULL)""")
+
+
+def day_bounds(day):
+    """Return the epoch seconds of the local start of a day and of the next day.
+
+    Args:
+        day (date): The day.
+
+    Returns:
+        tuple: (start, end) epoch seconds, end exclusive.
+    """
+    start = int(datetime.combine(day, datetime.min.time()).timestamp())
+    end = int(datetime.combine(day + timedelta(days=1), datetime.min.time()).timestamp())
+    return start, end
+
+
+def day_path(day, archive_dir=ARCHIVE_DIR):
+    """Return the Parquet file of an archived day."""
+    return os.path.join(archive_dir, f"day={day.isoformat()}", "positions.parquet")
+
+
+def archived_before(conn):
+    """Return the epoch second before which all positions are archived.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the collector database.
+
+    Returns:
+        int or None: Start of the day after the last archived day, None if
+        nothing is archived.
+    """
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'archived_days'").fetchone()
+    if not exists:
+        return None
+    last = conn.execute("SELECT MAX(day) FROM archived_days").fetchone()[0]
+    if last is None:
+        return None
+    return day_bounds(date.fromisoformat(last))[1]
+
+
+def to_epoch(conn, value):
+    """Convert epoch seconds or a local 'YYYY-MM-DD HH:MM:SS' time to epoch seconds.
+
+    Local times are converted by SQLite, like the ts filters of the pages.
+    """
+    value = str(value)
+    if value.isdigit():
+        return int(value)
+    return conn.execute("SELECT CAST(strftime('%s', ?, 'utc') AS INTEGER)", (value,)).fetchone()[0]
+
+
+def _to_batch(rows, batch_schema=ARCHIVE_SCHEMA):
+    """Convert rows of vehicle_positions_full to a record batch of the given schema."""
+    columns = list(zip(*rows))
+    arrays = []
+    for column, field in zip(columns, batch_schema):
+        if field.name == "route_type":
+            column = [None if value is None else int(value) for value in column]
+        arrays.append(pa.array(column, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=batch_schema)
+
+
+def _missing_columns(path, names):
+    """Return the columns in names that a file archived by an older version lacks."""
+    present = pq.read_schema(path).names
+    return tuple(name for name in names if name not in present)
+
+
+def _read_columns(names, missing):
+    """Return the columns to read from a file lacking the missing columns."""
+    read_columns = [name for name in names if name not in missing]
+    if "zone" in missing:
+        read_columns += [name for name in ("longitude", "latitude") if name not in read_columns]
+    return read_columns
+
+
+def _fill_columns(data, names, missing, tagger=None):
+    """Add the columns a file archived by an older version lacks.
+
+    The zone is tagged from the coordinates, other missing columns are null.
+
+    Args:
+        data (pyarrow.RecordBatch or pyarrow.Table): Rows read with _read_columns().
+        names (list[str]): Columns of the result, in order.
+        missing (tuple[str]): Columns of names the file lacks.
+        tagger (zones.ZoneTagger, optional): Tagger of the tariff zones, needed for zone.
+
+    Returns:
+        pyarrow.RecordBatch or pyarrow.Table: The rows with the columns in names.
+    """
+    arrays = []
+    for name in names:
+        if name not in missing:
+            arrays.append(data.column(name))
+        elif name == "zone":
+            zone = tagger.tag(data.column("longitude").to_numpy(zero_copy_only=False),
+                              data.column("latitude").to_numpy(zero_copy_only=False))
+            unknown = np.isnan(zone)
+            arrays.append(pa.array(np.where(unknown, 0, zone).astype(np.int8), mask=unknown))
+        else:
+            arrays.append(pa.nulls(data.num_rows, ARCHIVE_SCHEMA.field(name).type))
+    return type(data).from_arrays(arrays, names=names)
+
+
+def write_day(conn, day, archive_dir=ARCHIVE_DIR):
+    """Write the positions of one local day to its Parquet file.
+
+    The file is written under a temporary name and renamed when complete, so
+    readers never see a half-written day.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the collector database.
+        day (date): Day to archive.
+        archive_dir (str): Root directory of the archive.
+
+    Returns:
+        tuple: (number of rows, path of the file or None if the day is empty).
+    """
+    start, end = day_bounds(day)
+    cursor = conn.execute("""SELECT vehicle_id, gtfs_trip_id, route_type, gtfs_route_short_name,
+                                    bearing, delay, latitude, longitude, state_position, zone,
+                                    stop_id, parent_station, stop_distance, ts
+                             FROM vehicle_positions_full
+                             WHERE ts >= ? AND ts < ?
+                             ORDER BY state_position, vehicle_id, ts""", (start, end))
+    path = day_path(day, archive_dir)
+    tmp_path = path + ".tmp"
+    writer = None
+    total = 0
+    try:
+        while True:
+            rows = cursor.fetchmany(CHUNK_ROWS)
+            if not rows:
+                break
+            if writer is None:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                writer = pq.ParquetWriter(tmp_path, ARCHIVE_SCHEMA, compression="zstd")
+            writer.write_batch(_to_batch(rows), row_group_size=ROW_GROUP_ROWS)
+            total += len(rows)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        return 0, None
+    os.replace(tmp_path, path)
+    logger.info(f"Archived {total} rows of {day} to {path}.")
+    return total, path
+
+
+def export_day(conn, day, archive_dir=ARCHIVE_DIR):
+    """Write a complete day to the column store unless its file exists.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the collector database.
+        day (date): A day before today.
+        archive_dir (str): Root directory of the archive.
+
+    Returns:
+        tuple: (number of rows, path of the file or None if the day is empty).
+    """
+    path = day_path(day, archive_dir)
+    if os.path.exists(path):
+        return pq.ParquetFile(path).metadata.num_rows, path
+    return write_day(conn, day, archive_dir)
+
+
+def export(conn, start_day, end_day, archive_dir=ARCHIVE_DIR):
+    """Export all complete days between start_day and end_day.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the collector database.
+        start_day (date): First day.
+        end_day (date): Last day (inclusive); today and later are skipped.
+        archive_dir (str): Root directory of the archive.
+    """
+    day = start_day
+    end_day = min(end_day, (datetime.now() - EXPORT_DELAY).date() - timedelta(days=1))
+    while day <= end_day:
+        rows, path = export_day(conn, day, archive_dir)
+        print(f"{day}: {rows} rows in {path}.")
+        day += timedelta(days=1)
+
+
+def _filter_sql(bbox=None, states=None, route_types=None, where=None):
+    """Build the SQL conditions and parameters matching the scan filters."""
+    conditions, params = [], []
+    for column, op, value in where or []:
+        conditions.append(f"{column} {op} ?")
+        # route types are text in the views, like for route_types below
+        params.append(str(value) if column == "route_type" else value)
+    if bbox is not None:
+        conditions.append("longitude BETWEEN ? AND ? AND latitude BETWEEN ? AND ?")
+        params += [bbox[0], bbox[2], bbox[1], bbox[3]]
+    if states:
+        conditions.append(f"state_position IN ({', '.join('?' * len(states))})")
+        params += list(states)
+    if route_types:
+        conditions.append(f"route_type IN ({', '.join('?' * len(route_types))})")
+        params += [str(route_type) for route_type in route_types]
+    return "".join(f" AND {condition}" for condition in conditions), params
+
+
+def _where_expression(where):
+    """Build the pyarrow expression of scan conditions, None if there are none."""
+    expression = None
+    for column, op, value in where:
+        condition = _OPERATORS[op](ds.field(column), value)
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def _filter_expression(start, end, bbox=None, states=None, route_types=None, where=None):
+    """Build the pyarrow filter expression matching the scan filters."""
+    expression = (ds.field("ts") >= start) & (ds.field("ts") <= end)
+    if where:
+        expression &= _where_expression(where)
+    if bbox is not None:
+        expression &= (ds.field("longitude") >= bbox[0]) & (ds.field("longitude") <= bbox[2])
+        expression &= (ds.field("latitude") >= bbox[1]) & (ds.field("latitude") <= bbox[3])
+    if states:
+        expression &= ds.field("state_position").isin(list(states))
+    if route_types:
+        expression &= ds.field("route_type").isin([int(route_type) for route_type in route_types])
+    return expression
+
+
+def scan(conn, start, end, columns=None, bbox=None, states=None, route_types=None, archive_dir=ARCHIVE_DIR,
+         where=None):
+    """Read positions with start <= ts <= end from the column store and the database.
+
+    Days with a Parquet file are read from it; only the requested columns are
+    decoded and the filters are evaluated by the Parquet reader, skipping row
+    groups by their statistics. Remaining days are read from SQLite.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the collector database.
+        start (int): First epoch second.
+        end (int): Last epoch second (inclusive).
+        columns (list[str], optional): Columns to return, defaults to all.
+        bbox (tuple, optional): (minx, miny, maxx, maxy) in degrees.
+        states (list[str], optional): Allowed state_position values.
+        route_types (list[int], optional): Allowed route types.
+        archive_dir (str): Root directory of the archive.
+        where (list[tuple], optional): More conditions (column, operator, value)
+            the rows must meet, operator one of _OPERATORS; rows where the
+            column is NULL never match.
+
+    Yields:
+        pyarrow.RecordBatch: Batches with the requested columns and types of ARCHIVE_SCHEMA.
+    """
+    columns = list(columns) if columns else ARCHIVE_SCHEMA.names
+    where = list(where or [])
+    # the columns of the conditions are read too, files of older versions may lack them
+    needed = columns + [column for column, _, _ in where if column not in columns]
+    out_schema = pa.schema([ARCHIVE_SCHEMA.field(column) for column in columns])
+    stored, missing = [], []
+    day = datetime.fromtimestamp(start).date()
+    while day <= datetime.fromtimestamp(end).date():
+        path = day_path(day, archive_dir)
+        (stored if os.path.exists(path) else missing).append((day, path))
+        day += timedelta(days=1)
+
+    if stored:
+        parquet_format = ds.ParquetFileFormat(
+            read_options=ds.ParquetReadOptions(dictionary_columns=_DICTIONARY_COLUMNS))
+        # one dataset per set of columns missing in files of older versions
+        by_missing = {}
+        for _, path in stored:
+            by_missing.setdefault(_missing_columns(path, needed), []).append(path)
+        tagger = None
+        for missing_columns, paths in by_missing.items():
+            dataset = ds.dataset(paths, format=parquet_format)
+            if not missing_columns:
+                expression = _filter_expression(start, end, bbox, states, route_types, where)
+                for batch in dataset.to_batches(columns=columns, filter=expression):
+                    yield batch.cast(out_schema)
+                continue
+            if "zone" in missing_columns:
+                tagger = tagger or zones.ZoneTagger()
+            # conditions on filled columns are checked after filling them
+            late = [condition for condition in where if condition[0] in missing_columns]
+            expression = _filter_expression(start, end, bbox, states, route_types,
+                                            [condition for condition in where if condition not in late])
+            read_columns = _read_columns(needed, missing_columns)
+            for batch in dataset.to_batches(columns=read_columns, filter=expression):
+                batch = _fill_columns(batch, needed, missing_columns, tagger)
+                if late:
+                    batch = batch.filter(_where_expression(late))
+                yield batch.select(columns).cast(out_schema)
+
+    conditions, params = _filter_sql(bbox, states, route_types, where)
+    for day, _ in missing:
+        day_start, day_end = day_bounds(day)
+        # main: remote_query.shadow_archived shadows the view with a TEMP view of the same name
+        cursor = conn.execute(f"""SELECT {', '.join(columns)} FROM main.vehicle_positions_full
+                                  WHERE ts >= ? AND ts < ? AND ts BETWEEN ? AND ?{conditions}""",
+                              [day_start, day_end, start, end] + params)
+        while True:
+            rows = cursor.fetchmany(CHUNK_ROWS)
+            if not rows:
+                break
+            yield _to_batch(rows, out_schema)
+
+
+def read_days(start, end, archive_dir=ARCHIVE_DIR, columns=None):
+    """Read archived positions with start <= ts <= end.
+
+    Args:
+        start (int): First epoch second.
+        end (int): Last epoch second (inclusive).
+        archive_dir (str): Root directory of the archive.
+        columns (list[str], optional): Columns to read, defaults to all.
+
+    Returns:
+        pyarrow.Table: The archived rows, empty if no day is archived.
+    """
+    names = list(columns) if columns else ARCHIVE_SCHEMA.names
+    tables = []
+    tagger = None
+    day = datetime.fromtimestamp(start).date()
+    last_day = datetime.fromtimestamp(end).date()
+    while day <= last_day:
+        path = day_path(day, archive_dir)
+        if os.path.exists(path):
+            filters = [("ts", ">=", start), ("ts", "<=", end)]
+            missing_columns = _missing_columns(path, names)
+            if missing_columns:
+                # archived before zone tagging or stop assignment
+                if "zone" in missing_columns:
+                    tagger = tagger or zones.ZoneTagger()
+                table = pq.read_table(path, columns=_read_columns(names, missing_columns), filters=filters)
+                table = _fill_columns(table, names, missing_columns, tagger)
+            else:
+                table = pq.read_table(path, columns=names, filters=filters)
+            tables.append(table.cast(pa.schema([ARCHIVE_SCHEMA.field(name) for name in names])))
+        day += timedelta(days=1)
+    if not tables:
+        empty = ARCHIVE_SCHEMA if columns is None else pa.schema([ARCHIVE_SCHEMA.field(c) for c in columns])
+        return empty.empty_table()
+    return pa.concat_tables(tables)
+
+
+def main():
+    """Command line entry point for exporting and scanning the column store."""
+    parser = argparse.ArgumentParser(description="Parquet column store of the vehicle positions.")
+    parser.add_argument("command", choices=["export", "scan"])
+    parser.add_argument("--db", default=schema.DB_PATH, help="Path to the collector database.")
+    parser.add_argument("--archive-dir", default=ARCHIVE_DIR, help="Root directory of the archive.")
+    parser.add_argument("--start", required=True, help="First day (export) or start time (scan, epoch or local).")
+    parser.add_argument("--end", required=True, help="Last day (export) or end time (scan, epoch or local).")
+    parser.add_argument("--columns", help="Comma-separated columns to return (scan).")
+    parser.add_argument("--state", action="append", help="Allowed state_position, repeatable (scan).")
+    parser.add_argument("--route-type", action="append", type=int, help="Allowed route type, repeatable (scan).")
+    parser.add_argument("--bbox", nargs=4, type=float, metavar=("MINX", "MINY", "MAXX", "MAXY"),
+                        help="Bounding box in degrees (scan).")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        conn = sqlite3.connect(args.db)
+        conn.execute(f"PRAGMA busy_timeout={schema.MAINTENANCE_BUSY_TIMEOUT_MS}")
+        export(conn, date.fromisoformat(args.start), date.fromisoformat(args.end), args.archive_dir)
+        conn.close()
+        return
+
+    conn = sqlite3.connect(f"file:{args.db}?mode=ro", uri=True)
+    conn.execute(f"PRAGMA busy_timeout={schema.MAINTENANCE_BUSY_TIMEOUT_MS}")
+    columns = args.columns.split(",") if args.columns else None
+    out_schema = pa.schema([ARCHIVE_SCHEMA.field(c) for c in columns]) if columns else ARCHIVE_SCHEMA
+    try:
+        with pa.ipc.new_stream(sys.stdout.buffer, out_schema) as writer:
+            for batch in scan(conn, to_epoch(conn, args.start), to_epoch(conn, args.end), columns,
+                              args.bbox, args.state, args.route_type, args.archive_dir):
+                writer.write_batch(batch)
+    except (sqlite3.Error, OSError, pa.ArrowException, KeyError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""
+maintenance.py
+
+Retention job for the collector database (vehicle_positions.db). Run it
+next to server.py, e.g. once a night from cron:
+
+    python maintenance.py run              # archive and delete old raw positions
+    python maintenance.py run --keep-days 14
+    python maintenance.py vacuum           # one-time switch to incremental vacuum
+
+What `run` does, oldest day first, while the collector keeps writing:
+1. Writes every local day older than RETENTION_DAYS to the Parquet archive
+   (see archive.py) and records it in archived_days. Younger complete days
+   are exported to the same column store but keep their raw rows.
+2. Deletes the archived raw rows in small batches, each in its own short
+   transaction. In delta mode rows that a later snapshot still needs as its
+   keyframe stay until the next run.
+3. Drops the per-minute delay rollups of archived days; the 5-minute, hourly
+   and daily rollups are kept, so the dashboard still covers the full history.
+4. Gives freed pages back to the file system with PRAGMA incremental_vacuum if
+   the database uses auto_vacuum=INCREMENTAL (new databases do). Otherwise
+   the freed pages are reused for new snapshots and the file stops growing;
+   `vacuum` converts an existing database once (it blocks the collector for
+   the duration of a full VACUUM, so run it in a quiet moment).
+
+Queries with a time range read archived days transparently through
+remote_query.py.
+"""
+
+import argparse
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime, date, timedelta
+
+import archive
+import rollups
+import schema
+
+logger = logging.getLogger(__name__)
+
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "21"))
+DELETE_BATCH = 20000
+
+
+def open_maintenance(db_path=schema.DB_PATH):
+    """Open a writable connection that waits for the collector's commits.
+
+    Args:
+        db_path (str): Path to the collector database.
+
+    Returns:
+        sqlite3.Connection: The connection.
+    """
+    conn = sqlite3.connect(db_path)
+    conn.execute(f"PRAGMA busy_timeout={schema.MAINTENANCE_BUSY_TIMEOUT_MS}")
+    return conn
+
+
+def delete_before(conn, cutoff):
+    """Return the epoch second before which raw rows can be deleted.
+
+    In delta mode the first snapshot at or after the cutoff may still refer to
+    an earlier keyframe; its rows have to stay.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the collector database.
+        cutoff (int): Epoch second before which everything is archived.
+
+    Returns:
+        int: The deletion bound.
+    """
+    row = conn.execute("SELECT keyframe_ts FROM snapshots WHERE ts >= ? ORDER BY ts LIMIT 1",
+                       (cutoff,)).fetchone()
+    if row is None:
+        return cutoff
+    return min(cutoff, row[0])
+
+
+def delete_batches(conn, sql, params, batch_size=DELETE_BATCH, pause=0.1):
+    """Run a batch-limited DELETE repeatedly, one short transaction per batch.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the collector database.
+        sql (str): DELETE statement with a trailing LIMIT placeholder.
+        params (tuple): Parameters of the statement without the limit.
+        batch_size (int): Rows per transaction.
+        pause (float): Seconds to sleep between batches.
+
+    Returns:
+        int: Number of deleted rows.
+    """
+    deleted = 0
+    while True:
+        cursor = conn.execute(sql, params + (batch_size,))
+        conn.commit()
+        deleted += cursor.rowcount
+        if cursor.rowcount < batch_size:
+            return deleted
+        time.sleep(pause)
+
+
+def reclaim_space(conn):
+    """Return free pages to the file system if incremental vacuum is enabled.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the collector database.
+
+    Returns:
+        int: Number of free pages before reclaiming.
+    """
+    free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+    if auto_vacuum == 2:
+        # free pages in slices, so the collector is never blocked for long
+        remaining = free_pages
+        while remaining > 0:
+            conn.execute("PRAGMA incremental_vacuum(1000)").fetchall()
+            conn.commit()
+            left = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if left >= remaining:
+                break
+            remaining = left
+            time.sleep(0.05)
+    elif free_pages:
+        logger.info(f"{free_pages} free pages will be reused; run 'python maintenance.py vacuum' "
+                    "once to return space to the file system.")
+    return free_pages
+
+
+def run(conn, keep_days=RETENTION_DAYS, archive_dir=archive.ARCHIVE_DIR, batch_size=DELETE_BATCH):
+    """Archive and delete raw positions older than keep_days.
+
+    Safe to interrupt and rerun: archived days are recorded before their rows
+    are deleted, and a day file is never written twice.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the collector database.
+        keep_days (int): Number of most recent local days kept as raw rows.
+        archive_dir (str): Root directory of the archive.
+        batch_size (int): Rows deleted per transaction.
+    """
+    if schema._table_type(conn, schema.LEGACY_TABLE) == "table":
+        print("The legacy table is not migrated yet; run 'python schema.py migrate' first.")
+        return
+    archive.create_archive_table(conn)
+    conn.commit()
+
+    last_day = date.today() - timedelta(days=keep_days + 1)
+    cutoff = archive.archived_before(conn)
+    if cutoff is None:
+        first_ts = conn.execute("SELECT MIN(ts) FROM snapshots").fetchone()[0]
+        if first_ts is None:
+            print("Nothing to archive.")
+            return
+        day = datetime.fromtimestamp(first_ts).date()
+    else:
+        day = datetime.fromtimestamp(cutoff).date()
+
+    while day <= last_day:
+        rows, path = archive.export_day(conn, day, archive_dir)
+        conn.execute("INSERT OR REPLACE INTO archived_days (day, rows, path, archived_at) VALUES (?, ?, ?, ?)",
+                     (day.isoformat(), rows, path, datetime.now().isoformat(timespec="seconds")))
+        conn.commit()
+        print(f"{day}: archived {rows} rows.")
+        day += timedelta(days=1)
+
+    # recent complete days go to the column store too, their raw rows stay
+    archive.export(conn, day, date.today() - timedelta(days=1), archive_dir)
+
+    cutoff = archive.archived_before(conn)
+    if cutoff is None:
+        print("Nothing to archive.")
+        return
+    bound = delete_before(conn, cutoff)
+    deleted = delete_batches(conn, """DELETE FROM positions WHERE rowid IN (
+                                          SELECT rowid FROM positions WHERE ts < ? LIMIT ?)""",
+                             (bound,), batch_size)
+    conn.execute("DELETE FROM snapshots WHERE ts < ?", (bound,))
+    conn.commit()
+    pruned = 0
+    if schema._table_type(conn, "delay_rollups") == "table":
+        for level in (rollups.LEVEL_TRIP, rollups.LEVEL_ROUTE, rollups.LEVEL_ROUTE_TYPE):
+            # delay_rollups has no rowid, batch over its primary key instead
+            pruned += delete_batches(conn, """DELETE FROM delay_rollups
+                                              WHERE (level, bucket, start, key, band) IN (
+                                                  SELECT level, bucket, start, key, band FROM delay_rollups
+                                                  WHERE level = ? AND bucket = ? AND start < ? LIMIT ?)""",
+                                     (level, rollups.BUCKETS["minute"], cutoff), batch_size)
+    free_pages = reclaim_space(conn)
+    conn.execute("PRAGMA optimize")
+    logger.info(f"Maintenance: deleted {deleted} positions and {pruned} minute rollups, {free_pages} free pages.")
+    print(f"Deleted {deleted} raw positions and {pruned} minute rollups before "
+          f"{datetime.fromtimestamp(bound)}; {free_pages} pages freed.")
+
+
+def vacuum(conn):
+    """Switch the database to incremental auto-vacuum with one full VACUUM.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the collector database.
+    """
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+    print("Database vacuumed, auto_vacuum is now INCREMENTAL.")
+
+
+def main():
+    """Command line entry point for the maintenance job."""
+    logging.basicConfig(filename="gather.log", level=logging.INFO,
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Retention and archival of the vehicle positions database.")
+    parser.add_argument("command", choices=["run", "vacuum"])
+    parser.add_argument("--db", default=schema.DB_PATH, help="Path to the collector database.")
+    parser.add_argument("--keep-days", type=int, default=RETENTION_DAYS, help="Days of raw positions to keep.")
+    parser.add_argument("--archive-dir", default=archive.ARCHIVE_DIR, help="Root directory of the archive.")
+    parser.add_argument("--batch", type=int, default=DELETE_BATCH, help="Rows deleted per transaction.")
+    args = parser.parse_args()
+
+    conn = open_maintenance(args.db)
+    if args.command == "run":
+        run(conn, args.keep_days, args.archive_dir, args.batch)
+    else:
+        vacuum(conn)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
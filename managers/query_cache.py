@@ -0,0 +1,230 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import pyarrow as pa
+import streamlit as st
+
+import queries
+
+# directory of the result cache, shared by all sessions; empty disables the cache
+QUERY_CACHE_DIR = os.getenv("QUERY_CACHE_DIR", ".query_cache")
+# size of the cached results above which the least recently used are deleted
+QUERY_CACHE_MAX_BYTES = int(float(os.getenv("QUERY_CACHE_MAX_MB", "512")) * 1e6)
+# seconds the results of a day that is not complete yet are reused
+QUERY_CACHE_TTL_SECONDS = float(os.getenv("QUERY_CACHE_TTL_SECONDS", "60"))
+# a day is complete this long after its end, once the collector stored its last snapshots
+DAY_SETTLE_SECONDS = 900
+# eviction deletes down to this share of the maximum size, so it does not run on every write
+EVICT_TO = 0.9
+# rows per record batch of the files, read one at a time when a result is streamed
+CACHE_BATCH_ROWS = 65536
+
+
+def expires_at(day, server_timezone):
+    """Return when the cached result of a day expires.
+
+    History is append-only, so results of complete days never change.
+
+    Args:
+        day (date): The local day of the result.
+        server_timezone (str): Time zone of the collector, e.g. "Europe/Prague".
+
+    Returns:
+        float or None: Epoch seconds, None if the result never expires.
+    """
+    day_end = datetime.combine(day + timedelta(days=1), datetime.min.time(), ZoneInfo(server_timezone))
+    if datetime.now(ZoneInfo(server_timezone)) >= day_end + timedelta(seconds=DAY_SETTLE_SECONDS):
+        return None
+    return time.time() + QUERY_CACHE_TTL_SECONDS
+
+
+class QueryCache:
+    """Disk cache of named query results, one Arrow IPC file per query, parameters and day.
+
+    An index in SQLite records the size, expiry and last use of every file, so
+    that all sessions and processes of the app share the cache and the least
+    recently used files are deleted when the cache grows over max_bytes.
+
+    Attributes:
+        directory (str): Directory of the files and the index.
+        max_bytes (int): Size limit of the files.
+    """
+    def __init__(self, directory=QUERY_CACHE_DIR, max_bytes=QUERY_CACHE_MAX_BYTES):
+        """Initialize the QueryCache and create its index if needed.
+
+        Args:
+            directory (str): Directory of the files and the index.
+            max_bytes (int): Size limit of the files.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(directory, "index.db"), timeout=10, check_same_thread=False,
+                                    isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+                                 key TEXT PRIMARY KEY,
+                                 size INTEGER NOT NULL,
+                                 expires REAL,
+                                 last_used REAL NOT NULL)""")
+
+    @staticmethod
+    def key(namespace, name, params):
+        """Return the cache key of a named query.
+
+        Args:
+            namespace (str): Identifies the database, e.g. server and path.
+            name (str): Name of the query.
+            params (dict): Its normalized parameters.
+
+        Returns:
+            str: Hex digest.
+        """
+        return hashlib.sha256(f"{namespace}\n{queries.cache_key(name, params)}".encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.arrow")
+
+    def get(self, key):
+        """Return a cached result, None if it is not cached or expired.
+
+        Args:
+            key (str): Cache key (see key()).
+
+        Returns:
+            pyarrow.Table or None: The result.
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT expires FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[0] is not None and row[0] < time.time():
+                self._delete(key)
+                return None
+            try:
+                with pa.OSFile(self._path(key), "rb") as f:
+                    table = pa.ipc.open_file(f).read_all()
+            except (OSError, pa.ArrowInvalid):
+                # deleted by another process or written incompletely
+                self._delete(key)
+                return None
+            self.conn.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+            return table
+
+    def get_batches(self, key):
+        """Return the record batches of a cached result without reading the whole file.
+
+        Args:
+            key (str): Cache key (see key()).
+
+        Returns:
+            iterator of pyarrow.RecordBatch or None: The result, None if it is not
+            cached or expired.
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT expires FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[0] is not None and row[0] < time.time():
+                self._delete(key)
+                return None
+            try:
+                # the mapping stays readable if the file is evicted meanwhile
+                reader = pa.ipc.open_file(pa.memory_map(self._path(key)))
+            except (OSError, pa.ArrowInvalid):
+                self._delete(key)
+                return None
+            self.conn.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+        return (reader.get_batch(i) for i in range(reader.num_record_batches))
+
+    def put(self, key, table, expires=None):
+        """Store a result and evict the least recently used ones if the cache is full.
+
+        Args:
+            key (str): Cache key (see key()).
+            table (pyarrow.Table): The result.
+            expires (float, optional): Epoch seconds after which the result is stale,
+                None to keep it until it is evicted.
+        """
+        # a result without rows has no batches but is stored with its schema
+        batches = (table.to_batches(max_chunksize=CACHE_BATCH_ROWS)
+                   or [pa.RecordBatch.from_pylist([], schema=table.schema)])
+        for _ in self.put_batches(key, batches, expires):
+            pass
+
+    def put_batches(self, key, batches, expires=None):
+        """Store a result while it is streamed and pass its batches on.
+
+        The result is stored once the last batch went through; if the caller
+        stops early or the stream fails, nothing is stored.
+
+        Args:
+            key (str): Cache key (see key()).
+            batches (iterable of pyarrow.RecordBatch): The result, all with one schema.
+            expires (float, optional): Epoch seconds after which the result is stale,
+                None to keep it until it is evicted.
+
+        Yields:
+            pyarrow.RecordBatch: The batches of the result.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written under a temporary name, so readers never see half a file
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        options = pa.ipc.IpcWriteOptions(compression="zstd")
+        writer = None
+        try:
+            with pa.OSFile(tmp, "wb") as f:
+                for batch in batches:
+                    if writer is None:
+                        writer = pa.ipc.new_file(f, batch.schema, options=options)
+                    writer.write_batch(batch)
+                    yield batch
+                if writer is None:
+                    return
+                writer.close()
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO entries (key, size, expires, last_used) VALUES (?, ?, ?, ?)",
+                              (key, os.path.getsize(path), expires, time.time()))
+            self._evict()
+
+    def _evict(self):
+        """Delete the least recently used files while the cache is over its size limit."""
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.conn.execute("SELECT key, size FROM entries ORDER BY last_used").fetchall():
+            if total <= self.max_bytes * EVICT_TO:
+                break
+            self._delete(key)
+            total -= size
+
+    def _delete(self, key):
+        self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        """Delete all cached results, e.g. after days were recomputed on the server."""
+        with self.lock:
+            for (key,) in self.conn.execute("SELECT key FROM entries").fetchall():
+                self._delete(key)
+
+
+@st.cache_resource
+def get_query_cache():
+    """Return the QueryCache of this process, None if QUERY_CACHE_DIR is empty."""
+    return QueryCache() if QUERY_CACHE_DIR else None
@@ -0,0 +1,430 @@
+import http.client
+import json
+import shlex
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+import pyarrow as pa
+
+import remote_query
+
+# the service only listens on the loopback of the gather host (see query_service.py)
+DEFAULT_ADDRESS = ("127.0.0.1", 8765)
+# seconds a query may run before it is stopped on the server and the client
+QUERY_TIMEOUT_SECONDS = 300
+# rows and transferred bytes a query may return before it is stopped
+QUERY_MAX_ROWS = 10_000_000
+QUERY_MAX_BYTES = 1_000_000_000
+# archived rows a query may load on the server (see remote_query.shadow_archived)
+QUERY_MAX_LOAD_ROWS = remote_query.LOAD_MAX_ROWS
+# the server reports its own deadline first, the client waits this much longer for it
+DEADLINE_GRACE_SECONDS = 10
+DEFAULT_HELPER = "remote_query.py"
+DEFAULT_DB = "vehicle_positions.db"
+# rows per chunk when a result that is already local (cache, mirror) is streamed
+STREAM_CHUNK_ROWS = 65536
+
+
+class QueryServiceError(RuntimeError):
+    """Raised when the query service rejects a request or the query fails."""
+
+
+class QueryStoppedError(QueryServiceError):
+    """Raised when a query was stopped: it ran past its deadline, returned too much or was cancelled."""
+
+
+class QueryCancelledError(QueryStoppedError):
+    """Raised when a query was stopped because its request was cancelled (see QueryGuard.cancel)."""
+
+
+class QueryGuard:
+    """Limits of the queries of one request, and the channels to close when it is cancelled.
+
+    Every query of the request (e.g. every day of a range) gets its own
+    deadline, which the server enforces as well, and its own row and byte
+    caps, checked while the result arrives. The server stops a query that
+    would load more than max_load_rows archived rows before it returns any
+    (see remote_query.shadow_archived). A query over a limit is stopped
+    by closing its channel, which ends it on the server (see
+    remote_query.limits). cancel() does the same for all queries still
+    running, e.g. when the caller of a stream stopped reading.
+
+    Attributes:
+        timeout (float): Seconds a query may run.
+        max_rows (int): Rows a query may return.
+        max_bytes (int): Bytes a query may transfer.
+        max_load_rows (int): Archived rows a query may load on the server.
+        cancelled (bool): True once cancel() was called.
+    """
+    def __init__(self, timeout=QUERY_TIMEOUT_SECONDS, max_rows=QUERY_MAX_ROWS, max_bytes=QUERY_MAX_BYTES,
+                 max_load_rows=QUERY_MAX_LOAD_ROWS):
+        """Initialize the QueryGuard.
+
+        Args:
+            timeout (float): Seconds a query may run.
+            max_rows (int): Rows a query may return.
+            max_bytes (int): Bytes a query may transfer.
+            max_load_rows (int): Archived rows a query may load on the server.
+        """
+        self.timeout = timeout
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_load_rows = max_load_rows
+        self.cancelled = False
+        self.channels = set()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def watch(self, channel):
+        """Register the channel of a running query until the block is left.
+
+        Args:
+            channel (paramiko.Channel): The channel of the query.
+
+        Yields:
+            float: time.monotonic() deadline of the query.
+
+        Raises:
+            QueryStoppedError: If the request was already cancelled.
+        """
+        with self.lock:
+            if self.cancelled:
+                raise QueryCancelledError("Query stopped: it was cancelled.")
+            self.channels.add(channel)
+        # a read waiting for a server that no longer answers fails instead of blocking
+        channel.settimeout(self.timeout + DEADLINE_GRACE_SECONDS)
+        try:
+            yield time.monotonic() + self.timeout
+        finally:
+            with self.lock:
+                self.channels.discard(channel)
+
+    def cancel(self):
+        """Stop the queries that are still running and refuse new ones."""
+        with self.lock:
+            self.cancelled = True
+            channels = list(self.channels)
+        for channel in channels:
+            channel.close()
+
+
+def parse_address(value):
+    """Parse a service address from the environment.
+
+    Args:
+        value (str): "host:port", ":port" or the path of a Unix socket.
+
+    Returns:
+        tuple or str: (host, port), or the socket path.
+    """
+    host, sep, port = value.rpartition(":")
+    if sep and port.isdigit():
+        return (host or DEFAULT_ADDRESS[0], int(port))
+    return value
+
+
+def connect(address, timeout=QUERY_TIMEOUT_SECONDS):
+    """Open a socket to a query service on this machine, e.g. for local runs and tests.
+
+    Args:
+        address (tuple or str): (host, port) or the path of a Unix socket.
+        timeout (float): Socket timeout in seconds.
+
+    Returns:
+        socket.socket: The connected socket.
+    """
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(address)
+        return sock
+    return socket.create_connection(address, timeout=timeout)
+
+
+class _Borrowed:
+    """Socket-like view that http.client cannot close.
+
+    http.client closes its socket as soon as the response headers of a
+    closing connection are read. A socket survives that while the response
+    still reads from it, an SSH channel does not, so the caller closes it.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+
+    def sendall(self, data):
+        return self.sock.sendall(data)
+
+    def makefile(self, mode):
+        return self.sock.makefile(mode)
+
+    def close(self):
+        pass
+
+
+def _response(sock, method, path, body=None):
+    """Send one HTTP request over a connected socket and return the response."""
+    conn = http.client.HTTPConnection("query-service")
+    # the socket may be an SSH channel, so http.client must not connect itself
+    conn.sock = _Borrowed(sock)
+    headers = {"Content-Type": "application/json"} if body is not None else {}
+    conn.request(method, path, body=body, headers=headers)
+    return conn.getresponse()
+
+
+def _check(response):
+    """Raise QueryServiceError unless the response succeeded."""
+    if response.status != 200:
+        message = response.read().decode(errors="replace").strip()
+        if response.status == 504:
+            # the service stopped the query at its deadline, the body says so
+            raise QueryStoppedError(message)
+        raise QueryServiceError(f"{response.status} {response.reason}: {message}")
+
+
+class _CountingReader:
+    """File-like view of a response or SSH stream that reports the bytes read from it.
+
+    Every read checks the deadline, the byte cap and the cancellation of the query.
+    """
+    # pyarrow checks the file before reading
+    closed = False
+
+    def __init__(self, stream, on_bytes, guard, deadline):
+        self.stream = stream
+        self.on_bytes = on_bytes
+        self.guard = guard
+        self.deadline = deadline
+        self.received = 0
+
+    def read(self, size=-1):
+        if time.monotonic() > self.deadline:
+            raise QueryStoppedError(f"Query stopped: it ran longer than {self.guard.timeout:g} s.")
+        data = self.stream.read(size)
+        if not data and self.guard.cancelled:
+            # the channel was closed by cancel()
+            raise QueryCancelledError("Query stopped: it was cancelled.")
+        self.received += len(data)
+        if self.received > self.guard.max_bytes:
+            raise QueryStoppedError(f"Query stopped: its result is larger than {self.guard.max_bytes / 1e6:g} MB.")
+        if self.on_bytes is not None and data:
+            self.on_bytes(len(data))
+        return data
+
+
+def _batches(stream, on_bytes, guard, deadline):
+    """Yield the record batches of an Arrow IPC stream while they arrive.
+
+    An empty result yields one batch without rows, so the schema is never lost.
+
+    Raises:
+        QueryStoppedError: If the query is over a limit of the guard or was cancelled.
+    """
+    try:
+        reader = pa.ipc.open_stream(_CountingReader(stream, on_bytes, guard, deadline))
+        rows = 0
+        for batch in reader:
+            rows += batch.num_rows
+            if rows > guard.max_rows:
+                raise QueryStoppedError(f"Query stopped: its result has more than {guard.max_rows} rows.")
+            yield batch
+    except socket.timeout as e:
+        raise QueryStoppedError(f"Query stopped: no answer from the server within "
+                                f"{guard.timeout + DEADLINE_GRACE_SECONDS:g} s.") from e
+    if not rows:
+        yield pa.RecordBatch.from_pylist([], schema=reader.schema)
+
+
+def stream(sock, name, params, on_bytes=None, guard=None):
+    """Run a named query of queries.py on the service and yield the result while it arrives.
+
+    Args:
+        sock: Connected socket or socket-like SSH channel; one request per socket.
+        name (str): Name of the query.
+        params (dict): Its parameters.
+        on_bytes (callable, optional): Called with the number of bytes of every read.
+        guard (QueryGuard, optional): Limits of the query, the defaults if None.
+
+    Yields:
+        pyarrow.RecordBatch: The typed rows, column names as in the query.
+
+    Raises:
+        QueryStoppedError: If the query is over a limit or was cancelled.
+        QueryServiceError: If the request is rejected, the query fails or the
+            stream breaks off.
+    """
+    guard = guard or QueryGuard()
+    with guard.watch(sock) as deadline:
+        body = json.dumps({"query": name, "params": params, "timeout": guard.timeout,
+                           "max_load_rows": guard.max_load_rows}).encode()
+        try:
+            response = _response(sock, "POST", "/query", body)
+        except socket.timeout as e:
+            raise QueryStoppedError(f"Query stopped: no answer from the server within "
+                                    f"{guard.timeout + DEADLINE_GRACE_SECONDS:g} s.") from e
+        except (http.client.HTTPException, OSError) as e:
+            if guard.cancelled:
+                # cancel() closed the channel before the response arrived
+                raise QueryCancelledError("Query stopped: it was cancelled.") from e
+            raise
+        _check(response)
+        try:
+            yield from _batches(response, on_bytes, guard, deadline)
+        except pa.ArrowInvalid as e:
+            if time.monotonic() > deadline:
+                # the service stopped the query at its deadline while streaming
+                raise QueryStoppedError(f"Query stopped: it ran longer than {guard.timeout:g} s.") from e
+            raise QueryServiceError(f"The result stream of {name} broke off: {e}") from e
+
+
+def query(sock, name, params, guard=None):
+    """Run a named query of queries.py on the service.
+
+    Args:
+        sock: Connected socket or socket-like SSH channel; one request per socket.
+        name (str): Name of the query.
+        params (dict): Its parameters.
+        guard (QueryGuard, optional): Limits of the query, the defaults if None.
+
+    Returns:
+        pyarrow.Table: The typed result, column names as in the query.
+
+    Raises:
+        QueryStoppedError: If the query is over a limit or was cancelled.
+        QueryServiceError: If the request is rejected, the query fails or the
+            stream breaks off.
+    """
+    return pa.Table.from_batches(list(stream(sock, name, params, guard=guard)))
+
+
+def list_queries(sock):
+    """Return the named queries of the service.
+
+    Args:
+        sock: Connected socket or socket-like SSH channel.
+
+    Returns:
+        dict: Query name -> parameter names.
+    """
+    response = _response(sock, "GET", "/queries")
+    _check(response)
+    return json.loads(response.read())
+
+
+def stream_helper(ssh, command, input, on_bytes=None, guard=None):
+    """Run a helper on the server that writes an Arrow IPC stream and yield its batches.
+
+    The batches are yielded while the helper writes them, so the caller can
+    process a large result in chunks of remote_query.ARROW_BATCH_ROWS rows.
+    Leaving the loop early closes the channel, which stops the helper (see
+    remote_query.limits).
+
+    Args:
+        ssh (managers.ssh_pool.SSHConnection): The shared connection.
+        command (str): The command line of the helper, without --timeout.
+        input (str): Data written to its stdin, the SQL or the JSON parameters.
+        on_bytes (callable, optional): Called with the number of bytes of every read.
+        guard (QueryGuard, optional): Limits of the query, the defaults if None.
+
+    Yields:
+        pyarrow.RecordBatch: The rows; one batch without rows if the result is empty.
+
+    Raises:
+        QueryStoppedError: If the query is over a limit or was cancelled.
+        QueryServiceError: If the helper reports an error or writes no complete stream.
+    """
+    guard = guard or QueryGuard()
+    with ssh.exec_command(f"{command} --timeout {guard.timeout:g} --max-load-rows {guard.max_load_rows}",
+                          guard) as (stdin, stdout, stderr):
+        with guard.watch(stdout.channel) as deadline:
+            stdin.write(input)
+            stdin.channel.shutdown_write()
+            try:
+                yield from _batches(stdout, on_bytes, guard, deadline)
+                complete = True
+            except pa.ArrowInvalid:
+                # no or a truncated stream, the helper failed
+                complete = False
+            error = stderr.read().decode()
+            # the helper exits right after reporting an error
+            status = stdout.channel.recv_exit_status() if error or not complete else 0
+    if status == remote_query.EXIT_STOPPED:
+        raise QueryStoppedError(error.strip())
+    if error or not complete:
+        raise QueryServiceError(error.strip() or f"{command} returned no result.")
+
+
+def run_helper(ssh, command, input, guard=None):
+    """Run a helper on the server that writes an Arrow IPC stream and return its result.
+
+    Args:
+        ssh (managers.ssh_pool.SSHConnection): The shared connection.
+        command (str): The command line of the helper, without --timeout.
+        input (str): Data written to its stdin, the SQL or the JSON parameters.
+        guard (QueryGuard, optional): Limits of the query, the defaults if None.
+
+    Returns:
+        pyarrow.Table: The result.
+
+    Raises:
+        QueryStoppedError: If the query is over a limit or was cancelled.
+        QueryServiceError: If the helper reports an error or writes no complete stream.
+    """
+    return pa.Table.from_batches(list(stream_helper(ssh, command, input, guard=guard)))
+
+
+def stream_named(ssh, name, params, service=None, helper=DEFAULT_HELPER, db_path=DEFAULT_DB, on_bytes=None,
+                 guard=None):
+    """Run a named query on the server and yield the result while it arrives (see fetch_named).
+
+    Args:
+        ssh (managers.ssh_pool.SSHConnection): The shared connection.
+        name (str): Name of the query.
+        params (dict): Its parameters.
+        service (tuple or str, optional): Address of query_service.py as seen from
+            the server; None runs the query with the helper.
+        helper (str): Path of remote_query.py on the server.
+        db_path (str): Path of the collector database on the server.
+        on_bytes (callable, optional): Called with the number of bytes of every read.
+        guard (QueryGuard, optional): Limits of the query, the defaults if None.
+
+    Yields:
+        pyarrow.RecordBatch: The typed rows; one batch without rows if the result is empty.
+
+    Raises:
+        QueryStoppedError: If the query is over a limit or was cancelled.
+        QueryServiceError: If the query fails.
+        paramiko.SSHException, OSError: If the connection fails.
+    """
+    if service is None:
+        command = f"python3 {helper} --db {db_path} --query {shlex.quote(name)} --format arrow"
+        yield from stream_helper(ssh, command, json.dumps(params), on_bytes, guard)
+        return
+    guard = guard or QueryGuard()
+    with ssh.tunnel(service, guard) as channel:
+        yield from stream(channel, name, params, on_bytes, guard)
+
+
+def fetch_named(ssh, name, params, service=None, helper=DEFAULT_HELPER, db_path=DEFAULT_DB, guard=None):
+    """Run a named query on the server, through the query service if its address is given.
+
+    Args:
+        ssh (managers.ssh_pool.SSHConnection): The shared connection.
+        name (str): Name of the query.
+        params (dict): Its parameters.
+        service (tuple or str, optional): Address of query_service.py as seen from
+            the server (see parse_address); None runs the query with the helper.
+        helper (str): Path of remote_query.py on the server.
+        db_path (str): Path of the collector database on the server.
+        guard (QueryGuard, optional): Limits of the query, the defaults if None.
+
+    Returns:
+        pyarrow.Table: The typed result.
+
+    Raises:
+        QueryStoppedError: If the query is over a limit or was cancelled.
+        QueryServiceError: If the query fails.
+        paramiko.SSHException, OSError: If the connection fails.
+    """
+    return pa.Table.from_batches(list(stream_named(ssh, name, params, service, helper, db_path, guard=guard)))
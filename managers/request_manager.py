@@ -1,21 +1,34 @@
+import logging
 import paramiko
-import pandas as pd
-from io import StringIO
+import pyarrow as pa
 import sqlite3
 import os
+import queue
+import shlex
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import streamlit as st
+from managers.ssh_pool import get_pool
+from managers import query_client, query_cache
+from managers.single_flight import FlightCancelled, get_single_flight
+import mirror
+import queries
+
+logger = logging.getLogger(__name__)
 
 class RequestManager:
     """Manages SSH connection and SQL queries to the remote vehicle_positions database.
 
-    This class loads environment variables, opens an SSH tunnel to the remote SQLite database,
-    and provides methods to execute SQL queries and return results as pandas DataFrames.
+    This class loads environment variables, uses the process-wide SSH connection to the
+    remote SQLite database (see managers/ssh_pool.py), and provides methods to execute
+    SQL queries and return results as pandas DataFrames. Creating a RequestManager is
+    cheap: the connection is shared across Streamlit reruns and sessions.
     """
     def __init__(self):
         """Initialize the RequestManager.
 
-        Loads environment variables and establishes an SSH connection to the remote database.
+        Loads environment variables and gets the pooled SSH connection to the remote database.
         """
         self.load_env()
         self.connect()
@@ -32,86 +45,458 @@ class RequestManager:
     def connect(self):
 
 
-        """Establish an SSH connection to the remote database.
-
-        Reads SSH_USER, SERVER_ADDRESS, and PEM key path from environment/session state,
-        then connects using Paramiko SSHClient.
+        """Get the SSH connection to the remote database from the pool.
 
-        Raises:
-            paramiko.SSHException: If SSH authentication or connection fails.
+        Reads SSH_USER, SERVER_ADDRESS, and PEM key path from environment/session state.
+        The pool connects on first use and keeps the connection open (with keepalives
+        and transparent reconnects) for all later RequestManagers of these settings.
+        On failure an error is shown and self.ssh is None.
         """
     
         self.hostname = st.session_state["SERVER_ADDRESS"]
         self.username = st.session_state["SSH_USER"]
-        print("Connecting to server:", self.hostname)
-        print("Using username:", self.username)
 
         #self.key_path = "C:\\Users\\nilsw\\Documents\\prague_gtfs\\private_key_server.pem"
         #self.key = paramiko.RSAKey.from_private_key_file(self.key_path)
         self.key_path = st.session_state["pem_key_path"]
         #print("Using key path:", self.key_path)
         self.remote_db_path ="vehicle_positions.db"
-        self.ssh = paramiko.SSHClient()
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        # runs ranged queries over the database and the archive of old days
+        self.remote_helper = os.getenv("REMOTE_QUERY_HELPER", "remote_query.py")
+        # address of query_service.py as seen from the server; unset: run queries with remote_helper
+        service = os.getenv("QUERY_SERVICE")
+        self.query_service = query_client.parse_address(service) if service else None
+        # days of a long range queried at the same time, each on its own SSH channel
+        self.parallelism = max(1, int(os.getenv("QUERY_PARALLELISM", "4")))
+        # seconds a query may run, on the server and here, before it is stopped
+        self.query_timeout = float(os.getenv("QUERY_TIMEOUT_SECONDS", query_client.QUERY_TIMEOUT_SECONDS))
+        # rows and megabytes a query may return before it is stopped
+        self.max_rows = int(os.getenv("QUERY_MAX_ROWS", query_client.QUERY_MAX_ROWS))
+        self.max_bytes = int(float(os.getenv("QUERY_MAX_MB", query_client.QUERY_MAX_BYTES / 1e6)) * 1e6)
+        # archived rows a query may load on the server before it is stopped
+        self.max_load_rows = int(os.getenv("QUERY_MAX_LOAD_ROWS", query_client.QUERY_MAX_LOAD_ROWS))
+        # local time of the collector, used to turn epoch seconds into timestamps
+        self.server_timezone = os.getenv("SERVER_TIMEZONE", "Europe/Prague")
+        # metrics text file rewritten by the collector after every snapshot
+        self.remote_metrics_path = os.getenv("REMOTE_METRICS_FILE", "metrics.prom")
+        # server and database the cached results and the mirror belong to
+        self.source = f"{self.hostname}:{self.remote_db_path}"
+        # results of past days are read from disk instead of the server
+        self.cache = query_cache.get_query_cache()
+        # local copy of the database, created by `python mirror.py sync`
+        self.mirror = mirror.get_mirror(self.source, self.server_timezone)
+        # identical queries running at the same time in several sessions are fetched once
+        self.flights = get_single_flight()
+        self.ssh = None
         try:
-            self.ssh.connect(hostname=self.hostname, username=self.username, key_filename=self.key_path)
-        except paramiko.SSHException as e:
+            self.ssh = get_pool().get(self.hostname, self.username, self.key_path)
+        except (paramiko.SSHException, OSError) as e:
             st.error("SSH connection failed. Please check your credentials and server address.")
             print("SSH connection failed:", e)
             return
+        if self.mirror is not None:
+            self.mirror.start_background(self._remote_table, self.ssh.download)
 
-    def server_request(self, sql_query, columns=None):
+    def server_request(self, sql_query, columns=None, time_range=None):
         """Execute a SQL query on the remote SQLite database via SSH.
 
+        The query runs through the remote_query.py helper, which returns the rows
+        as a compressed Arrow IPC stream (see remote_query.write_arrow), so the
+        result keeps the column names and types of the query and is read batch
+        by batch instead of parsing text. Queries with a time range also read
+        days that maintenance.py moved to the archive. The query is stopped
+        after QUERY_TIMEOUT_SECONDS or once its result exceeds QUERY_MAX_ROWS
+        rows or QUERY_MAX_MB, and the reason is shown.
+
         Args:
             sql_query (str): The SQL query to run on the remote database.
-            columns (list[str], optional): Column names for the returned DataFrame.
+            columns (list[str], optional): Names replacing the column names of the
+                query, used if the number of columns matches.
+            time_range (tuple, optional): (start, end) local datetimes the query covers.
 
         Returns:
             pandas.DataFrame or None: A DataFrame with query results (empty if no data),
             or None if an error occurred.
 
         """
+        if self.ssh is None or not self.remote_db_path:
+            st.error("Please input the setting files or check the connection.")
+            return None
+        command = f"python3 {self.remote_helper} --db {self.remote_db_path} --format arrow"
+        if time_range is not None:
+            start, end = (shlex.quote(str(value)) for value in time_range)
+            command += f" --start {start} --end {end}"
+        try:
+            table = query_client.run_helper(self.ssh, command, sql_query, self._guard())
+        except query_client.QueryStoppedError as e:
+            st.error(str(e))
+            return None
+        except query_client.QueryServiceError as e:
+            print("Error:", e)
+            return None
+        return self._to_frame(table.to_pandas(), columns)
+
+    def named_request(self, name, params, columns=None):
+        """Run a named, parameterized query of queries.py on the server.
+
+        The range of the query is split into local days (see queries.split;
+        the trip aggregates of the dashboard into service days).
+        Days found in the result cache (see managers/query_cache.py) are read
+        from disk. Of the others, the part the local mirror holds (see
+        mirror.py) is read from it, the rest is fetched from the long-running
+        query service (query_service.py) through the SSH connection if
+        QUERY_SERVICE is set, and through the remote_query.py helper
+        otherwise. Up to QUERY_PARALLELISM days run at the same time, each
+        on its own channel, so the server uses several cores for a long
+        range. A day that another session is fetching at the same moment
+        (e.g. everybody opening the dashboard for today) is not fetched again
+        but waits for that result (see managers/single_flight.py). The days
+        are cached and merged into the result of the whole
+        range with the merge of the query (sums, counts, minima, maxima and
+        weighted means, see queries.merge_days). Every day is stopped after
+        QUERY_TIMEOUT_SECONDS or once it returns more than QUERY_MAX_ROWS rows
+        or QUERY_MAX_MB; then the days still running are stopped too and the
+        reason is shown.
+
+        Args:
+            name (str): Name of the query, a key of queries.QUERIES.
+            params (dict): Its normalized parameters (see queries.build).
+            columns (list[str], optional): Names replacing the column names of the
+                query, used if the number of columns matches.
+
+        Returns:
+            pandas.DataFrame or None: A DataFrame with query results (empty if no data),
+            or None if an error occurred.
+        """
+        try:
+            table = self._named_table(name, params)
+        except query_client.QueryStoppedError as e:
+            st.error(str(e))
+            return None
+        if table is None:
+            self._report_connection()
+            return None
+        return self._to_frame(table.to_pandas(), columns)
 
-        safe_query = sql_query.replace("'", "'\"'\"'")
-        #print("Executing SQL query on remote database:")
-        #print(safe_query)
-        if self.remote_db_path is None or not self.remote_db_path:
+    def delay_summary(self, start, end, min_delay, top=10):
+        """Fetch the aggregates the dashboard shows for the trip delays of a range.
+
+        The delay histogram, the statistics per vehicle type and the trips with
+        the highest delay are computed on the server (see queries.delay_histogram,
+        queries.delay_stats and queries.top_delays) and fetched at the same time,
+        so only a few rows are transferred however many trips the range has.
+
+        Args:
+            start (datetime): Start of the range (local time).
+            end (datetime): End of the range (local time).
+            min_delay (int): Minimum delay threshold in seconds.
+            top (int): Number of trips with the highest delay.
+
+        Returns:
+            dict or None: "histogram", "stats" and "top" -> pandas.DataFrame with the
+            columns of the queries, or None if an error occurred.
+        """
+        requests = {"histogram": queries.delay_histogram(start, end, min_delay),
+                    "stats": queries.delay_stats(start, end, min_delay),
+                    "top": queries.top_delays(start, end, min_delay, top)}
+        guard = self._guard()
+        try:
+            with self._executor(len(requests)) as pool:
+                try:
+                    tables = list(pool.map(lambda request: self._named_table(*request, guard), requests.values()))
+                finally:
+                    guard.cancel()
+        except query_client.QueryStoppedError as e:
+            st.error(str(e))
+            return None
+        if any(table is None for table in tables):
+            self._report_connection()
+            return None
+        return {key: self._to_frame(table.to_pandas(), None) for key, table in zip(requests, tables)}
+
+    def _named_table(self, name, params, guard=None):
+        """Fetch the days of a named query in parallel and merge them, None on errors.
+
+        Raises:
+            managers.query_client.QueryStoppedError: If a day is over a limit.
+        """
+        days = queries.split(name, params)
+        own = guard is None
+        guard = guard or self._guard()
+        with self._executor(len(days)) as pool:
+            try:
+                tables = list(pool.map(lambda item: self._day_table(name, *item, guard), days))
+            finally:
+                if own:
+                    # stops the days still running after one failed; waiting ones are refused
+                    guard.cancel()
+        if any(table is None for table in tables):
+            return None
+        return queries.merge_days(name, tables, params)
+
+    def _guard(self):
+        """Return the limits of a new request (see managers.query_client.QueryGuard)."""
+        return query_client.QueryGuard(self.query_timeout, self.max_rows, self.max_bytes, self.max_load_rows)
+
+    def _report_connection(self):
+        """Show an error if a query failed because there is no connection."""
+        if self.ssh is None or not self.remote_db_path:
             st.error("Please input the setting files or check the connection.")
+
+    def stream_named(self, name, params, columns=None, progress=None):
+        """Run a named query like named_request, yielding the result while it arrives.
+
+        Days come from the result cache, the mirror or the server like in
+        named_request, and up to QUERY_PARALLELISM of them run at the same
+        time, but the days the server answers are passed on batch by batch
+        while they are transferred (and written to the cache on the way), so
+        memory stays bounded by a few chunks instead of the whole range. The
+        chunks of the days arrive interleaved and are not merged across days:
+        rows of queries with a merge in queries.QUERIES (e.g. counts per
+        group) can repeat a group, so the caller aggregates them. Every day
+        has the limits of named_request. If the caller stops reading (e.g. a
+        Streamlit rerun raised in progress), the channels of the running days
+        are closed, which stops their queries on the server.
+
+        Args:
+            name (str): Name of the query, a key of queries.QUERIES.
+            params (dict): Its normalized parameters (see queries.build).
+            columns (list[str], optional): Names replacing the column names of the
+                query, used if the number of columns matches.
+            progress (callable, optional): progress(fraction, rows, bytes) after every
+                chunk, with the share of days done, the rows yielded and the bytes
+                received from the server so far.
+
+        Yields:
+            pandas.DataFrame: The next rows of the result.
+
+        Raises:
+            managers.query_client.QueryStoppedError: If a day is over a limit.
+            managers.query_client.QueryServiceError: If a day cannot be fetched,
+                possibly after chunks of earlier days were yielded.
+        """
+        days = queries.split(name, params)
+        received = [0, 0]
+        lock = threading.Lock()
+
+        def on_bytes(count):
+            with lock:
+                received[1] += count
+
+        batches = self._parallel_batches(name, days, on_bytes)
+        try:
+            for done, batch in batches:
+                received[0] += batch.num_rows
+                if progress is not None:
+                    progress(done / len(days), *received)
+                if batch.num_rows:
+                    yield self._chunk_frame(batch, columns)
+        finally:
+            # stops the running days at once, not when the generator is collected
+            batches.close()
+        if progress is not None:
+            progress(1.0, *received)
+        print("Query streamed successfully. Rows received:", received[0])
+
+    def _executor(self, days):
+        """Return a thread pool for the days of a range, at most self.parallelism threads."""
+        return ThreadPoolExecutor(max_workers=max(1, min(self.parallelism, days)), thread_name_prefix="query-day")
+
+    def _parallel_batches(self, name, days, on_bytes):
+        """Stream up to self.parallelism days at the same time.
+
+        The batches of all days go through one bounded queue, so memory stays
+        bounded by a few batches however fast the days arrive. If the caller
+        stops early or a day fails, the channels of the running days are
+        closed and the waiting ones dropped.
+
+        Yields:
+            tuple: (number of days finished, pyarrow.RecordBatch) in the order the batches arrive.
+        """
+        results = queue.Queue(maxsize=2 * self.parallelism)
+        stop = threading.Event()
+        guard = self._guard()
+        finished = object()
+
+        def offer(item):
+            # waits for room in the queue, gives up once the caller stopped
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce(day, day_params):
+            batches = self._stream_day(name, day, day_params, on_bytes, guard)
+            try:
+                for batch in batches:
+                    if not offer(batch):
+                        return
+                offer(finished)
+            except Exception as e:
+                # errors of days stopped by the caller are not reported
+                if not guard.cancelled:
+                    offer(e)
+            finally:
+                # closes the channel of a day that was not read to the end
+                batches.close()
+
+        pool = self._executor(len(days))
+        for day, day_params in days:
+            pool.submit(produce, day, day_params)
+        done = 0
+        try:
+            while done < len(days):
+                item = results.get()
+                if item is finished:
+                    done += 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield done, item
+        finally:
+            stop.set()
+            # days waiting in a read fail at once, the others notice the stop at their next batch
+            guard.cancel()
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _stream_day(self, name, day, params, on_bytes, guard):
+        """Yield the record batches of one day from the cache, the mirror or the server."""
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(self.source, name, params)
+            batches = self.cache.get_batches(key)
+            if batches is not None:
+                yield from batches
+                return
+        if self.mirror is not None and self.mirror.split(name, params)[0] is not None:
+            # the mirror answers most of the day, only its tail is fetched, both are merged
+            table = self._day_table(name, day, params, guard)
+            if table is None:
+                raise query_client.QueryServiceError(f"{name} failed for {day}, see the log.")
+            yield from table.to_batches(max_chunksize=query_client.STREAM_CHUNK_ROWS)
+            return
+        if self.ssh is None or not self.remote_db_path:
+            raise query_client.QueryServiceError("Please input the setting files or check the connection.")
+        batches = query_client.stream_named(self.ssh, name, params, self.query_service, self.remote_helper,
+                                            self.remote_db_path, on_bytes, guard)
+        if key is not None:
+            batches = self.cache.put_batches(key, batches, query_cache.expires_at(day, self.server_timezone))
+        yield from batches
+
+    def _day_table(self, name, day, params, guard):
+        """Return the result of one day from the cache, or fetch and cache it.
+
+        Concurrent calls for the same query and day share one fetch.
+        """
+        key = query_cache.QueryCache.key(self.source, name, params)
+        if self.cache is not None:
+            table = self.cache.get(key)
+            if table is not None:
+                return table
+
+        def fetch():
+            # a call that just finished may have cached the day meanwhile
+            table = self.cache.get(key) if self.cache is not None else None
+            if table is None:
+                table = self._fetch_day(name, params, guard)
+                if table is not None and self.cache is not None:
+                    self.cache.put(key, table, query_cache.expires_at(day, self.server_timezone))
+            return table
+
+        # only requests with the same limits share a fetch; a waiting one gives up like its own query would
+        flight_key = (key, guard.timeout, guard.max_rows, guard.max_bytes, guard.max_load_rows)
+        wait = guard.timeout + query_client.DEADLINE_GRACE_SECONDS
+        while True:
+            try:
+                table, shared = self.flights.do(flight_key, fetch, wait, lambda: guard.cancelled)
+            except query_client.QueryCancelledError:
+                if guard.cancelled:
+                    raise
+                # the request that fetched the day was cancelled, this one was not
+                continue
+            except FlightCancelled as e:
+                raise query_client.QueryCancelledError("Query stopped: it was cancelled.") from e
+            except TimeoutError as e:
+                raise query_client.QueryStoppedError(f"Query stopped: it ran longer than {guard.timeout:g} s.") from e
+            if shared:
+                stats = self.flights.stats()
+                logger.debug("Shared the running query %s for %s with another request; %d of %d requests "
+                             "deduplicated so far.", name, day, stats["deduplicated"], stats["calls"])
+            return table
+
+    def _fetch_day(self, name, params, guard):
+        """Read the part of a day the mirror holds and fetch the rest from the server, None on errors."""
+        local, remote = self.mirror.split(name, params) if self.mirror is not None else (None, params)
+        tables = []
+        if local is not None:
+            try:
+                tables.append(self.mirror.query(name, local))
+            except (sqlite3.Error, OSError, pa.ArrowException, ValueError) as e:
+                print("Mirror query failed, asking the server:", e)
+                local, remote, tables = None, params, []
+        if remote is not None:
+            table = self._fetch_named(name, remote, guard)
+            if table is None:
+                return None
+            tables.append(table)
+        return queries.merge_days(name, tables, params)
+
+    def _remote_table(self, name, params, guard=None):
+        """Run a named query on the server; raises on errors (used by the mirror's background sync)."""
+        return query_client.fetch_named(self.ssh, name, params, self.query_service, self.remote_helper,
+                                        self.remote_db_path, guard or self._guard())
+
+    def _fetch_named(self, name, params, guard):
+        """Run a named query on the server and return the result as pyarrow.Table, None on errors.
+
+        Runs in the threads of named_request, so it reports errors with print only;
+        a query over a limit raises QueryStoppedError, which named_request shows.
+        """
+        if self.ssh is None or not self.remote_db_path:
+            print("Error: no connection to the server.")
+            return None
+        try:
+            return self._remote_table(name, params, guard)
+        except query_client.QueryStoppedError:
+            raise
+        except (query_client.QueryServiceError, paramiko.SSHException, OSError) as e:
+            print("Error:", e)
             return None
-        command = f"sqlite3 {self.remote_db_path} '{safe_query}'"
-        stdin, stdout, stderr = self.ssh.exec_command(command)
-        output = stdout.read().decode()
-        error = stderr.read().decode()
 
-        #print(repr(output))
+    def _chunk_frame(self, batch, columns):
+        """Convert a streamed record batch to a DataFrame with the given column names."""
+        df = batch.to_pandas()
+        if columns is not None and len(columns) == df.shape[1]:
+            df.columns = columns
+        return df
+
+    def _to_frame(self, df, columns):
+        """Rename the columns of a result if given and report its size."""
+        if columns is not None and len(columns) == df.shape[1]:
+            df.columns = columns
+        if df.empty:
+            print("No data returned from the query.")
+        else:
+            print("Query executed successfully. DataFrame created with shape:", df.shape)
+        return df
 
+    def fetch_metrics(self):
+        """Read the collector's metrics file (Prometheus text format) via SSH.
+
+        Returns:
+            str or None: The exposition text, or None if an error occurred.
+        """
+        try:
+            output, error = self.ssh.run(f"cat {shlex.quote(self.remote_metrics_path)}")
+        except (query_client.QueryServiceError, paramiko.SSHException, OSError) as e:
+            print("Error:", e)
+            return None
+        output = output.decode()
+        error = error.decode()
         if error:
             print("Error:", error)
             return None
-        else:
-            if not output.strip():
-                print("No data returned from the query.")
-                df = pd.DataFrame()
-            else:
-                df = pd.read_csv(StringIO(output), sep="|", header=None)
-                #print(df.head())
-
-                if columns is not None:
-                    if len(columns) == df.shape[1]:
-                        df.columns = columns
-                else:
-                    df.columns = [
-                    "vehicle_id",
-                    "gtfs_trip_id",
-                    "route_type",
-                    "gtfs_route_short_name",
-                    "bearing",
-                    "delay",
-                    "latitude",
-                    "longitude",
-                    "state_position",
-                    "timestamp"
-                ]
-                print("Query executed successfully. DataFrame created with shape:", df.shape)
-            return df
\ No newline at end of file
+        return output
@@ -0,0 +1,110 @@
+import threading
+import time
+
+import streamlit as st
+
+# seconds between the checks of a waiting call for its deadline and cancellation
+WAIT_POLL_SECONDS = 0.2
+
+
+class FlightCancelled(Exception):
+    """Raised in a waiting call that was cancelled before the running call returned."""
+
+
+class SingleFlight:
+    """Runs identical calls that overlap only once and hands every caller the same result.
+
+    The first call of a key runs its function; calls of the same key that
+    arrive while it runs wait for it and get its result (or its error)
+    instead of running the function again. Once the call returned, the
+    next call of the key runs the function again, so results are never
+    reused after the fact (that is the job of the result cache).
+
+    Attributes:
+        calls (int): Calls so far.
+        deduplicated (int): Calls that got the result of a running call instead of running their own.
+    """
+    def __init__(self):
+        """Initialize a SingleFlight without running calls."""
+        self.calls = 0
+        self.deduplicated = 0
+        # key -> {"done": threading.Event, "result": ..., "error": Exception or None}
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, function, timeout=None, cancelled=None):
+        """Return function(), or the result of the running call of the same key.
+
+        A call that waits for a running one gives up after timeout seconds
+        or once cancelled() returns True; the running call goes on for its
+        other callers. Calls that must not share results, e.g. because they
+        have different limits, need different keys.
+
+        Args:
+            key (hashable): Identifies identical calls, e.g. a normalized query.
+            function (callable): Computes the result; called without arguments.
+            timeout (float, optional): Seconds to wait for a running call; None waits until it returned.
+            cancelled (callable, optional): Returns True when the caller no longer wants the result.
+
+        Returns:
+            tuple: (result, True if it was shared from a running call).
+
+        Raises:
+            TimeoutError: If the running call did not return within timeout.
+            FlightCancelled: If cancelled() returned True while waiting.
+            Exception: The error of the call that ran function, in all its callers.
+        """
+        with self.lock:
+            self.calls += 1
+            flight = self.flights.get(key)
+            shared = flight is not None
+            if shared:
+                self.deduplicated += 1
+            else:
+                flight = self.flights[key] = {"done": threading.Event(), "result": None, "error": None}
+        if shared:
+            self._wait(flight, timeout, cancelled)
+        else:
+            try:
+                flight["result"] = function()
+            except Exception as e:
+                flight["error"] = e
+            finally:
+                # later calls run the function again, the waiting ones get this outcome
+                with self.lock:
+                    del self.flights[key]
+                flight["done"].set()
+        if flight["error"] is not None:
+            raise flight["error"]
+        return flight["result"], shared
+
+    @staticmethod
+    def _wait(flight, timeout, cancelled):
+        """Wait until the flight is done, raising once timeout passed or cancelled() is True."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = WAIT_POLL_SECONDS if cancelled is not None else None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                wait = remaining if wait is None else min(wait, remaining)
+            if flight["done"].wait(max(wait, 0) if wait is not None else None):
+                return
+            if cancelled is not None and cancelled():
+                raise FlightCancelled("The call was cancelled while it waited for a running call.")
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError(f"The running call did not return within {timeout:g} s.")
+
+    def stats(self):
+        """Return the counters, e.g. to report how much load was saved.
+
+        Returns:
+            dict: "calls", "deduplicated" and "running" (calls running now).
+        """
+        with self.lock:
+            return {"calls": self.calls, "deduplicated": self.deduplicated, "running": len(self.flights)}
+
+
+@st.cache_resource
+def get_single_flight():
+    """Return the SingleFlight of this process, shared by all sessions."""
+    return SingleFlight()
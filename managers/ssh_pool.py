@@ -0,0 +1,345 @@
+import atexit
+import os
+import shlex
+import threading
+import time
+from contextlib import contextmanager
+
+import paramiko
+import streamlit as st
+
+from managers.query_client import QueryCancelledError, QueryStoppedError
+
+# seconds between keepalive packets, so idle connections survive NAT and firewall timeouts
+SSH_KEEPALIVE_SECONDS = int(os.getenv("SSH_KEEPALIVE_SECONDS", "30"))
+# channels (remote commands) open at the same time per connection; sshd allows 10 by default
+SSH_MAX_CHANNELS = int(os.getenv("SSH_MAX_CHANNELS", "8"))
+# seconds to wait for a free channel before giving up
+SSH_CHANNEL_WAIT_SECONDS = float(os.getenv("SSH_CHANNEL_WAIT_SECONDS", "60"))
+# seconds between checks whether the query waiting for a channel was cancelled
+SSH_CHANNEL_POLL_SECONDS = 0.2
+# connections unused for this long are closed
+SSH_IDLE_SECONDS = float(os.getenv("SSH_IDLE_SECONDS", "900"))
+# connections unused for this long are probed before they are used again
+SSH_HEALTH_CHECK_SECONDS = 60
+SSH_CONNECT_TIMEOUT = 15
+
+# errors of a broken transport, after which the connection is opened again
+_TRANSPORT_ERRORS = (paramiko.SSHException, EOFError, OSError)
+
+
+class ChannelLimitError(QueryStoppedError):
+    """Raised when no channel becomes free in time; the callers of queries handle it like a stopped query."""
+
+
+class SSHConnection:
+    """One persistent SSH connection shared by all callers of a server.
+
+    Every remote command runs in its own channel of the same transport, so the
+    key exchange happens once per connection instead of once per query. The
+    connection sends keepalives, is probed before use after a quiet period and
+    is opened again transparently when the transport broke.
+
+    Attributes:
+        hostname (str): Server address.
+        username (str): SSH user.
+        key_path (str): Path to the private key.
+        client (paramiko.SSHClient): The current client, None until connected.
+        last_used (float): time.monotonic() of the last use.
+        active (int): Number of channels currently open.
+    """
+    def __init__(self, hostname, username, key_path, max_channels=SSH_MAX_CHANNELS):
+        """Initialize the SSHConnection and connect.
+
+        Args:
+            hostname (str): Server address.
+            username (str): SSH user.
+            key_path (str): Path to the private key.
+            max_channels (int): Maximum number of channels open at the same time.
+
+        Raises:
+            paramiko.SSHException: If SSH authentication or connection fails.
+        """
+        self.hostname = hostname
+        self.username = username
+        self.key_path = key_path
+        self.client = None
+        self.last_used = time.monotonic()
+        self.active = 0
+        self.lock = threading.Lock()
+        self.channels = threading.BoundedSemaphore(max_channels)
+        self._connect()
+
+    def _connect(self):
+        """Open a new client and enable keepalives."""
+        print("Connecting to server:", self.hostname)
+        print("Using username:", self.username)
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(hostname=self.hostname, username=self.username, key_filename=self.key_path,
+                       timeout=SSH_CONNECT_TIMEOUT)
+        client.get_transport().set_keepalive(SSH_KEEPALIVE_SECONDS)
+        self.client = client
+
+    def _healthy(self):
+        """Return True if the transport is usable, probing it after a quiet period."""
+        transport = self.client.get_transport() if self.client is not None else None
+        if transport is None or not transport.is_active():
+            return False
+        if time.monotonic() - self.last_used > SSH_HEALTH_CHECK_SECONDS:
+            try:
+                transport.send_ignore()
+            except _TRANSPORT_ERRORS:
+                return False
+        return True
+
+    def transport(self):
+        """Return a working transport, reconnecting if the current one broke.
+
+        Returns:
+            paramiko.Transport: The transport of the connection.
+        """
+        with self.lock:
+            if not self._healthy():
+                self._reconnect()
+            self.last_used = time.monotonic()
+            return self.client.get_transport()
+
+    def _reconnect(self, broken=None):
+        """Replace the client, unless another caller already replaced the broken transport."""
+        if broken is not None and self.client is not None and self.client.get_transport() is not broken:
+            return
+        print("Reconnecting to server:", self.hostname)
+        self._close_client()
+        self._connect()
+
+    def _open_channel(self, kind, *args):
+        """Open a channel, reconnecting once if the transport broke."""
+        transport = self.transport()
+        try:
+            return transport.open_channel(kind, *args, timeout=SSH_CONNECT_TIMEOUT)
+        except _TRANSPORT_ERRORS:
+            with self.lock:
+                self._reconnect(broken=transport)
+                transport = self.client.get_transport()
+            return transport.open_channel(kind, *args, timeout=SSH_CONNECT_TIMEOUT)
+
+    def _acquire(self, guard=None):
+        """Wait for a free channel, at most SSH_CHANNEL_WAIT_SECONDS and the timeout of the guard.
+
+        Raises:
+            ChannelLimitError: If no channel becomes free in time.
+            managers.query_client.QueryCancelledError: If the guard was cancelled meanwhile.
+        """
+        wait = SSH_CHANNEL_WAIT_SECONDS if guard is None else min(SSH_CHANNEL_WAIT_SECONDS, guard.timeout)
+        deadline = time.monotonic() + wait
+        while True:
+            if guard is not None and guard.cancelled:
+                raise QueryCancelledError("Query stopped: it was cancelled.")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ChannelLimitError(f"Query stopped: no free SSH channel to {self.hostname} "
+                                        f"after {wait:g} s.")
+            if self.channels.acquire(timeout=min(remaining, SSH_CHANNEL_POLL_SECONDS)):
+                return
+
+    @contextmanager
+    def _channel(self, kind, *args, guard=None):
+        """Open a channel that counts against the channel cap until the block is left."""
+        self._acquire(guard)
+        with self.lock:
+            self.active += 1
+        try:
+            channel = self._open_channel(kind, *args)
+            try:
+                yield channel
+            finally:
+                channel.close()
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.last_used = time.monotonic()
+            self.channels.release()
+
+    @contextmanager
+    def exec_command(self, command, guard=None):
+        """Run a remote command in a channel of the shared connection.
+
+        The channel counts against the channel cap until the block is left,
+        so callers should read the output inside the block.
+
+        Args:
+            command (str): The command line to run on the server.
+            guard (managers.query_client.QueryGuard, optional): Limits of the
+                query the command runs; the wait for a channel ends with its
+                timeout or its cancellation.
+
+        Yields:
+            tuple: (stdin, stdout, stderr) file objects like SSHClient.exec_command.
+
+        Raises:
+            ChannelLimitError: If no channel becomes free in time.
+            managers.query_client.QueryCancelledError: If the guard was cancelled while waiting.
+        """
+        with self._channel("session", guard=guard) as channel:
+            channel.exec_command(command)
+            yield channel.makefile_stdin("wb"), channel.makefile("rb"), channel.makefile_stderr("rb")
+
+    @contextmanager
+    def tunnel(self, address, guard=None):
+        """Connect to a TCP address as seen from the server (like ssh -L).
+
+        Args:
+            address (tuple): (host, port) on the server side, e.g. ("127.0.0.1", 8765).
+            guard (managers.query_client.QueryGuard, optional): Limits of the
+                query sent through the tunnel (see exec_command).
+
+        Yields:
+            paramiko.Channel: A socket-like channel to the address.
+
+        Raises:
+            ChannelLimitError: If no channel becomes free in time.
+            managers.query_client.QueryCancelledError: If the guard was cancelled while waiting.
+            paramiko.ChannelException: If the server cannot connect to the address.
+        """
+        with self._channel("direct-tcpip", address, ("127.0.0.1", 0), guard=guard) as channel:
+            yield channel
+
+    def run(self, command, input=None):
+        """Run a remote command and return its complete output.
+
+        Args:
+            command (str): The command line to run on the server.
+            input (str or bytes, optional): Data written to the command's stdin.
+
+        Returns:
+            tuple: (stdout bytes, stderr bytes).
+        """
+        with self.exec_command(command) as (stdin, stdout, stderr):
+            if input is not None:
+                stdin.write(input)
+            # the command never waits for more input
+            stdin.channel.shutdown_write()
+            return stdout.read(), stderr.read()
+
+    def download(self, remote_path, local_path, chunk_size=1 << 20):
+        """Copy a file from the server, e.g. a day of the archive.
+
+        The file is written under a temporary name and renamed when complete.
+
+        Args:
+            remote_path (str): Path on the server.
+            local_path (str): Destination path.
+            chunk_size (int): Bytes read at a time.
+
+        Raises:
+            OSError: If the remote file cannot be read.
+        """
+        tmp_path = f"{local_path}.tmp"
+        with self.exec_command(f"cat {shlex.quote(remote_path)}") as (stdin, stdout, stderr):
+            stdin.channel.shutdown_write()
+            with open(tmp_path, "wb") as f:
+                while True:
+                    chunk = stdout.read(chunk_size)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+            error = stderr.read().decode()
+            status = stdout.channel.recv_exit_status()
+        if status != 0:
+            os.remove(tmp_path)
+            raise OSError(f"Cannot copy {remote_path} from {self.hostname}: {error.strip()}")
+        os.replace(tmp_path, local_path)
+
+    def idle_for(self):
+        """Return the seconds since the last use, 0 while a channel is open."""
+        return 0.0 if self.active else time.monotonic() - self.last_used
+
+    def _close_client(self):
+        """Close the current client, ignoring errors of a dead transport."""
+        if self.client is not None:
+            try:
+                self.client.close()
+            except _TRANSPORT_ERRORS:
+                pass
+            self.client = None
+
+    def close(self):
+        """Close the connection."""
+        with self.lock:
+            self._close_client()
+
+
+class SSHPool:
+    """Process-wide pool of SSH connections, one per server, user and key.
+
+    A connection is opened under the lock of its key only, so a slow or
+    unreachable server does not hold up the sessions of other servers.
+
+    Attributes:
+        connections (dict): (hostname, username, key_path) -> SSHConnection.
+        connecting (dict): (hostname, username, key_path) -> threading.Lock held while connecting.
+        max_channels (int): Channel cap of every connection.
+    """
+    def __init__(self, max_channels=SSH_MAX_CHANNELS):
+        """Initialize an empty SSHPool.
+
+        Args:
+            max_channels (int): Channel cap of every connection.
+        """
+        self.connections = {}
+        self.connecting = {}
+        self.max_channels = max_channels
+        self.lock = threading.Lock()
+
+    def get(self, hostname, username, key_path):
+        """Return the connection to a server, connecting on first use.
+
+        Connections that were idle for SSH_IDLE_SECONDS are closed first, so
+        settings that are no longer used do not keep connections open.
+
+        Args:
+            hostname (str): Server address.
+            username (str): SSH user.
+            key_path (str): Path to the private key.
+
+        Returns:
+            SSHConnection: The shared connection.
+
+        Raises:
+            paramiko.SSHException: If SSH authentication or connection fails.
+        """
+        key = (hostname, username, key_path)
+        with self.lock:
+            for other, connection in list(self.connections.items()):
+                if other != key and connection.idle_for() > SSH_IDLE_SECONDS:
+                    connection.close()
+                    del self.connections[other]
+            connection = self.connections.get(key)
+            if connection is not None:
+                return connection
+            connecting = self.connecting.setdefault(key, threading.Lock())
+        with connecting:
+            # another caller may have connected while this one waited
+            with self.lock:
+                connection = self.connections.get(key)
+            if connection is None:
+                connection = SSHConnection(hostname, username, key_path, self.max_channels)
+                with self.lock:
+                    self.connections[key] = connection
+            return connection
+
+    def close(self):
+        """Close all connections, e.g. when the Streamlit server shuts down."""
+        with self.lock:
+            for connection in self.connections.values():
+                connection.close()
+            self.connections.clear()
+
+
+@st.cache_resource
+def get_pool():
+    """Return the SSHPool of this process, shared across reruns and sessions."""
+    pool = SSHPool()
+    atexit.register(pool.close)
+    return pool
@@ -0,0 +1,287 @@
+"""
+metrics.py
+
+Small in-process metrics registry of the collector in the Prometheus text
+exposition format (version 0.0.4), without extra dependencies.
+
+The collector (server.py) updates the metrics defined at the bottom of this
+module and exposes them in two ways:
+- an HTTP endpoint on 127.0.0.1:METRICS_PORT/metrics for a Prometheus scraper,
+- a text file METRICS_TEXTFILE rewritten after every snapshot, which the
+  Collector Health page of the app reads over SSH (and which also works with
+  the textfile collector of node_exporter).
+
+parse_text() turns the text format back into samples for the page.
+"""
+
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))  # 0 disables the endpoint
+METRICS_TEXTFILE = os.getenv("METRICS_TEXTFILE", "metrics.prom")
+
+
+def _format_labels(labels):
+    """Render a label dict as {a="b",...}."""
+    if not labels:
+        return ""
+    items = ",".join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+    return "{" + items + "}"
+
+
+def _format_value(value):
+    """Render a sample value like the Prometheus client libraries."""
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """Base class of all metric types.
+
+    Attributes:
+        name (str): Metric name.
+        help (str): Help text.
+        kind (str): Prometheus type ('counter', 'gauge' or 'histogram').
+    """
+    kind = "untyped"
+
+    def __init__(self, name, help_text):
+        """Initialize the metric.
+
+        Args:
+            name (str): Metric name.
+            help_text (str): Help text.
+        """
+        self.name = name
+        self.help = help_text
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def samples(self):
+        """Return (name, labels, value) tuples of the current values."""
+        with self.lock:
+            return [(self.name, dict(key), value) for key, value in self.values.items()]
+
+
+class Counter(Metric):
+    """Monotonically increasing count."""
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        """Increase the counter.
+
+        Args:
+            amount (float): Increment.
+            **labels: Label values.
+        """
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that can go up and down."""
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        """Set the gauge.
+
+        Args:
+            value (float): New value.
+            **labels: Label values.
+        """
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """Distribution of observations in cumulative buckets."""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets):
+        """Initialize the histogram.
+
+        Args:
+            name (str): Metric name.
+            help_text (str): Help text.
+            buckets (list[float]): Upper bounds of the buckets, +Inf is added.
+        """
+        super().__init__(name, help_text)
+        self.buckets = sorted(buckets) + [float("inf")]
+
+    def observe(self, value, **labels):
+        """Record one observation.
+
+        Args:
+            value (float): Observed value.
+            **labels: Label values.
+        """
+        key = self._key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        """Return the bucket, sum and count samples."""
+        samples = []
+        with self.lock:
+            for key, (counts, total) in self.values.items():
+                labels = dict(key)
+                for bound, count in zip(self.buckets, counts):
+                    samples.append((f"{self.name}_bucket", dict(labels, le=_format_value(bound)), count))
+                samples.append((f"{self.name}_sum", labels, total))
+                samples.append((f"{self.name}_count", labels, counts[-1]))
+        return samples
+
+
+class Registry:
+    """Collection of metrics rendered together."""
+
+    def __init__(self):
+        """Initialize an empty registry."""
+        self.metrics = []
+
+    def register(self, metric):
+        """Add a metric and return it."""
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Render all metrics in the Prometheus text format.
+
+        Returns:
+            str: The exposition text.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def write_textfile(path=METRICS_TEXTFILE, registry=REGISTRY):
+    """Write the metrics to a file atomically (write, then rename).
+
+    Args:
+        path (str): Target file.
+        registry (Registry): Metrics to write.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(registry.render())
+    os.replace(tmp_path, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """Serves the registry on /metrics."""
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes every few seconds would flood the collector's output
+        pass
+
+
+def start_http_server(port=METRICS_PORT, addr="127.0.0.1"):
+    """Serve /metrics from a daemon thread.
+
+    Args:
+        port (int): TCP port, 0 disables the endpoint.
+        addr (str): Bind address; local only by default.
+
+    Returns:
+        ThreadingHTTPServer or None: The running server.
+    """
+    if not port:
+        return None
+    server = ThreadingHTTPServer((addr, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    return server
+
+
+def parse_text(text):
+    """Parse Prometheus exposition text into samples.
+
+    Args:
+        text (str): Exposition text as written by Registry.render().
+
+    Returns:
+        list[tuple]: (name, labels dict, value) for every sample line.
+    """
+    samples = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        series, _, value = line.rpartition(" ")
+        labels = {}
+        if "{" in series:
+            series, _, label_text = series.partition("{")
+            for item in label_text.rstrip("}").split(","):
+                if item:
+                    key, _, label_value = item.partition("=")
+                    labels[key] = label_value.strip('"')
+        samples.append((series, labels, float(value)))
+    return samples
+
+
+# --- Collector metrics -------------------------------------------------------
+
+API_LATENCY = REGISTRY.register(Histogram(
+    "gtfs_api_request_seconds", "Duration of the vehicle positions API request.",
+    [0.1, 0.25, 0.5, 1, 2, 5, 10, 20]))
+API_ERRORS = REGISTRY.register(Counter(
+    "gtfs_api_errors_total", "Failed snapshots by reason (timeout, http, parse, other)."))
+PAYLOAD_BYTES = REGISTRY.register(Histogram(
+    "gtfs_payload_bytes", "Size of the API response body.",
+    [256e3, 512e3, 1e6, 2e6, 4e6, 8e6, 16e6]))
+PARSE_SECONDS = REGISTRY.register(Histogram(
+    "gtfs_parse_seconds", "Time to decode and convert one payload.",
+    [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2]))
+INSERT_SECONDS = REGISTRY.register(Histogram(
+    "gtfs_insert_seconds", "Time to write one snapshot (including commits).",
+    [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10]))
+SNAPSHOT_ROWS = REGISTRY.register(Gauge(
+    "gtfs_snapshot_rows", "Rows of the last snapshot (kind=received or stored)."))
+ROWS_STORED = REGISTRY.register(Counter(
+    "gtfs_rows_stored_total", "Rows written to the positions table."))
+TICKS_MISSED = REGISTRY.register(Counter(
+    "gtfs_ticks_missed_total", "Ticks dropped because a stage was busy (reason=busy) or late (reason=late)."))
+WRITE_LAG = REGISTRY.register(Gauge(
+    "gtfs_write_lag_seconds", "Seconds between the tick and the end of its write."))
+WRITE_ERRORS = REGISTRY.register(Counter(
+    "gtfs_write_errors_total", "Snapshots that could not be written."))
+COMMITS = REGISTRY.register(Counter(
+    "gtfs_commits_total", "Transactions committed by the writer."))
+DB_BYTES = REGISTRY.register(Gauge(
+    "gtfs_db_size_bytes", "Size of the database file (file=db) and its WAL (file=wal)."))
+LAST_TICK = REGISTRY.register(Gauge(
+    "gtfs_last_success_tick_timestamp_seconds", "Tick of the last snapshot written successfully."))
+STARTED = REGISTRY.register(Gauge(
+    "gtfs_collector_start_timestamp_seconds", "Start time of the collector."))
+STARTED.set(time.time())
@@ -0,0 +1,486 @@
+"""
+mirror.py
+
+Incremental local mirror of the collector database (vehicle_positions.db)
+on an analyst's machine.
+
+History is append-only, so a sync only transfers what the collector wrote
+after the high-water mark of the mirror: positions and snapshots newer than
+it, rollup rows updated since, stop visits finished since and new dictionary
+entries. The rows come as Arrow through the mirror_* queries of queries.py,
+over the shared SSH connection and the query service if QUERY_SERVICE is
+set. The mirror has the schema of the collector database (dictionary-encoded
+positions, see schema.py), so the named queries of the pages run on it
+unchanged (see remote_query.execute_named). Days the server already moved to
+its Parquet archive are copied as files into the archive directory next to
+the mirror.
+
+The range up to the newest complete snapshot is transferred in chunks of
+SYNC_CHUNK_SECONDS. Every chunk is committed together with the new
+high-water mark, so an interrupted sync resumes after the last chunk, and a
+chunk is only committed if no other process synced it meanwhile.
+
+Local-first queries:
+    RequestManager.named_request reads from the mirror once it exists:
+    ranges up to the high-water mark are answered locally, only the newest
+    minutes since the last sync go to the server. Rollups and visits of a day
+    change until DAY_SETTLE_SECONDS after its end, so queries on them use
+    the mirror for settled days only. The app syncs in the background every
+    MIRROR_SYNC_SECONDS. SQLite converts local times with the time zone of
+    the machine, so local queries are only used if it matches SERVER_TIMEZONE.
+
+Not mirrored: rollups and visits the server recomputes with a backfill after
+they were synced, and the pruning of minute rollups (the mirror keeps them).
+Old days of the mirror can be moved to its Parquet archive with
+    python maintenance.py run --db mirror/vehicle_positions.db --archive-dir mirror/archive
+
+Usage:
+    python mirror.py sync --since 2025-05-01    # first sync: everything from that day on
+    python mirror.py sync                        # later syncs: only what is new
+    python mirror.py status
+The server address, user and key default to SERVER_ADDRESS, SSH_USER and
+KEY_PATH of the .env file.
+"""
+
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import paramiko
+import streamlit as st
+from dotenv import load_dotenv
+
+import archive
+import queries
+import remote_query
+import rollups
+import schema
+import visits
+from managers import query_client
+from managers.query_cache import DAY_SETTLE_SECONDS
+from managers.ssh_pool import SSHConnection
+
+logger = logging.getLogger(__name__)
+
+# local mirror of the collector database; the app reads from it once it exists
+MIRROR_DB = os.getenv("MIRROR_DB", os.path.join("mirror", "vehicle_positions.db"))
+# seconds between the background syncs of the app, 0 disables them
+MIRROR_SYNC_SECONDS = float(os.getenv("MIRROR_SYNC_SECONDS", "120"))
+# days a first sync without --since reaches back
+MIRROR_DAYS = int(os.getenv("MIRROR_DAYS", "30"))
+# range of snapshots transferred and committed at a time
+SYNC_CHUNK_SECONDS = 3600
+# the same before the first snapshot the server still holds, where only rollups and visits are left
+ARCHIVED_CHUNK_SECONDS = 86400
+
+# query of every table transferred per chunk -> (table, insert statement)
+_CHUNK_TABLES = {
+    "mirror_positions": ("positions", "INSERT"),
+    "mirror_snapshots": ("snapshots", "INSERT OR REPLACE"),
+    # rows of open buckets and visits are transferred again when they changed
+    "mirror_rollups": ("delay_rollups", "INSERT OR REPLACE"),
+    "mirror_visits": ("stop_visits", "INSERT OR REPLACE"),
+}
+
+
+class MirrorError(RuntimeError):
+    """Raised when a sync cannot continue, e.g. because the mirror copies another server."""
+
+
+def _rows(table):
+    """Yield the rows of a pyarrow.Table as tuples, one record batch at a time."""
+    for batch in table.to_batches():
+        yield from zip(*(column.to_pylist() for column in batch.columns))
+
+
+def _format(ts):
+    """Return epoch seconds as local 'YYYY-MM-DD HH:MM:SS' string."""
+    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def same_timezone(server_timezone):
+    """Return True if this machine's local time is the time zone of the collector.
+
+    Compares the UTC offsets in winter and summer, so daylight saving time counts.
+
+    Args:
+        server_timezone (str): Time zone of the collector, e.g. "Europe/Prague".
+
+    Returns:
+        bool: True if local times mean the same on both machines.
+    """
+    year = date.today().year
+    for month in (1, 7):
+        local = datetime(year, month, 15, 12).astimezone().utcoffset()
+        if local != datetime(year, month, 15, 12, tzinfo=ZoneInfo(server_timezone)).utcoffset():
+            return False
+    return True
+
+
+class Mirror:
+    """Local copy of the collector database, synced incrementally.
+
+    Attributes:
+        path (str): Path of the mirror database.
+        archive_dir (str): Root directory of the archived days of the mirror.
+        source (str): Server and database the mirror copies, e.g. "host:vehicle_positions.db".
+        server_timezone (str): Time zone of the collector.
+        remote (tuple): (fetch, download) used by the background sync.
+    """
+    def __init__(self, path=MIRROR_DB, source=None, server_timezone="Europe/Prague"):
+        """Initialize the Mirror and create its tables if needed.
+
+        Args:
+            path (str): Path of the mirror database.
+            source (str, optional): Server and database the mirror copies; a sync
+                fails if the mirror was filled from another one.
+            server_timezone (str): Time zone of the collector.
+        """
+        self.path = path
+        self.archive_dir = os.path.join(os.path.dirname(path), "archive")
+        self.source = source
+        self.server_timezone = server_timezone
+        self.remote = None
+        self.thread = None
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # autocommit: sync() runs its own BEGIN IMMEDIATE transactions
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        schema.ensure_schema(self.conn)
+        rollups.create_rollup_table(self.conn)
+        visits.create_visit_table(self.conn)
+        archive.create_archive_table(self.conn)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS mirror_state (
+                                 name TEXT PRIMARY KEY,
+                                 value)""")
+        schema.ensure_indexes(self.conn, delta=self._delta())
+
+    def _state(self, name, conn=None):
+        row = (conn or self.conn).execute("SELECT value FROM mirror_state WHERE name = ?", (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def _committed_state(self):
+        """Return (synced_until, source) as committed, read on a fresh connection like the queries."""
+        conn = remote_query.open_readonly(self.path)
+        try:
+            return self._state("synced_until", conn), self._state("source", conn)
+        finally:
+            conn.close()
+
+    def _set_state(self, name, value):
+        self.conn.execute("INSERT OR REPLACE INTO mirror_state (name, value) VALUES (?, ?)", (name, value))
+
+    def _delta(self):
+        """Return True if the mirror holds delta snapshots, which need the per-vehicle index."""
+        return self.conn.execute("SELECT 1 FROM snapshots WHERE keyframe_ts <> ts LIMIT 1").fetchone() is not None
+
+    def synced_until(self):
+        """Return the high-water mark.
+
+        Returns:
+            int or None: Epoch second of the newest snapshot in the mirror, None before the first sync.
+        """
+        return self._committed_state()[0]
+
+    def split(self, name, params):
+        """Split the range of a named query into the part the mirror holds and the newer rest.
+
+        Args:
+            name (str): Name of the query.
+            params (dict): Its normalized parameters with start and end as local times.
+
+        Returns:
+            tuple: (params of the local part, params of the remote part), None for an empty part.
+        """
+        until, source = self._committed_state()
+        if until is None or source != self.source or not same_timezone(self.server_timezone):
+            return None, params
+        _, reads_positions = queries.bind(name, params)
+        if not reads_positions:
+            # rollups and visits of a day are final once the day settled
+            settled = datetime.fromtimestamp(until - DAY_SETTLE_SECONDS).date()
+            until = archive.day_bounds(settled)[0] - 1
+        start = datetime.fromisoformat(params["start"]).timestamp()
+        end = datetime.fromisoformat(params["end"]).timestamp()
+        if end <= until:
+            return params, None
+        if start > until or name in queries.SERVICE_DAY_QUERIES:
+            # trip aggregates only combine over whole service days
+            return None, params
+        return dict(params, end=_format(until)), dict(params, start=_format(until + 1))
+
+    def query(self, name, params):
+        """Run a named query on the mirror.
+
+        Args:
+            name (str): Name of the query.
+            params (dict): Its parameters.
+
+        Returns:
+            pyarrow.Table: The result, typed like the results of the server.
+        """
+        conn = remote_query.open_readonly(self.path)
+        try:
+            cursor = remote_query.execute_named(conn, name, params, self.archive_dir)
+            return remote_query.read_table(cursor)
+        finally:
+            conn.close()
+
+    def sync(self, fetch, download, since=None):
+        """Transfer everything the collector wrote after the high-water mark.
+
+        Args:
+            fetch (callable): fetch(name, params) -> pyarrow.Table runs a named query
+                on the server and raises on errors (see managers.query_client.fetch_named).
+            download (callable): download(remote_path, local_path) copies a file from the server.
+            since (date, optional): First day of the first sync, defaults to MIRROR_DAYS
+                days ago. Ignored once the mirror holds data.
+
+        Returns:
+            int: Number of positions transferred.
+
+        Raises:
+            MirrorError: If the mirror copies another server.
+        """
+        with self.lock:
+            stored = self._state("source")
+            if self.source is not None and stored not in (None, self.source):
+                raise MirrorError(f"{self.path} mirrors {stored}, not {self.source}.")
+            synced = self._state("synced_until")
+            if synced is None:
+                since = since or date.today() - timedelta(days=MIRROR_DAYS)
+                lower = archive.day_bounds(since)[0]
+            else:
+                lower = synced + 1
+            bounds = fetch("mirror_bounds", {"since": lower}).to_pylist()[0]
+            until = bounds["until"]
+            if until is None:
+                logger.info("The server has no snapshots yet.")
+                return 0
+            # delta snapshots of the first sync need the rows since their keyframe
+            after = synced if synced is not None else min(lower, bounds["first_keyframe"] or lower) - 1
+            first_day = datetime.fromtimestamp(after + 1).date()
+            if bounds["last_archived_day"] is not None and date.fromisoformat(bounds["last_archived_day"]) >= first_day:
+                self._copy_archive(fetch, download, first_day)
+            self._sync_dictionaries(fetch)
+
+            # before the first snapshot the server still holds, only rollups and visits are left
+            positions_from = after + 1 if synced is not None else bounds["first_keyframe"] or until
+            total = 0
+            while after < until:
+                if after + 1 < positions_from:
+                    upper = min(after + ARCHIVED_CHUNK_SECONDS, positions_from - 1)
+                else:
+                    upper = min(after + SYNC_CHUNK_SECONDS, until)
+                chunk = {name: fetch(name, {"after": after, "until": upper}) for name in _CHUNK_TABLES}
+                if not self._commit_chunk(synced, upper, chunk):
+                    logger.warning(f"{self.path} was synced by another process meanwhile, stopping.")
+                    return total
+                rows = chunk["mirror_positions"].num_rows
+                total += rows
+                logger.info(f"Mirrored {rows} positions up to {_format(upper)}.")
+                synced = after = upper
+            if total:
+                schema.ensure_indexes(self.conn, delta=self._delta())
+            return total
+
+    def _commit_chunk(self, synced, upper, chunk):
+        """Insert the tables of one chunk and move the high-water mark in one transaction.
+
+        Returns:
+            bool: False if the high-water mark is no longer synced, nothing was inserted.
+        """
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self._state("synced_until") != synced:
+                self.conn.execute("ROLLBACK")
+                return False
+            for name, (table_name, insert) in _CHUNK_TABLES.items():
+                table = chunk[name]
+                self.conn.executemany(f"{insert} INTO {table_name} ({', '.join(table.column_names)}) "
+                                      f"VALUES ({', '.join('?' * table.num_columns)})", _rows(table))
+            if self.source is not None:
+                self._set_state("source", self.source)
+            self._set_state("synced_until", upper)
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return True
+
+    def _sync_dictionaries(self, fetch):
+        """Transfer the dictionary entries added since the last sync."""
+        params = {key: self.conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+                  for key, (table, _) in schema.DICTIONARIES.items()}
+        entries = fetch("mirror_dictionaries", params)
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            for key, ident, value in _rows(entries):
+                table, column = schema.DICTIONARIES[key]
+                self.conn.execute(f"INSERT OR IGNORE INTO {table} (id, {column}) VALUES (?, ?)", (ident, value))
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def _copy_archive(self, fetch, download, first_day):
+        """Copy the days the server archived from first_day on and read them from the archive.
+
+        Raw rows of earlier days the mirror holds are exported to its archive,
+        because queries read everything before the last archived day from there
+        (see remote_query.shadow_archived).
+        """
+        days = fetch("mirror_archived_days", {"since": first_day.isoformat()}).to_pylist()
+        if not days:
+            return
+        first_ts = self.conn.execute("SELECT MIN(ts) FROM snapshots").fetchone()[0]
+        cutoff = archive.archived_before(self.conn)
+        if cutoff is not None or first_ts is not None:
+            day = datetime.fromtimestamp(cutoff if cutoff is not None else first_ts).date()
+            while day < date.fromisoformat(days[0]["day"]):
+                rows, path = archive.export_day(self.conn, day, self.archive_dir)
+                self._record_day(day, rows, path)
+                day += timedelta(days=1)
+        for entry in days:
+            day = date.fromisoformat(entry["day"])
+            path = None
+            if entry["path"]:
+                path = archive.day_path(day, self.archive_dir)
+                if not os.path.exists(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    download(entry["path"], path)
+            self._record_day(day, entry["rows"], path)
+            logger.info(f"{day}: copied {entry['rows']} archived rows.")
+
+    def _record_day(self, day, rows, path):
+        self.conn.execute("INSERT OR REPLACE INTO archived_days (day, rows, path, archived_at) VALUES (?, ?, ?, ?)",
+                          (day.isoformat(), rows, path, datetime.now().isoformat(timespec="seconds")))
+
+    def start_background(self, fetch, download, interval=MIRROR_SYNC_SECONDS):
+        """Sync every interval seconds in a daemon thread, started once per mirror.
+
+        The callables are replaced on every call, so the thread always uses the
+        connection of the latest RequestManager.
+
+        Args:
+            fetch (callable): See sync().
+            download (callable): See sync().
+            interval (float): Seconds between syncs, 0 disables the thread.
+        """
+        self.remote = (fetch, download)
+        if interval <= 0 or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._sync_forever, args=(interval,), name="mirror-sync", daemon=True)
+        self.thread.start()
+
+    def _sync_forever(self, interval):
+        while True:
+            fetch, download = self.remote
+            try:
+                self.sync(fetch, download)
+            except (RuntimeError, OSError, sqlite3.Error, paramiko.SSHException) as e:
+                logger.error(f"Background sync of {self.path} failed: {e}")
+            time.sleep(interval)
+
+    def status(self):
+        """Return the high-water mark and the size of the mirror.
+
+        Returns:
+            dict: source, synced_until (local time or None), snapshots, positions,
+            archived_days and bytes of the database file.
+        """
+        synced = self._state("synced_until")
+        return {
+            "source": self._state("source"),
+            "synced_until": None if synced is None else _format(synced),
+            "snapshots": self.conn.execute("SELECT COUNT(*) FROM snapshots").fetchone()[0],
+            "positions": self.conn.execute("SELECT COUNT(*) FROM positions").fetchone()[0],
+            "archived_days": self.conn.execute("SELECT COUNT(*) FROM archived_days").fetchone()[0],
+            "bytes": os.path.getsize(self.path),
+        }
+
+    def close(self):
+        """Close the connection of the mirror."""
+        self.conn.close()
+
+
+@st.cache_resource
+def _open_mirror(path, source, server_timezone):
+    return Mirror(path, source, server_timezone)
+
+
+def get_mirror(source, server_timezone):
+    """Return the Mirror of this process, None until `python mirror.py sync` created it.
+
+    Args:
+        source (str): Server and database the mirror copies.
+        server_timezone (str): Time zone of the collector.
+
+    Returns:
+        Mirror or None: The shared mirror.
+    """
+    if not MIRROR_DB or not os.path.exists(MIRROR_DB):
+        return None
+    return _open_mirror(MIRROR_DB, source, server_timezone)
+
+
+def main():
+    """Command line entry point for syncing the mirror and showing its status."""
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Local mirror of the vehicle positions database.")
+    parser.add_argument("command", choices=["sync", "status"])
+    parser.add_argument("--db", default=MIRROR_DB, help="Path to the mirror database.")
+    parser.add_argument("--since", type=date.fromisoformat,
+                        help=f"First day of the first sync (YYYY-MM-DD), default {MIRROR_DAYS} days ago.")
+    parser.add_argument("--host", default=os.getenv("SERVER_ADDRESS"), help="Server address.")
+    parser.add_argument("--user", default=os.getenv("SSH_USER"), help="SSH user.")
+    parser.add_argument("--key", default=os.getenv("KEY_PATH"), help="Path to the private key.")
+    parser.add_argument("--remote-db", default=query_client.DEFAULT_DB, help="Collector database on the server.")
+    parser.add_argument("--helper", default=os.getenv("REMOTE_QUERY_HELPER", query_client.DEFAULT_HELPER),
+                        help="Path of remote_query.py on the server.")
+    parser.add_argument("--service", default=os.getenv("QUERY_SERVICE"),
+                        help="Address of query_service.py as seen from the server, e.g. :8765.")
+    parser.add_argument("--timezone", default=os.getenv("SERVER_TIMEZONE", "Europe/Prague"),
+                        help="Time zone of the collector.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    if args.command == "status":
+        mirror = Mirror(args.db, server_timezone=args.timezone)
+        for name, value in mirror.status().items():
+            print(f"{name}: {value}")
+        mirror.close()
+        return
+
+    if not (args.host and args.user and args.key):
+        parser.error("--host, --user and --key (or SERVER_ADDRESS, SSH_USER and KEY_PATH) are required.")
+    mirror = Mirror(args.db, f"{args.host}:{args.remote_db}", args.timezone)
+    service = query_client.parse_address(args.service) if args.service else None
+    ssh = None
+    try:
+        ssh = SSHConnection(args.host, args.user, args.key)
+
+        def fetch(name, params):
+            return query_client.fetch_named(ssh, name, params, service, args.helper, args.remote_db)
+
+        rows = mirror.sync(fetch, ssh.download, args.since)
+        print(f"Mirrored {rows} positions, synced until {mirror.status()['synced_until']}.")
+    except (RuntimeError, OSError, sqlite3.Error, paramiko.SSHException) as e:
+        print(f"Sync failed: {e}")
+        raise SystemExit(1)
+    finally:
+        if ssh is not None:
+            ssh.close()
+        mirror.close()
+
+
+if __name__ == "__main__":
+    main()
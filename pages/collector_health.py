@@ -0,0 +1,126 @@
+import streamlit as st
+import pandas as pd
+import plotly.express as px
+from datetime import datetime
+from managers.request_manager import RequestManager
+import metrics
+
+
+missing_keys = any(
+    key not in st.session_state or st.session_state[key] is None
+    for key in ["SERVER_ADDRESS", "pem_key_path", "SSH_USER"]
+)
+
+# a snapshot every 30 s; after two missed ones the data has a visible hole
+STALE_AFTER_SECONDS = 90
+
+st.title("Collector Health")
+
+"""
+Collector Health page: ingestion metrics of the vehicle positions collector.
+
+Reads the metrics file that server.py rewrites after every snapshot and shows
+the age of the last snapshot, write lag, missed ticks, error counts, timings
+and the size of the database.
+"""
+
+st.markdown("""
+**Collector Health Overview**
+Spot ingestion lag and write stalls before they show up as holes in the charts.
+
+- **Last snapshot**: time since the last successfully written tick.
+- **Timings**: API latency, parse and insert time per snapshot.
+- **Errors**: failed requests, unparsable payloads and missed ticks.
+- **Storage**: size of the database and its write-ahead log.
+""", unsafe_allow_html=True)
+
+
+def _value(samples, name, default=0.0, **labels):
+    """Return the value of the first sample with this name and labels."""
+    for sample_name, sample_labels, value in samples:
+        if sample_name == name and all(sample_labels.get(k) == v for k, v in labels.items()):
+            return value
+    return default
+
+
+def _sum(samples, name):
+    """Sum a metric over all its label values."""
+    return sum(value for sample_name, _, value in samples if sample_name == name)
+
+
+def _mean(samples, name):
+    """Average of a histogram, None without observations."""
+    count = _value(samples, f"{name}_count")
+    return _value(samples, f"{name}_sum") / count if count else None
+
+
+def _buckets(samples, name):
+    """Per-bucket (not cumulative) counts of a histogram as a DataFrame."""
+    rows = [(labels["le"], value) for sample_name, labels, value in samples if sample_name == f"{name}_bucket"]
+    df = pd.DataFrame(rows, columns=["le", "cumulative"])
+    df["count"] = df["cumulative"].diff().fillna(df["cumulative"])
+    return df
+
+
+if st.button("Refresh"):
+    if missing_keys:
+        st.error("Please set the connection settings first.")
+        st.stop()
+    with st.spinner("Reading collector metrics..."):
+        text = RequestManager().fetch_metrics()
+    if not text:
+        st.error("No metrics available. Is the collector running with METRICS_TEXTFILE set?")
+        st.stop()
+    st.session_state["collector_metrics"] = (datetime.now(), metrics.parse_text(text))
+
+if "collector_metrics" in st.session_state:
+    read_at, samples = st.session_state["collector_metrics"]
+    last_tick = _value(samples, "gtfs_last_success_tick_timestamp_seconds", None)
+    st.caption(f"Metrics read at {read_at:%Y-%m-%d %H:%M:%S}")
+
+    if last_tick is None:
+        st.warning("The collector has not written a snapshot since it started.")
+    else:
+        age = read_at.timestamp() - last_tick
+        if age > STALE_AFTER_SECONDS:
+            st.error(f"Last snapshot is {age:.0f} s old ({datetime.fromtimestamp(last_tick):%H:%M:%S}). Ingestion is stalled.")
+        else:
+            st.success(f"Last snapshot {age:.0f} s ago ({datetime.fromtimestamp(last_tick):%H:%M:%S}).")
+
+    c1, c2, c3, c4 = st.columns(4)
+    c1.metric("Write lag (s)", f"{_value(samples, 'gtfs_write_lag_seconds'):.1f}")
+    c2.metric("Rows last snapshot", f"{_value(samples, 'gtfs_snapshot_rows', kind='received'):.0f}",
+              help="Rows received; stored rows differ in delta mode.")
+    c3.metric("Missed ticks", f"{_sum(samples, 'gtfs_ticks_missed_total'):.0f}")
+    c4.metric("Errors", f"{_sum(samples, 'gtfs_api_errors_total') + _sum(samples, 'gtfs_write_errors_total'):.0f}")
+
+    st.subheader("Timings per snapshot")
+    timings = pd.DataFrame([
+        ("API request", _mean(samples, "gtfs_api_request_seconds")),
+        ("Parse", _mean(samples, "gtfs_parse_seconds")),
+        ("Insert", _mean(samples, "gtfs_insert_seconds")),
+    ], columns=["Stage", "Average (s)"])
+    st.dataframe(timings, use_container_width=True)
+
+    latency = _buckets(samples, "gtfs_api_request_seconds")
+    if not latency.empty:
+        fig = px.bar(latency, x="le", y="count", labels={"le": "≤ seconds", "count": "Requests"},
+                     title="API latency distribution")
+        st.plotly_chart(fig, use_container_width=True)
+
+    st.subheader("Errors and missed ticks")
+    errors = pd.DataFrame(
+        [(f"{name} {labels}", value) for name, labels, value in samples
+         if name in ("gtfs_api_errors_total", "gtfs_ticks_missed_total", "gtfs_write_errors_total")],
+        columns=["Metric", "Count"])
+    if errors.empty:
+        st.info("No errors since the collector started.")
+    else:
+        st.dataframe(errors, use_container_width=True)
+
+    st.subheader("Storage")
+    s1, s2, s3 = st.columns(3)
+    s1.metric("Database (MB)", f"{_value(samples, 'gtfs_db_size_bytes', file='db') / 1e6:.1f}")
+    s2.metric("WAL (MB)", f"{_value(samples, 'gtfs_db_size_bytes', file='wal') / 1e6:.1f}")
+    payload = _mean(samples, "gtfs_payload_bytes")
+    s3.metric("Avg payload (kB)", f"{payload / 1e3:.0f}" if payload else "-")
@@ -4,8 +4,8 @@ import matplotlib.pyplot as plt
 import plotly.express as px
 from managers.request_manager import RequestManager
 from managers.trip_manager import TripManager
-from managers.shape_manager import ShapeManager
 from shapely import wkt
+import queries
 
 from datetime import datetime, time
 
@@ -78,38 +78,10 @@ tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs([
     "Export Data"
 ])
 
-def make_query(start_date, end_date, min_delay, bbox, start_datetime, end_datetime):
-    """Build a SQL query to fetch average delays per trip with filters.
-
-    Args:
-        start_date (date): Start of the date range for filtering.
-        end_date (date): End of the date range for filtering.
-        min_delay (int): Minimum delay threshold in seconds.
-        bbox (tuple): Geographic bounding box as (minx, miny, maxx, maxy).
-
-    Returns:
-        str: The formatted SQL query string excluding trains.
-    """
-    minx, miny, maxx, maxy = bbox
-    
-    
-
-    query = (
-    "SELECT gtfs_trip_id, vehicle_id, route_type, gtfs_route_short_name, "
-    "AVG(delay) AS delay, MIN(timestamp) AS first_timestamp "
-    "FROM vehicle_positions "
-    "WHERE delay IS NOT NULL "
-    "AND route_type <> 2 "
-    f"AND timestamp BETWEEN '{start_datetime}' AND '{end_datetime}' "
-    f"AND longitude BETWEEN {minx} AND {maxx} "
-    f"AND latitude BETWEEN {miny} AND {maxy} "
-    f"AND delay BETWEEN {min_delay} AND 7200 "
-    "GROUP BY gtfs_trip_id"
-)
-    return query
-
-# Initialize df as empty DataFrame
-df = pd.DataFrame()
+# aggregates of the applied filters, computed on the server (see RequestManager.delay_summary)
+summary = None
+# columns of the named query trip_delays (see queries.py)
+TRIP_COLUMNS = ["gtfs_trip_id", "vehicle_id", "route_type", "gtfs_route_short_name", "delay", "first_timestamp", "n"]
 
 # Tab 1: Delay Distribution
 with tab1:
@@ -138,63 +110,51 @@ with tab1:
             st.error("Start date cannot be in the future.")
         else:
             with st.spinner("Load Data from Server..."):
-                minx, miny, maxx, maxy = ShapeManager().set_bounding_box()
                 st.success(f"Filters applied: Date Range: {start_date} to {end_date}")
-                query = make_query(start_date, end_date, min_delay, (minx, miny, maxx, maxy), 
-                                  datetime.combine(start_date, time.min), 
-                                  datetime.combine(end_date, time.max))
-                
-                #st.write("Executing query:")
-                #st.code(query)
-                columns = ["gtfs_trip_id", "vehicle_id", "route_type", "gtfs_route_short_name", "delay", "first_timestamp"]
-                rm = RequestManager()
-                df = rm.server_request(query, columns=columns)
-                df = df[df['gtfs_route_short_name'].apply(_is_valid_short)]
-
-                if df is None:
+                start_datetime = datetime.combine(start_date, time.min)
+                end_datetime = datetime.combine(end_date, time.max)
+                # the rollups when min_delay is a band edge, the raw positions (and the archive) otherwise;
+                # the widgets only receive their aggregates, not the trips
+                summary = RequestManager().delay_summary(start_datetime, end_datetime, min_delay)
+
+                if summary is None:
                     st.error("Server request returned None!")
-                elif df.empty:
+                elif summary["stats"].empty:
                     st.warning("No data available for the selected filter.")
                 else:
-                    # Filter by vehicle type if needed
-
-                    # Save filtered df to session state
-                    st.session_state["df"] = df.copy()
-
-                    if not df.empty:
-                        mean_delay_trip = df.groupby('gtfs_trip_id')['delay'].mean().reset_index()
-                        unique_mean_delay = mean_delay_trip['delay'].nunique()
-                        st.success(f"{unique_mean_delay} Trips have a delay over {min_delay} seconds.")
-                        bins = [60, 180, 300, 600, 1800, 3600, float('inf')]  #
-                        bin_labels = ['1-3 min', '3-5 min', '5-10 min', '10-30 min', '30-60 min', '> 60 min']
-                        labels=bin_labels
-                        fig, ax = plt.subplots()
-                        df['delay_binned'] = pd.cut(df['delay'], bins=bins, labels=bin_labels, right=False)  # 'right=False' für offene Intervalle rechts
-                        delay_counts = df['delay_binned'].value_counts().sort_index()
-
-                        ax.bar(delay_counts.index, delay_counts.values, edgecolor='black', color='skyblue')
-
-                        #ax.hist(df['delay'], bins=bins, edgecolor='black', color='skyblue')
-                        ax.set_title("Distribution of Delays")
-                        ax.set_xlabel("Delay (seconds)")
-                        ax.set_ylabel("Number of observations")
-                        st.pyplot(fig)
-                    else:
-                        st.success(f"No delay data for the selected vehicle type over {min_delay} seconds.")
+                    # Save the aggregates to session state
+                    st.session_state["delay_summary"] = summary
+                    st.session_state["delay_filters"] = (min_delay, start_datetime, end_datetime)
+                    # trips of earlier filters, loaded for the export
+                    st.session_state.pop("df", None)
+
+                    trips = int(summary["stats"]["trips"].sum())
+                    st.success(f"{trips} Trips have a delay over {min_delay} seconds.")
+                    bin_labels = ['1-3 min', '3-5 min', '5-10 min', '10-30 min', '30-60 min', '> 60 min']
+                    fig, ax = plt.subplots()
+                    # trips per bin of queries.DELAY_BINS, also the empty bins
+                    delay_counts = summary["histogram"].set_index("bin")["trips"].reindex(queries.DELAY_BINS, fill_value=0)
+
+                    ax.bar(bin_labels, delay_counts.values, edgecolor='black', color='skyblue')
+
+                    ax.set_title("Distribution of Delays")
+                    ax.set_xlabel("Delay (seconds)")
+                    ax.set_ylabel("Number of observations")
+                    st.pyplot(fig)
 
             st.subheader("Delay Statistics")
             st.write("Mean and maximum delay grouped by vehicle type.")
-            if df is not None and not df.empty:
-                stats = df.groupby('route_type')['delay'].agg(['count', 'mean', 'max']).round(1)
+            if summary is not None and not summary["stats"].empty:
+                stats = summary["stats"].set_index("route_type")[["trips", "mean_delay", "max_delay"]].round(1)
                 stats.columns = ['Count', 'Mean Delay', 'Max Delay']
                 st.dataframe(stats)
             else:
                 st.info("No statistics available for the current selection.")
 
-    # Use df from session state
-    if "df" in st.session_state and not st.session_state["df"].empty:
-        df_session = st.session_state["df"]
-        vehicle_types = sorted(df_session['route_type'].dropna().unique())
+    # Use the statistics from session state
+    if "delay_summary" in st.session_state:
+        stats_session = st.session_state["delay_summary"]["stats"]
+        vehicle_types = sorted(stats_session['route_type'].dropna().unique())
 
         with st.form("vehicle_type_form"):
             selected_types = st.multiselect(
@@ -203,8 +163,8 @@ with tab1:
                 default=vehicle_types
             )
 
-            ts_min = pd.to_datetime(df_session['first_timestamp'].min())
-            ts_max = pd.to_datetime(df_session['first_timestamp'].max())
+            ts_min = pd.to_datetime(stats_session['first_timestamp'].min())
+            ts_max = pd.to_datetime(stats_session['last_timestamp'].max())
             duration = ts_max - ts_min
 
             interval_options = []
@@ -223,47 +183,53 @@ with tab1:
                     st.error("Please upload a PEM key first.")
                 else:
                     if selected_types:
-                        filtered_df = df_session[df_session['route_type'].isin(selected_types)].copy()
-                        if not filtered_df.empty:
-                            filtered_df['first_timestamp'] = pd.to_datetime(filtered_df['first_timestamp'])
-
-                            if selected_interval == "5min":
-                                filtered_df['time_bin'] = filtered_df['first_timestamp'].dt.floor("5min")
-                            elif selected_interval == "hourly":
-                                filtered_df['time_bin'] = filtered_df['first_timestamp'].dt.floor("h")
-                            elif selected_interval == "daily":
-                                filtered_df['time_bin'] = filtered_df['first_timestamp'].dt.floor("D")
-
-                            show_overall_avg = st.checkbox("Show average over all selected vehicle types", value=True)
-
-                            delay_by_type = (
-                                filtered_df.groupby(['time_bin', 'route_type'])['delay'].mean().reset_index()
-                            )
-
-                            fig = px.line(
-                                delay_by_type,
-                                x='time_bin',
-                                y='delay',
-                                color='route_type',
-                                title=f'Average Delay ({selected_interval}) by Vehicle Type',
-                                labels={'time_bin': 'Time', 'delay': 'Average Delay (seconds)', 'route_type': 'Vehicle Type'}
-                            )
-
-                            if show_overall_avg:
-                                delay_overall = (
-                                    filtered_df.groupby('time_bin')['delay'].mean().reset_index()
+                        interval_keys = {"5min": "5min", "hourly": "hour", "daily": "day"}
+                        chart_min_delay, chart_start, chart_end = st.session_state.get("delay_filters", (None, None, None))
+                        # every trip counts once, with its mean delay in the bucket of its first position;
+                        # read from the rollups if the threshold is a delay band edge (see queries._from_trips)
+                        name, params = queries.trip_delay_buckets(interval_keys[selected_interval], chart_min_delay,
+                                                                  chart_start, chart_end)
+                        buckets = RequestManager().named_request(name, params,
+                                                                 columns=["time_bin", "route_type", "total", "n"])
+                        if buckets is None:
+                            st.error("Server request returned None!")
+                        else:
+                            buckets = buckets[buckets['route_type'].isin(selected_types)].copy()
+                            buckets['time_bin'] = pd.to_datetime(buckets['time_bin'])
+                            buckets['delay'] = buckets['total'] / buckets['n']
+                            if not buckets.empty:
+                                show_overall_avg = st.checkbox("Show average over all selected vehicle types", value=True)
+
+                                delay_by_type = (
+                                    buckets.groupby(['time_bin', 'route_type'])[['total', 'n']].sum().reset_index()
                                 )
-                                fig.add_scatter(
-                                    x=delay_overall['time_bin'],
-                                    y=delay_overall['delay'],
-                                    mode='lines',
-                                    line=dict(color='black', width=3, dash='dash'),
-                                    name='Overall Average'
+                                delay_by_type['delay'] = delay_by_type['total'] / delay_by_type['n']
+
+                                fig = px.line(
+                                    delay_by_type,
+                                    x='time_bin',
+                                    y='delay',
+                                    color='route_type',
+                                    title=f'Average Trip Delay ({selected_interval}) by Vehicle Type and Trip Start',
+                                    labels={'time_bin': 'Time', 'delay': 'Average Delay (seconds)', 'route_type': 'Vehicle Type'}
                                 )
 
-                            st.plotly_chart(fig, use_container_width=True)
-                        else:
-                            st.warning("No data available for the selected vehicle types.")
+                                if show_overall_avg:
+                                    delay_overall = (
+                                        buckets.groupby('time_bin')[['total', 'n']].sum().reset_index()
+                                    )
+                                    delay_overall['delay'] = delay_overall['total'] / delay_overall['n']
+                                    fig.add_scatter(
+                                        x=delay_overall['time_bin'],
+                                        y=delay_overall['delay'],
+                                        mode='lines',
+                                        line=dict(color='black', width=3, dash='dash'),
+                                        name='Overall Average'
+                                    )
+
+                                st.plotly_chart(fig, use_container_width=True)
+                            else:
+                                st.warning("No data available for the selected vehicle types.")
                     else:
                         st.warning("Please select at least one vehicle type.")
 
@@ -272,14 +238,9 @@ with tab2:
     st.subheader("Delay Statistics")
     st.write("Delayed Lines per vehicle type.")
 
-    if "df" in st.session_state and not st.session_state["df"].empty:
-        df = st.session_state["df"]
-        trip_stats = df.groupby(['gtfs_trip_id', 'route_type'])['delay'].agg(['count', 'mean', 'max']).reset_index()
-        stats = trip_stats.groupby('route_type')[['count', 'mean', 'max']].agg({
-            'count': 'sum',
-            'mean': 'mean',
-            'max': 'max'
-        }).round(1)
+    if "delay_summary" in st.session_state:
+        stats = st.session_state["delay_summary"]["stats"].set_index("route_type")
+        stats = stats[["trips", "mean_delay", "max_delay"]].round(1)
 
         stats.columns = ['Total Observations', 'Avg of Mean Delays', 'Max of Max Delays']
         st.dataframe(stats)
@@ -290,11 +251,10 @@ with tab2:
 with tab3:
     st.subheader("Top 10 Delays")
 
-    if "df" not in st.session_state or st.session_state["df"].empty:
+    if "delay_summary" not in st.session_state:
         st.info("No data available to display top delays. Please apply filters in the delay distribution tab first.") 
     else:
-        df = st.session_state["df"]
-        top_delays = df.groupby('gtfs_trip_id')['delay'].max().reset_index().sort_values(by='delay', ascending=False).head(10)
+        top_delays = st.session_state["delay_summary"]["top"].copy()
         top_delay_list = top_delays['gtfs_trip_id'].tolist()
         extra_cols = TripManager().get_infos_by_trip_id(top_delay_list)
         extra_cols = extra_cols.rename(columns={'trip_id': 'gtfs_trip_id'})
@@ -315,15 +275,13 @@ with tab4:
     st.subheader("Delay Distribution by Vehicle Type")
     st.write("This page shows the distribution of delays by vehicle type in a pie chart.")
 
-    if "df" in st.session_state and not st.session_state["df"].empty:
-        df = st.session_state["df"]
-        count_by_type = df.groupby("route_type")["vehicle_id"].nunique()
-        delay_by_type = df.groupby('route_type')['delay'].sum().sort_values(ascending=False)
+    if "delay_summary" in st.session_state:
+        by_type = st.session_state["delay_summary"]["stats"].sort_values("total_delay", ascending=False)
 
         pie_df = pd.DataFrame({
-            "route_type": delay_by_type.index,
-            "total_delay": delay_by_type.values,
-            "unique_vehicles": count_by_type.reindex(delay_by_type.index).values
+            "route_type": by_type["route_type"].values,
+            "total_delay": by_type["total_delay"].values,
+            "unique_vehicles": by_type["vehicles"].values
         })
 
         fig = px.pie(
@@ -349,6 +307,17 @@ with tab5:
 with tab6:
     st.subheader("Export Data")
     st.write("This page allows you to export the filtered data to a CSV file.")
+    if "delay_filters" in st.session_state:
+        # the trips are only transferred when they are exported
+        if st.button("Load trips"):
+            export_min_delay, export_start, export_end = st.session_state["delay_filters"]
+            with st.spinner("Load Data from Server..."):
+                name, params = queries.trip_delays(export_start, export_end, export_min_delay)
+                df = RequestManager().named_request(name, params, columns=TRIP_COLUMNS)
+            if df is None:
+                st.error("Server request returned None!")
+            else:
+                st.session_state["df"] = df[df['gtfs_route_short_name'].apply(_is_valid_short)]
     if "df" in st.session_state and not st.session_state["df"].empty:
         st.download_button(
             label="Download CSV",
@@ -9,14 +9,38 @@ import plotly.express as px
 from managers.request_manager import RequestManager
 from managers.stop_manager import StopManager
 from managers.shape_manager import ShapeManager
-from managers.trip_manager import TripManager
 from dotenv import load_dotenv
 import os
+import queries
 
 load_dotenv()
 api_url = os.getenv("API_URL")
 db_path = "database.db"
 headers = {"X-Access-Token": os.getenv("API_KEY")}
+# columns of the named queries stop_visits and stop_throughput (see queries.py)
+VISIT_COLUMNS = ["vehicle_id", "route_type", "Line", "parent_station", "arrival", "departure", "dwell_seconds"]
+THROUGHPUT_COLUMNS = ["parent_station", "Line", "hour", "events"]
+
+
+def progress_callback(bar, label):
+    """Return a RequestManager progress callback that updates a Streamlit progress bar.
+
+    Args:
+        bar: The element returned by st.progress.
+        label (str): What is being loaded, shown before the counts.
+
+    Returns:
+        callable: progress(fraction, rows, bytes).
+    """
+    last = [0.0]
+
+    def report(fraction, rows, nbytes):
+        if fraction is not None:
+            last[0] = fraction
+        bar.progress(last[0], text=f"{label}: {rows:,} rows, {nbytes / 1e6:.1f} MB received")
+
+    return report
+
 
 st.title("Stops Analytics")
 
@@ -109,25 +133,6 @@ with overview_tab:
         return df
 
 
-    def haversine(lat1, lon1, lat2, lon2):
-        """Calculate great-circle distance between two points on Earth.
-
-        Args:
-            lat1, lon1, lat2, lon2 (float or array-like): Coordinates in decimal degrees.
-
-        Returns:
-            float or array-like: Distance in kilometers.
-        """
-        R = 6371  # radius in km
-        phi1, phi2 = np.radians(lat1), np.radians(lat2)
-        dphi = phi2 - phi1
-        dlambda = np.radians(lon2 - lon1)
-
-        a = np.sin(dphi/2)**2 + np.cos(phi1)*np.cos(phi2)*np.sin(dlambda/2)**2
-        c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
-
-        return R * c
-
     def is_valid_line(line: str) -> bool:
         if not isinstance(line, str):
             return False
@@ -152,22 +157,39 @@ with overview_tab:
         n = int(line)
         return (1 <= n <= 99) or (100 <= n <= 250) or (901 <= n <= 917)
 
-    def assign_nearest_parent(df: pd.DataFrame, stops_df: pd.DataFrame) -> list[str]:
-        if df.empty:
-            return []
-        lat0 = df["lat"].to_numpy()
-        lon0 = df["lon"].to_numpy()
-        p_lat = stops_df["avg_lat"].to_numpy()
-        p_lon = stops_df["avg_lon"].to_numpy()
-        p_names = stops_df["stop_name"].to_numpy()
-
-        assigned = []
-        for y, x in zip(lat0, lon0):
-            dlat = p_lat - y
-            dlon = p_lon - x
-            idx = np.argmin(dlat * dlat + dlon * dlon)
-            assigned.append(p_names[idx])
-        return assigned
+    @st.cache_data
+    def load_station_names():
+        """Map station ids to stop names.
+
+        A station is the parent_station of a platform, or the platform itself
+        if it has none, the same way the collector stores it (see stop_index.py).
+
+        Returns:
+            dict: Station id -> stop name.
+        """
+        conn = sqlite3.connect("database.db", check_same_thread=False)
+        query = """
+        SELECT COALESCE(NULLIF(parent_station, ''), stop_id) AS station, stop_name
+        FROM stops
+        WHERE stop_name IS NOT NULL
+        """
+        df = pd.read_sql_query(query, conn)
+        conn.close()
+        return dict(zip(df["station"], df["stop_name"]))
+
+    def stop_labels(df: pd.DataFrame, stops_df: pd.DataFrame) -> pd.Series:
+        """Name the stop of each visit from its station.
+
+        Stations that are not among the stops of stops_df get no name.
+
+        Returns:
+            pandas.Series: Stop name per row, aligned with df.
+        """
+        names = {station: name for station, name in load_station_names().items()
+                 if name in set(stops_df["stop_name"])}
+        return df["parent_station"].map(names)
+
+
     # --- Initial data display ---
     parents_df = load_parent_stations()
     if parents_df is None or parents_df.empty:
@@ -295,71 +317,37 @@ with dwell_tab:
         else:
             sd = f"{start_date} 00:00:00"
             ed = f"{end_date} 23:59:59"
-            q = (
-                "SELECT vehicle_id, gtfs_trip_id, route_type, latitude, longitude, timestamp "
-                "FROM vehicle_positions "
-                "WHERE state_position='at_stop' "
-                f"AND timestamp BETWEEN '{sd}' AND '{ed}' "
-                "ORDER BY vehicle_id, timestamp"
-            )
-            with st.spinner("This might take a while"):
-                try:
-                    rm = RequestManager()
-                    cols = ["vehicle_id", "gtfs_trip_id", "route_type", "lat", "lon", "ts"]
-                    df = rm.server_request(q, columns=cols)
-                except Exception as exc:
-                    st.error(f"Unable to retrieve dwell‑time data: {exc}")
-                    df = pd.DataFrame()
-
-            if df.empty:
-                st.info("No data returned for the selected period.")
-            else:
-                df = df[df["route_type"] != "metro"]
-
-                df["ts"] = pd.to_datetime(df["ts"])
-                df[["lat", "lon"]] = df[["lat", "lon"]].astype(float)
-
-                df["prev_lat"] = df.groupby("vehicle_id")["lat"].shift()
-                df["prev_lon"] = df.groupby("vehicle_id")["lon"].shift()
-                df["prev_ts"] = df.groupby("vehicle_id")["ts"].shift()
-
-                d = haversine(df["lat"], df["lon"], df["prev_lat"], df["prev_lon"])
-                dt = (df["ts"] - df["prev_ts"]).dt.total_seconds()
-
-                df["break"] = (
-                    (df["vehicle_id"] != df["vehicle_id"].shift()) |
-                    (d > 0.15) |                    # > 150 m
-                    (dt > 300)                      # > 5 min
-                )
-                df["group_id"] = df["break"].cumsum()
-
-                agg = (
-                    df.groupby("group_id")
-                    .agg(
-                        vehicle_id=("vehicle_id", "first"),
-                        gtfs_trip_id=("gtfs_trip_id", "first"),
-                        lat=("lat", "first"),
-                        lon=("lon", "first"),
-                        arrival=("ts", "first"),
-                        departure=("ts", "last")
-                    )
-                    .reset_index(drop=True)
-                )
-                agg["dwell_seconds"] = (agg["departure"] - agg["arrival"]).dt.total_seconds()
-                agg = agg[agg["dwell_seconds"] >= min_dwell]
-
-                if agg.empty:
+            bar = st.progress(0.0, text="Loading dwell events…")
+            events = []
+            # dwell seconds summed and counted per stop while the chunks arrive
+            per_stop = None
+            try:
+                rm = RequestManager()
+                # visits the collector materialized, filtered by dwell time on the server
+                name, params = queries.stop_visits(sd, ed, min_dwell)
+                for chunk in rm.stream_named(name, params, columns=VISIT_COLUMNS,
+                                             progress=progress_callback(bar, "Loading dwell events")):
+                    chunk = chunk[chunk["route_type"] != "metro"]
+                    chunk = chunk.assign(Stop=stop_labels(chunk, stops_grouped_df), Line=chunk["Line"].astype(str))
+                    chunk = chunk[chunk["Stop"].notna() & chunk["Line"].apply(is_valid_line)]
+                    if chunk.empty:
+                        continue
+                    events.append(chunk[["Stop", "Line", "vehicle_id", "arrival", "departure", "dwell_seconds"]])
+                    sums = chunk.groupby("Stop")["dwell_seconds"].agg(["sum", "count"])
+                    per_stop = sums if per_stop is None else per_stop.add(sums, fill_value=0)
+            except Exception as exc:
+                st.error(f"Unable to retrieve dwell‑time data: {exc}")
+                events = None
+            bar.empty()
+
+            if events is not None:
+                if not events:
                     st.info("No dwell events ≥ threshold")
                 else:
                     try:
-                        agg["Stop"] = assign_nearest_parent(agg.rename(
-                            columns={"lat": "lat", "lon": "lon"}), stops_grouped_df)
-
-                        routes = TripManager().get_infos_by_trip_id(agg["gtfs_trip_id"].tolist())
-                        routes = routes.rename(columns={"trip_id": "gtfs_trip_id", "route_short_name": "Line"})
-                        out = agg.merge(routes, on="gtfs_trip_id", how="left")
-                        out = out[out["Line"].apply(is_valid_line)]
-                        out = out[["Stop", "Line", "vehicle_id", "arrival", "departure", "dwell_seconds"]]
+                        out = pd.concat(events, ignore_index=True)
+                        out["arrival"] = pd.to_datetime(out["arrival"])
+                        out["departure"] = pd.to_datetime(out["departure"])
                         out.columns = ["Stop", "Line", "Vehicle", "Arrival", "Departure", "Dwell (s)"]
 
                         st.subheader("Single Dwell Time Events")
@@ -367,7 +355,7 @@ with dwell_tab:
                         st.dataframe(out, use_container_width=True)
 
                         # Cumulative Dwell Time per Stop
-                        cum = out.groupby("Stop")["Dwell (s)"].sum().reset_index()
+                        cum = per_stop["sum"].rename("Dwell (s)").reset_index()
                         cum["Dwell (min)"] = cum["Dwell (s)"] / 60
                         cum = cum.sort_values("Dwell (min)", ascending=False)
 
@@ -383,10 +371,10 @@ with dwell_tab:
                         st.caption("Total dwell minutes accumulated at each stop during the selected period.")
 
                         # Average dwell time and event count per stop
-                        stats = out.groupby("Stop").agg(
-                            avg_dwell_min=("Dwell (s)", lambda x: x.mean() / 60),
-                            event_count=("Dwell (s)", "count")
-                        ).reset_index()
+                        stats = pd.DataFrame({
+                            "avg_dwell_min": per_stop["sum"] / per_stop["count"] / 60,
+                            "event_count": per_stop["count"].astype(int),
+                        }).reset_index()
                         stats = stats.sort_values("avg_dwell_min", ascending=False)
                         st.subheader("Average Dwell Time vs. Event Count")
                         fig2 = px.scatter(
@@ -423,74 +411,39 @@ with peak_tab:
         else:
             start_dt = f"{ph_start} 00:00:00"
             end_dt   = f"{ph_end} 23:59:59"
-            sql = (
-                "SELECT vehicle_id, gtfs_trip_id, route_type, "
-                "       latitude, longitude, timestamp "
-                "FROM   vehicle_positions "
-                f"WHERE  timestamp BETWEEN '{start_dt}' AND '{end_dt}' "
-                "ORDER  BY vehicle_id, timestamp"
-            )
-            with st.spinner("This might take a while"):
-                try:
-                    rm = RequestManager()
-                    cols = ["vehicle_id", "gtfs_trip_id", "route_type",
-                            "lat", "lon", "ts"]
-                    peak_df = rm.server_request(sql, columns=cols)
-                except Exception as exc:
-                    st.error(f"Request error: {exc}")
-                    peak_df = pd.DataFrame()
-
-            if "state_position" in peak_df.columns:
-                peak_df = peak_df[peak_df["state_position"] != "before_stop"]
-            peak_df = peak_df.drop(columns=["state_position"], errors="ignore")
-
-            if peak_df.empty:
+            bar = st.progress(0.0, text="Loading stop events…")
+            received = 0
+            # events per stop, line and hour, summed while the chunks arrive
+            groups = None
+            try:
+                rm = RequestManager()
+                # visits per station, line and hour, counted on the server
+                name, params = queries.stop_throughput(start_dt, end_dt)
+                for chunk in rm.stream_named(name, params, columns=THROUGHPUT_COLUMNS,
+                                             progress=progress_callback(bar, "Loading stop events")):
+                    received += len(chunk)
+                    chunk = chunk.assign(Stop=stop_labels(chunk, stops_grouped_df), Line=chunk["Line"].astype(str))
+                    chunk = chunk[chunk["Stop"].notna() & chunk["Line"].apply(is_valid_line)]
+                    # the days of the range arrive separately, so a group can repeat
+                    sums = chunk.groupby(["Stop", "Line", "hour"])["events"].sum()
+                    groups = sums if groups is None else groups.add(sums, fill_value=0)
+            except Exception as exc:
+                st.error(f"Request error: {exc}")
+                received = 0
+            bar.empty()
+
+            if not received:
                 st.info("No data for the selected range.")
             else:
-                peak_df = peak_df[peak_df["route_type"] != "metro"]
-                peak_df["Stop"] = assign_nearest_parent(
-                    peak_df.rename(columns={"lat": "lat", "lon": "lon"}),
-                    stops_grouped_df
-                )
-                trip_info = TripManager().get_infos_by_trip_id(
-                    peak_df["gtfs_trip_id"].unique().tolist()
-                )
-                trip_info = trip_info.rename(
-                    columns={"trip_id": "gtfs_trip_id", "route_short_name": "Line"}
-                )
-                peak_df = peak_df.merge(trip_info, on="gtfs_trip_id", how="left")
-                peak_df = peak_df[peak_df["Line"].apply(is_valid_line)]
-
-                peak_df = peak_df.sort_values(["vehicle_id", "ts"])
-                peak_df["prev_stop"] = peak_df.groupby("vehicle_id")["Stop"].shift()
-                peak_df["prev_ts"]   = peak_df.groupby("vehicle_id")["ts"].shift()
-                peak_df["break"] = (
-                    (peak_df["Stop"] != peak_df["prev_stop"]) |
-                    (peak_df["vehicle_id"] != peak_df["vehicle_id"].shift()) |
-                    ((pd.to_datetime(peak_df["ts"]) - pd.to_datetime(peak_df["prev_ts"])
-                     ).dt.total_seconds() > 300)
-                )
-                peak_df["group_id"] = peak_df["break"].cumsum()
-
-                groups = (
-                    peak_df.groupby("group_id")
-                    .agg(
-                        vehicle_id=("vehicle_id", "first"),
-                        Stop=("Stop", "first"),
-                        arrival=("ts", "first")
-                    )
-                    .reset_index(drop=True)
-                )
-                groups["hour"] = pd.to_datetime(groups["arrival"]).dt.hour
-
-                if peak_df.empty or groups.empty:
+                if groups is not None:
+                    groups = groups.astype(int).reset_index()
+                if groups is None or groups.empty:
                     st.info("No Prague in‑service stop events after filtering.")
                 else:
                     total_hours = ((ph_end - ph_start).days + 1) * 24
                     counts = (
-                        groups.groupby("Stop")
-                        .size()
-                        .rename("events")
+                        groups.groupby("Stop")["events"]
+                        .sum()
                         .reset_index()
                     )
                     counts["avg_per_hour"] = counts["events"] / total_hours
@@ -0,0 +1,590 @@
+"""
+queries.py
+
+Named, parameterized queries of the Streamlit pages.
+
+Every query is a fixed SQL text with named parameters (:start, :end, ...),
+so the query service (query_service.py) and remote_query.py can run it with
+bound values, SQLite prepares it once per connection, and nothing the user
+enters is interpolated into SQL. Times are local 'YYYY-MM-DD HH:MM:SS'
+strings, converted to epoch seconds by SQLite like before.
+
+QUERIES maps the name of a query to (sql, parameter names, reads_positions,
+merge). Queries that read positions get the archived days of their
+:start/:end range (see remote_query.shadow_archived); the others only read
+tables that are never archived. Every query can run day by day (see
+split()); merge tells merge_days() how the results of the single days
+combine into the result of the whole range:
+    None                  the days have disjoint rows, which are concatenated
+    (keys, aggregates)    rows with the same keys are combined per column with
+                          "sum", "min", "max", "first", ("mean", weight
+                          column), a mean weighted by the row count of each
+                          day, "union", the distinct elements of JSON arrays,
+                          or ("count", union column), the number of elements
+                          of a merged "union" column
+    (TOP, sort keys, parameter)
+                          every day returns its highest rows; the rows of all
+                          days are sorted again and the first :parameter kept
+
+The aggregates of the dashboard (delay_histogram, delay_stats, top_delays,
+trip_delay_buckets, each also as *_rollup) run over the per-trip rows of
+trip_delays on the server, so the pages only receive a few rows per widget.
+They count a trip once per service day: the raw variants run per service day
+(from SERVICE_DAY_START to the same time of the next day, see
+SERVICE_DAY_QUERIES), so a trip running over midnight stays in one part and
+the parts merge exactly; the *_rollup variants run per local day like the
+daily rollups they read.
+
+The queries named mirror_* transfer the tables of the collector database to
+the local mirror (see mirror.py). They take epoch bounds instead of a local
+time range and are never split into days.
+
+The pages build their queries with the functions at the end of this module,
+which return (name, params) with normalized parameter values: times as
+local 'YYYY-MM-DD HH:MM:SS' strings, thresholds as int. The same request
+therefore always yields the same SQL text and parameters, so connections
+reuse the prepared statement (sqlite3 caches statements by their SQL text)
+and results can be cached under cache_key().
+"""
+
+import hashlib
+import json
+from datetime import date, datetime, time, timedelta
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import rollups
+import schema
+import visits
+import zones
+
+# per-trip rows of several days: the delay is the mean over all positions of the trip
+_TRIP_MERGE = (["gtfs_trip_id"], {"vehicle_id": "first", "route_type": "first", "gtfs_route_short_name": "first",
+                                  "delay": ("mean", "n"), "first_timestamp": "min", "n": "sum"})
+# merge of queries that return the highest rows of every day (see merge_days())
+TOP = "top"
+# local time at which the trip aggregates start a new service day: the hour with the
+# fewest trips running, so hardly any trip has positions on both sides of it
+SERVICE_DAY_START = time(4, 0)
+# local time parameter -> epoch seconds
+_START = "CAST(strftime('%s', :start, 'utc') AS INTEGER)"
+_END = "CAST(strftime('%s', :end, 'utc') AS INTEGER)"
+
+# average delay per trip from the raw positions (any threshold)
+_TRIPS = f"""
+        SELECT gtfs_trip_id, vehicle_id, route_type, gtfs_route_short_name,
+               AVG(delay) AS delay, datetime(MIN(ts), 'unixepoch', 'localtime') AS first_timestamp,
+               COUNT(*) AS n
+        FROM vehicle_positions_full
+        WHERE delay IS NOT NULL
+          AND route_type <> 2
+          AND ts BETWEEN {_START} AND {_END}
+          AND zone = {zones.ZONE_P}
+          AND delay BETWEEN :min_delay AND {rollups.MAX_DELAY}
+        GROUP BY gtfs_trip_id"""
+# the conditions of _TRIPS on single positions, which the archive scan applies before
+# the rows reach SQLite (see remote_query.shadow_archived); ":name" values are parameters
+_TRIPS_SCAN = [("zone", "=", zones.ZONE_P), ("route_type", "<>", 2),
+               ("delay", ">=", ":min_delay"), ("delay", "<=", rollups.MAX_DELAY)]
+# the same from the daily rollups, for thresholds that are a delay band edge
+_TRIPS_ROLLUP = f"""
+        SELECT t.gtfs_trip_id, v.vehicle_id, rt.route_type, rn.route_short_name AS gtfs_route_short_name,
+               SUM(r.total) / SUM(r.n) AS delay,
+               datetime(MIN(r.first_ts), 'unixepoch', 'localtime') AS first_timestamp, SUM(r.n) AS n
+        FROM delay_rollups AS r
+        JOIN trips AS t ON t.id = r.key
+        LEFT JOIN vehicles AS v ON v.id = r.vehicle
+        LEFT JOIN route_types AS rt ON rt.id = r.route_type
+        LEFT JOIN route_names AS rn ON rn.id = r.route
+        WHERE r.level = {rollups.LEVEL_TRIP} AND r.bucket = {rollups.BUCKETS['day']}
+          AND r.start BETWEEN {_START} AND {_END}
+          AND r.band >= :min_delay
+          AND rt.route_type <> 2
+        GROUP BY r.key"""
+
+QUERIES = {
+    # average delay per trip from the raw positions (any threshold)
+    "trip_delays": (_TRIPS, ("start", "end", "min_delay"), True, _TRIP_MERGE),
+    # the same from the daily rollups, for thresholds that are a delay band edge
+    "trip_delays_rollup": (_TRIPS_ROLLUP, ("start", "end", "min_delay"), False, _TRIP_MERGE),
+    # delay total and count per vehicle type and time bucket (:bucket in seconds, see rollups.BUCKETS);
+    # buckets are aligned to local days, so every bucket belongs to one day
+    "delay_buckets": (f"""
+        SELECT datetime(r.start, 'unixepoch', 'localtime') AS time_bin, rt.route_type,
+               SUM(r.total) AS total, SUM(r.n) AS n
+        FROM delay_rollups AS r
+        JOIN route_types AS rt ON rt.id = r.key
+        WHERE r.level = {rollups.LEVEL_ROUTE_TYPE} AND r.bucket = :bucket
+          AND r.start BETWEEN {_START} AND {_END}
+          AND r.band >= :min_delay
+          AND rt.route_type <> 2
+        GROUP BY r.start, r.key""", ("start", "end", "bucket", "min_delay"), False, None),
+    # one row per stop visit the collector materialized (see visits.py)
+    "stop_visits": (f"""
+        SELECT v.vehicle_id, rt.route_type, rn.route_short_name, s.parent_station,
+               datetime(sv.arrival, 'unixepoch', 'localtime') AS arrival,
+               datetime(sv.departure, 'unixepoch', 'localtime') AS departure, sv.dwell
+        FROM stop_visits AS sv
+        JOIN vehicles AS v ON v.id = sv.vehicle
+        JOIN stations AS s ON s.id = sv.station
+        JOIN route_names AS rn ON rn.id = sv.route
+        LEFT JOIN route_types AS rt ON rt.id = sv.route_type
+        WHERE sv.arrival BETWEEN {_START} AND {_END}
+          AND sv.dwell >= :min_dwell""", ("start", "end", "min_dwell"), False, None),
+    # number of stop visits per station, line and hour of day
+    "stop_throughput": (f"""
+        SELECT s.parent_station, rn.route_short_name,
+               CAST(strftime('%H', sv.arrival, 'unixepoch', 'localtime') AS INTEGER) AS hour,
+               COUNT(*) AS events
+        FROM stop_visits AS sv
+        JOIN stations AS s ON s.id = sv.station
+        JOIN route_names AS rn ON rn.id = sv.route
+        WHERE sv.arrival BETWEEN {_START} AND {_END}
+        GROUP BY sv.station, sv.route, hour""", ("start", "end"), False,
+        (["parent_station", "route_short_name", "hour"], {"events": "sum"})),
+
+    # incremental transfer to the local mirror (see mirror.py); :after and :until are epoch seconds
+    # newest complete snapshot, first keyframe the range from :since (epoch) needs, last archived day
+    "mirror_bounds": ("""
+        SELECT MAX(ts) AS until,
+               (SELECT MIN(keyframe_ts) FROM snapshots WHERE ts >= :since) AS first_keyframe,
+               (SELECT MAX(day) FROM archived_days) AS last_archived_day
+        FROM snapshots""", ("since",), False, None),
+    # archived days from :since ('YYYY-MM-DD') on, whose raw rows the server deleted
+    "mirror_archived_days": ("""
+        SELECT day, rows, path FROM archived_days WHERE day >= :since ORDER BY day""", ("since",), False, None),
+    # dictionary entries added after the largest id of each dictionary in the mirror
+    "mirror_dictionaries": ("\nUNION ALL\n".join(
+        f"SELECT '{key}' AS dictionary, id, {column} AS value FROM {table} WHERE id > :{key}"
+        for key, (table, column) in schema.DICTIONARIES.items()), tuple(schema.DICTIONARIES), False, None),
+    "mirror_positions": ("""
+        SELECT ts, vehicle, trip, route, route_type, state, bearing, delay, lat_e6, lon_e6,
+               zone, stop, station, stop_dist
+        FROM positions
+        WHERE ts > :after AND ts <= :until""", ("after", "until"), False, None),
+    "mirror_snapshots": ("""
+        SELECT ts, keyframe_ts, vehicles, stored FROM snapshots
+        WHERE ts > :after AND ts <= :until""", ("after", "until"), False, None),
+    # rollup rows changed in the range: every update raises last_ts, and a bucket
+    # starts at most one day (plus a DST hour) before its last update
+    "mirror_rollups": (f"""
+        SELECT level, bucket, start, key, band, route, route_type, vehicle,
+               n, total, min_delay, max_delay, first_ts, last_ts
+        FROM delay_rollups
+        WHERE level IN ({rollups.LEVEL_TRIP}, {rollups.LEVEL_ROUTE}, {rollups.LEVEL_ROUTE_TYPE})
+          AND bucket IN ({", ".join(str(width) for width in rollups.BUCKETS.values())})
+          AND start > :after - {max(rollups.BUCKETS.values()) + 3600} AND start <= :until
+          AND last_ts > :after AND last_ts <= :until""", ("after", "until"), False, None),
+    # visits are written up to VISIT_GAP after their departure, so the range is
+    # read again from that far back; visits longer than a day are not transferred
+    "mirror_visits": (f"""
+        SELECT vehicle, arrival, departure, dwell, trip, route, route_type, stop, station, snapshots
+        FROM stop_visits
+        WHERE arrival > :after - 86400 AND arrival <= :until
+          AND departure > :after - {2 * visits.VISIT_GAP} AND departure <= :until""",
+        ("after", "until"), False, None),
+}
+
+# lower edges of the bins of the delay histogram in seconds, the last bin is open
+DELAY_BINS = rollups.DELAY_BANDS[1:]
+# lines the dashboard shows: A, B, C and the numbers 1-250 and 901-917, also with the prefix X (night lines)
+_LINE_NUMBER = "(CAST({0} AS INTEGER) BETWEEN 1 AND 250 OR CAST({0} AS INTEGER) BETWEEN 901 AND 917)"
+_VALID_LINE = f"""(gtfs_route_short_name GLOB '[ABC]'
+            OR (length(gtfs_route_short_name) <= 4 AND gtfs_route_short_name NOT GLOB '*[^0-9]*'
+                AND {_LINE_NUMBER.format("gtfs_route_short_name")})
+            OR (length(gtfs_route_short_name) <= 4 AND gtfs_route_short_name GLOB 'X[0-9]*'
+                AND substr(gtfs_route_short_name, 2) NOT GLOB '*[^0-9]*'
+                AND {_LINE_NUMBER.format("substr(gtfs_route_short_name, 2)")}))"""
+# aggregates of the dashboard over the per-trip rows of trip_delays, computed on the server so only
+# a few rows are transferred; name -> (SELECT over trip_delays, parameters besides those of trip_delays,
+# merge of the service days)
+_TRIP_AGGREGATES = {
+    # number of trips per delay bin, labeled by the lower edge of the bin
+    "delay_histogram": (f"""
+        SELECT CASE {" ".join(f"WHEN delay >= {edge} THEN {edge}" for edge in reversed(DELAY_BINS))} END AS bin,
+               COUNT(*) AS trips
+        FROM trip_delays
+        WHERE {_VALID_LINE}
+        GROUP BY bin
+        HAVING bin IS NOT NULL
+        ORDER BY bin""", (), (["bin"], {"trips": "sum"})),
+    # trips, mean, maximum and sum of the trip delays, vehicles and time span per vehicle type;
+    # vehicle_ids (a JSON array) lets the distinct vehicles of several days be counted
+    "delay_stats": (f"""
+        SELECT route_type, COUNT(*) AS trips, AVG(delay) AS mean_delay, MAX(delay) AS max_delay,
+               SUM(delay) AS total_delay, COUNT(DISTINCT vehicle_id) AS vehicles,
+               MIN(first_timestamp) AS first_timestamp, MAX(first_timestamp) AS last_timestamp,
+               json_group_array(DISTINCT vehicle_id) FILTER (WHERE vehicle_id IS NOT NULL) AS vehicle_ids
+        FROM trip_delays
+        WHERE {_VALID_LINE}
+        GROUP BY route_type
+        ORDER BY route_type""", (),
+        (["route_type"], {"trips": "sum", "mean_delay": ("mean", "trips"), "max_delay": "max", "total_delay": "sum",
+                          "vehicles": ("count", "vehicle_ids"), "first_timestamp": "min", "last_timestamp": "max",
+                          "vehicle_ids": "union"})),
+    # the :k trips with the highest delay
+    "top_delays": (f"""
+        SELECT gtfs_trip_id, delay
+        FROM (SELECT gtfs_trip_id, delay, ROW_NUMBER() OVER (ORDER BY delay DESC, gtfs_trip_id) AS rank
+              FROM trip_delays
+              WHERE {_VALID_LINE})
+        WHERE rank <= :k
+        ORDER BY rank""", ("k",), (TOP, [("delay", "descending"), ("gtfs_trip_id", "ascending")], "k")),
+    # sum and number of the trip delays per vehicle type and :bucket seconds of the trips' first position
+    "trip_delay_buckets": (f"""
+        SELECT datetime(CAST(strftime('%s', first_timestamp) AS INTEGER) / :bucket * :bucket, 'unixepoch')
+                   AS time_bin,
+               route_type, SUM(delay) AS total, COUNT(*) AS n
+        FROM trip_delays
+        WHERE {_VALID_LINE}
+        GROUP BY time_bin, route_type""", ("bucket",), (["time_bin", "route_type"], {"total": "sum", "n": "sum"})),
+}
+# name of a query that reads positions -> conditions its positions meet (see scan_filter())
+SCAN_FILTERS = {"trip_delays": _TRIPS_SCAN}
+# queries split into service days instead of local days, whose parts are never split further
+SERVICE_DAY_QUERIES = set()
+for _name, (_select, _params, _merge) in _TRIP_AGGREGATES.items():
+    QUERIES[_name] = (f"WITH trip_delays AS ({_TRIPS})\n{_select}",
+                      ("start", "end", "min_delay") + _params, True, _merge)
+    SCAN_FILTERS[_name] = _TRIPS_SCAN
+    SERVICE_DAY_QUERIES.add(_name)
+    QUERIES[f"{_name}_rollup"] = (f"WITH trip_delays AS ({_TRIPS_ROLLUP})\n{_select}",
+                                  ("start", "end", "min_delay") + _params, False, _merge)
+
+
+def bind(name, params):
+    """Return the SQL of a named query and check its parameters.
+
+    Args:
+        name (str): Name of the query, a key of QUERIES.
+        params (dict): Parameter name -> value.
+
+    Returns:
+        tuple: (sql, reads_positions).
+
+    Raises:
+        KeyError: If there is no query of this name.
+        ValueError: If parameters are missing or unknown.
+    """
+    sql, names, reads_positions, _ = QUERIES[name]
+    if set(params) != set(names):
+        raise ValueError(f"Query {name} takes the parameters {', '.join(names)}, "
+                         f"got {', '.join(sorted(params)) or 'none'}.")
+    return sql, reads_positions
+
+
+def scan_filter(name, params):
+    """Return the conditions every position a query uses meets, to skip the others early.
+
+    Args:
+        name (str): Name of the query.
+        params (dict): Its parameters.
+
+    Returns:
+        list[tuple]: (column, operator, value) with the parameters bound (see
+        archive.scan), empty if the query has none or reads no positions.
+    """
+    return [(column, op, params[value[1:]] if isinstance(value, str) and value.startswith(":") else value)
+            for column, op, value in SCAN_FILTERS.get(name, [])]
+
+
+def _normalize(value):
+    """Return a parameter value in the form the queries expect."""
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(value, date):
+        return value.isoformat()
+    if hasattr(value, "item"):
+        # numpy scalars, e.g. from a DataFrame or a Streamlit widget
+        return value.item()
+    return value
+
+
+def build(name, **params):
+    """Return a named query with normalized parameters.
+
+    Args:
+        name (str): Name of the query, a key of QUERIES.
+        **params: Its parameters.
+
+    Returns:
+        tuple: (name, params) for RequestManager.named_request.
+
+    Raises:
+        KeyError: If there is no query of this name.
+        ValueError: If parameters are missing or unknown.
+    """
+    params = {key: _normalize(value) for key, value in params.items()}
+    bind(name, params)
+    return name, params
+
+
+def cache_key(name, params):
+    """Return a key identifying the result of a named query.
+
+    The key covers the SQL text, so results cached before a query changed
+    are not reused.
+
+    Args:
+        name (str): Name of the query.
+        params (dict): Its normalized parameters (see build()).
+
+    Returns:
+        str: Hex digest of the SQL text and the parameters.
+    """
+    sql, _ = bind(name, params)
+    text = json.dumps([sql, params], sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def split_days(params):
+    """Split the :start/:end range of a query into local days.
+
+    Args:
+        params (dict): Normalized parameters with start and end as local
+            'YYYY-MM-DD HH:MM:SS' strings.
+
+    Returns:
+        list[tuple]: (day, params with the range clipped to that day) per day.
+    """
+    start = datetime.fromisoformat(params["start"])
+    end = datetime.fromisoformat(params["end"])
+    days = []
+    day = start.date()
+    while day <= end.date():
+        day_start = max(start, datetime.combine(day, time.min))
+        day_end = min(end, datetime.combine(day, time(23, 59, 59)))
+        days.append((day, dict(params, start=_normalize(day_start), end=_normalize(day_end))))
+        day = date.fromordinal(day.toordinal() + 1)
+    return days
+
+
+def split_service_days(params):
+    """Split the :start/:end range of a query into service days (see SERVICE_DAY_START).
+
+    Args:
+        params (dict): Normalized parameters with start and end as local
+            'YYYY-MM-DD HH:MM:SS' strings.
+
+    Returns:
+        list[tuple]: (day, params with the range clipped to the service day)
+        per service day; day is the local day the part ends on, whose end
+        makes the part final (see managers.query_cache.expires_at).
+    """
+    start = datetime.fromisoformat(params["start"])
+    end = datetime.fromisoformat(params["end"])
+    days = []
+    while start <= end:
+        boundary = datetime.combine(start.date(), SERVICE_DAY_START)
+        if boundary <= start:
+            boundary = datetime.combine(date.fromordinal(start.toordinal() + 1), SERVICE_DAY_START)
+        part_end = min(end, boundary - timedelta(seconds=1))
+        days.append((part_end.date(), dict(params, start=_normalize(start), end=_normalize(part_end))))
+        start = boundary
+    return days
+
+
+def split(name, params):
+    """Split the range of a named query into the parts that are fetched and cached separately.
+
+    Args:
+        name (str): Name of the query.
+        params (dict): Its normalized parameters.
+
+    Returns:
+        list[tuple]: (day, params) per service day for SERVICE_DAY_QUERIES
+        (see split_service_days), per local day otherwise (see split_days).
+    """
+    if name in SERVICE_DAY_QUERIES:
+        return split_service_days(params)
+    return split_days(params)
+
+
+def _union(arrays):
+    """Return the JSON array of the distinct elements of JSON arrays, skipping missing ones."""
+    return json.dumps(sorted({value for array in arrays if array is not None for value in json.loads(array)}))
+
+
+def merge_days(name, tables, params=None):
+    """Combine the results of single days into the result of the whole range.
+
+    Args:
+        name (str): Name of the query.
+        tables (list[pyarrow.Table]): Result of every day, with the column names of the query.
+        params (dict, optional): Parameters of the query, needed by TOP merges.
+
+    Returns:
+        pyarrow.Table: The combined result; rows combined by keys are ordered by them.
+    """
+    merge = QUERIES[name][3]
+    tables = [table for table in tables if table.num_rows] or tables[:1]
+    if len(tables) == 1:
+        return tables[0]
+    try:
+        table = pa.concat_tables(tables, promote_options="permissive")
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # a column that is NULL on some days has no type there and was sent as string
+        schema = max(tables, key=len).schema
+        table = pa.concat_tables([day.cast(schema) for day in tables])
+    if merge is None:
+        return table
+    if merge[0] == TOP:
+        _, sort_keys, limit = merge
+        return table.sort_by(sort_keys).slice(0, params[limit])
+    keys, aggregates = merge
+    weights = {column: aggregate[1] for column, aggregate in aggregates.items()
+               if isinstance(aggregate, tuple) and aggregate[0] == "mean"}
+    counts = {column: aggregate[1] for column, aggregate in aggregates.items()
+              if isinstance(aggregate, tuple) and aggregate[0] == "count"}
+    # a weighted mean is the sum of value * weight divided by the summed weight
+    for column, weight in weights.items():
+        index = table.schema.get_field_index(column)
+        table = table.set_column(index, column, pc.multiply(table[column].cast(pa.float64()), table[weight]))
+    # the arrays of a union are collected and combined below, counts are taken from the union
+    functions = {column: "sum" if column in weights else "first" if column in counts
+                 else "list" if aggregate == "union" else aggregate for column, aggregate in aggregates.items()}
+    # "first" needs the rows in order
+    merged = table.group_by(keys, use_threads=False).aggregate(list(functions.items()))
+    # pyarrow names the aggregates "<column>_<function>"
+    names = {f"{column}_{function}": column for column, function in functions.items()}
+    merged = merged.rename_columns([names.get(column, column) for column in merged.column_names])
+    for column, weight in weights.items():
+        index = merged.schema.get_field_index(column)
+        merged = merged.set_column(index, column, pc.divide(merged[column], merged[weight]))
+    for column, aggregate in aggregates.items():
+        if aggregate == "union":
+            index = merged.schema.get_field_index(column)
+            merged = merged.set_column(index, column, pa.array(map(_union, merged[column].to_pylist()), pa.string()))
+    for column, union in counts.items():
+        index = merged.schema.get_field_index(column)
+        sizes = [len(json.loads(array)) for array in merged[union].to_pylist()]
+        merged = merged.set_column(index, column, pa.array(sizes, table.schema.field(column).type))
+    return merged.select(table.column_names).sort_by([(key, "ascending") for key in keys])
+
+
+def _from_trips(name, min_delay, **params):
+    """Build a query over the trip delays, from the rollups if min_delay is a delay band edge."""
+    if min_delay in rollups.DELAY_BANDS:
+        name = f"{name}_rollup"
+    return build(name, min_delay=int(min_delay), **params)
+
+
+def trip_delays(start, end, min_delay):
+    """Average delay per trip, from the rollups if min_delay is a delay band edge.
+
+    Args:
+        start (datetime): Start of the range (local time).
+        end (datetime): End of the range (local time).
+        min_delay (int): Minimum delay threshold in seconds.
+
+    Returns:
+        tuple: (name, params); columns gtfs_trip_id, vehicle_id, route_type,
+        gtfs_route_short_name, delay, first_timestamp, n (number of positions).
+    """
+    return _from_trips("trip_delays", min_delay, start=start, end=end)
+
+
+def delay_histogram(start, end, min_delay):
+    """Number of trips per delay bin (see DELAY_BINS), of the lines the dashboard shows.
+
+    Args:
+        start (datetime): Start of the range (local time).
+        end (datetime): End of the range (local time).
+        min_delay (int): Minimum delay threshold in seconds.
+
+    Returns:
+        tuple: (name, params); columns bin (lower edge in seconds), trips.
+    """
+    return _from_trips("delay_histogram", min_delay, start=start, end=end)
+
+
+def delay_stats(start, end, min_delay):
+    """Statistics of the trip delays per vehicle type, of the lines the dashboard shows.
+
+    Args:
+        start (datetime): Start of the range (local time).
+        end (datetime): End of the range (local time).
+        min_delay (int): Minimum delay threshold in seconds.
+
+    Returns:
+        tuple: (name, params); columns route_type, trips, mean_delay, max_delay,
+        total_delay, vehicles (distinct), first_timestamp, last_timestamp.
+    """
+    return _from_trips("delay_stats", min_delay, start=start, end=end)
+
+
+def top_delays(start, end, min_delay, k=10):
+    """The k trips with the highest delay, of the lines the dashboard shows.
+
+    Args:
+        start (datetime): Start of the range (local time).
+        end (datetime): End of the range (local time).
+        min_delay (int): Minimum delay threshold in seconds.
+        k (int): Number of trips.
+
+    Returns:
+        tuple: (name, params); columns gtfs_trip_id, delay, highest first.
+    """
+    return _from_trips("top_delays", min_delay, start=start, end=end, k=int(k))
+
+
+def trip_delay_buckets(interval, min_delay, start, end):
+    """Sum and number of the trip delays per vehicle type and time bucket of the trips' start.
+
+    Unlike delay_buckets, every trip counts once, for any threshold.
+
+    Args:
+        interval (str): Aggregation interval, a key of rollups.BUCKETS.
+        min_delay (int): Minimum delay threshold in seconds.
+        start (datetime): Start of the range (local time).
+        end (datetime): End of the range (local time).
+
+    Returns:
+        tuple: (name, params); columns time_bin, route_type, total, n.
+    """
+    return _from_trips("trip_delay_buckets", min_delay, start=start, end=end, bucket=rollups.BUCKETS[interval])
+
+
+def delay_buckets(interval, min_delay, start, end):
+    """Delay total and count per vehicle type and time bucket.
+
+    Args:
+        interval (str): Aggregation interval, a key of rollups.BUCKETS.
+        min_delay (int): Minimum delay threshold in seconds, a delay band edge.
+        start (datetime): Start of the range (local time).
+        end (datetime): End of the range (local time).
+
+    Returns:
+        tuple: (name, params); columns time_bin, route_type, total, n.
+    """
+    return build("delay_buckets", start=start, end=end, bucket=rollups.BUCKETS[interval],
+                 min_delay=int(min_delay))
+
+
+def stop_visits(start, end, min_dwell):
+    """Stop visits of at least min_dwell seconds (see visits.py).
+
+    Args:
+        start (datetime or str): Start of the range (local time).
+        end (datetime or str): End of the range (local time).
+        min_dwell (int): Minimum dwell time in seconds.
+
+    Returns:
+        tuple: (name, params); columns vehicle_id, route_type, route_short_name,
+        parent_station, arrival, departure, dwell.
+    """
+    return build("stop_visits", start=start, end=end, min_dwell=int(min_dwell))
+
+
+def stop_throughput(start, end):
+    """Number of stop visits per station, line and hour of day.
+
+    Args:
+        start (datetime or str): Start of the range (local time).
+        end (datetime or str): End of the range (local time).
+
+    Returns:
+        tuple: (name, params); columns parent_station, route_short_name, hour, events.
+    """
+    return build("stop_throughput", start=start, end=end)
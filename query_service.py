@@ -0,0 +1,297 @@
+"""
+query_service.py
+
+Long-running query service of the gather host, the warm counterpart of
+remote_query.py.
+
+Starting python3 and opening a cold database for every query costs hundreds
+of milliseconds before any work begins. The service runs next to the
+collector, keeps a pool of read-only connections open (so SQLite prepares
+each named query once per connection) and answers the named, parameterized
+queries of queries.py over HTTP. It listens on 127.0.0.1 or a Unix socket
+only; RequestManager reaches it through a direct-tcpip channel of its
+pooled SSH connection (see managers/query_client.py), so it needs no open port.
+
+Protocol:
+    POST /query  with the JSON body {"query": <name>, "params": {...}} and
+                 optionally "timeout": seconds the query may run, and
+                 "max_load_rows": archived rows it may load (at most
+                 remote_query.LOAD_MAX_ROWS)
+        200: the rows as Arrow IPC stream (see remote_query.write_arrow),
+             streamed while SQLite returns them.
+        400: unknown query or wrong parameters; 500: the query failed;
+             504: the query ran past its deadline. The body is the error message.
+    GET /queries  JSON object name -> parameter names.
+    GET /health   "ok".
+Queries that read positions over archived days run on a fresh connection
+with the archive loaded into a TEMP table on disk (see
+remote_query.shadow_archived), so the pooled connections never hold TEMP
+objects.
+
+Every query is stopped after its timeout, at most --max-seconds, and as
+soon as its client closed the connection (see remote_query.limits), so a
+runaway query cannot hold a pooled connection for long.
+
+Usage:
+    python query_service.py --port 8765
+    python query_service.py --socket /tmp/prague_gtfs_query.sock
+"""
+
+import argparse
+import json
+import logging
+import os
+import queue
+import socketserver
+import sqlite3
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pyarrow as pa
+
+import archive
+import queries
+import remote_query
+import schema
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8765
+# read-only connections kept open, also the number of queries running at the same time
+POOL_SIZE = 4
+# seconds a query may run at most, whatever its client asks for
+MAX_QUERY_SECONDS = 600
+ARROW_CONTENT_TYPE = "application/vnd.apache.arrow.stream"
+
+
+class ConnectionPool:
+    """Read-only connections to the collector database, opened on first use and kept open.
+
+    Attributes:
+        db_path (str): Path to the collector database.
+        size (int): Maximum number of connections.
+    """
+    def __init__(self, db_path=schema.DB_PATH, size=POOL_SIZE):
+        """Initialize an empty ConnectionPool.
+
+        Args:
+            db_path (str): Path to the collector database.
+            size (int): Maximum number of connections.
+        """
+        self.db_path = db_path
+        self.size = size
+        self.idle = queue.LifoQueue()
+        # one token per connection that may be in use
+        self.slots = queue.Queue()
+        for _ in range(size):
+            self.slots.put(None)
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection, waiting while all of them are in use.
+
+        Yields:
+            sqlite3.Connection: A warm read-only connection.
+        """
+        self.slots.get()
+        try:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                conn = remote_query.open_readonly(self.db_path)
+            try:
+                yield conn
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                self.idle.put(conn)
+        finally:
+            self.slots.put(None)
+
+    def close(self):
+        """Close the idle connections."""
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class _Response:
+    """Binary stream of the response body that sends the 200 headers on the first write.
+
+    Errors raised before the first row is written still get an error status.
+    """
+    # pyarrow checks the file before writing
+    closed = False
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.started = False
+
+    def write(self, data):
+        if not self.started:
+            self.handler.send_response(200)
+            self.handler.send_header("Content-Type", ARROW_CONTENT_TYPE)
+            self.handler.end_headers()
+            self.started = True
+        return self.handler.wfile.write(data)
+
+    def flush(self):
+        self.handler.wfile.flush()
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """Answers the requests of one HTTP connection (see the module docstring)."""
+    # close the connection after the response, the end of the stream marks the end of the result
+    protocol_version = "HTTP/1.0"
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_text(200, "ok")
+        elif self.path == "/queries":
+            body = {name: list(spec[1]) for name, spec in queries.QUERIES.items()}
+            self._send_text(200, json.dumps(body), "application/json")
+        else:
+            self._send_text(404, f"Unknown path {self.path}.")
+
+    def do_POST(self):
+        if self.path != "/query":
+            self._send_text(404, f"Unknown path {self.path}.")
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            name = request["query"]
+            params = request.get("params", {})
+            timeout = min(float(request.get("timeout", self.server.max_seconds)), self.server.max_seconds)
+            max_load_rows = min(int(request.get("max_load_rows", remote_query.LOAD_MAX_ROWS)),
+                                remote_query.LOAD_MAX_ROWS)
+            _, reads_positions = queries.bind(name, params)
+        except KeyError as e:
+            self._send_text(400, f"Unknown query or missing field: {e}")
+            return
+        except (ValueError, TypeError, AttributeError) as e:
+            self._send_text(400, f"Bad request: {e}")
+            return
+
+        response = _Response(self)
+        try:
+            with self._connection(reads_positions, params) as conn, \
+                    remote_query.limits(conn, timeout, lambda: remote_query.socket_closed(self.connection)):
+                cursor = remote_query.execute_named(conn, name, params, self.server.archive_dir, max_load_rows)
+                try:
+                    rows = remote_query.write_arrow(cursor, response)
+                finally:
+                    # a cursor left behind would keep its read snapshot open
+                    cursor.close()
+        except remote_query.QueryStopped as e:
+            logger.warning(f"{name} stopped: {e}.")
+            if not response.started:
+                self._send_text(504, f"Query stopped: {e}.")
+            return
+        except (sqlite3.Error, OSError, pa.ArrowException) as e:
+            if isinstance(e, (BrokenPipeError, ConnectionResetError)):
+                logger.info(f"{name}: client went away.")
+            elif response.started:
+                # the status is already sent; the truncated stream fails on the client
+                logger.error(f"{name} failed while streaming: {e}")
+            else:
+                logger.error(f"{name} failed: {e}")
+                self._send_text(500, str(e))
+            return
+        logger.info(f"{name}: {rows} rows.")
+
+    @contextmanager
+    def _connection(self, reads_positions, params):
+        """Borrow a pooled connection, or open a fresh one for ranges over archived days."""
+        pool = self.server.pool
+        with pool.connection() as conn:
+            if not (reads_positions and remote_query.reaches_archive(conn, archive.to_epoch(conn, params["start"]))):
+                yield conn
+                return
+            # the TEMP tables of the archive must not stay on a pooled connection
+            fresh = remote_query.open_readonly(pool.db_path)
+            try:
+                yield fresh
+            finally:
+                fresh.close()
+
+    def _send_text(self, status, text, content_type="text/plain; charset=utf-8"):
+        body = text.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class QueryServer(ThreadingHTTPServer):
+    """HTTP server on 127.0.0.1 with a pool of warm connections.
+
+    Attributes:
+        pool (ConnectionPool): The read-only connections.
+        archive_dir (str): Root directory of the archive.
+        max_seconds (float): Seconds a query may run at most.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, pool, archive_dir=archive.ARCHIVE_DIR, max_seconds=MAX_QUERY_SECONDS):
+        self.pool = pool
+        self.archive_dir = archive_dir
+        self.max_seconds = max_seconds
+        super().__init__(address, QueryHandler)
+
+
+class UnixQueryServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """The same on a Unix socket, e.g. for local runs without a TCP port."""
+    daemon_threads = True
+
+    def __init__(self, path, pool, archive_dir=archive.ARCHIVE_DIR, max_seconds=MAX_QUERY_SECONDS):
+        self.pool = pool
+        self.archive_dir = archive_dir
+        self.max_seconds = max_seconds
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, QueryHandler)
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ("unix", 0)
+
+
+def main():
+    """Command line entry point for running the query service."""
+    parser = argparse.ArgumentParser(description="Query service of the vehicle positions database.")
+    parser.add_argument("--db", default=schema.DB_PATH, help="Path to the collector database.")
+    parser.add_argument("--archive-dir", default=archive.ARCHIVE_DIR, help="Root directory of the archive.")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="TCP port on 127.0.0.1.")
+    parser.add_argument("--socket", help="Listen on this Unix socket instead of the TCP port.")
+    parser.add_argument("--pool-size", type=int, default=POOL_SIZE, help="Read-only connections kept open.")
+    parser.add_argument("--max-seconds", type=float, default=MAX_QUERY_SECONDS,
+                        help="Seconds a query may run at most.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    pool = ConnectionPool(args.db, args.pool_size)
+    if args.socket:
+        server = UnixQueryServer(args.socket, pool, args.archive_dir, args.max_seconds)
+        logger.info(f"Query service listening on {args.socket}.")
+    else:
+        server = QueryServer(("127.0.0.1", args.port), pool, args.archive_dir, args.max_seconds)
+        logger.info(f"Query service listening on 127.0.0.1:{args.port}.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+recorder.py
+
+Raw snapshot recorder and replay harness of the collector.
+
+Recording:
+    With RECORD_DIR set, server.py appends every raw API payload to
+    <RECORD_DIR>/YYYY-MM-DD.rec.gz (or .rec.zst with RECORD_COMPRESSION=zstd
+    and the zstandard package installed). Each snapshot is one independent
+    compressed member, so files are append-only and a crash can at most cut
+    off the last snapshot. Inside the decompressed stream each record is
+
+        <tick> <length>\\n<length bytes of the raw JSON payload>\\n
+
+Replay:
+    python recorder.py replay --start 2025-05-20 --end 2025-05-21 --db scratch.db --speed 60
+    python recorder.py replay --start 2025-05-20 --db rebuilt.db --speed 0 --delta
+
+    Feeds the recorded snapshots through server.store_vehicle_stream into
+    a scratch database, --speed times faster than recorded (0 = as fast as
+    possible), and reports snapshots and rows per second. Use it to load-test
+    schema and index changes or to rebuild a database without the live API.
+"""
+
+import argparse
+import gzip
+import io
+import logging
+import os
+import shutil
+import time
+from datetime import date, datetime, timedelta
+
+try:
+    import zstandard
+    zstd_error = zstandard.ZstdError
+except ImportError:  # optional, gzip is always available
+    zstandard = None
+    zstd_error = OSError
+
+logger = logging.getLogger(__name__)
+
+RECORD_DIR = os.getenv("RECORD_DIR", "")
+RECORD_COMPRESSION = os.getenv("RECORD_COMPRESSION", "gzip")
+_SUFFIXES = {"gzip": ".rec.gz", "zstd": ".rec.zst"}
+_COPY_BYTES = 64 * 1024
+
+
+class Recorder:
+    """Appends raw payloads to per-day compressed files.
+
+    Attributes:
+        directory (str): Directory of the recordings.
+        compression (str): 'gzip' or 'zstd'.
+    """
+    def __init__(self, directory=RECORD_DIR, compression=RECORD_COMPRESSION):
+        """Initialize the Recorder.
+
+        Args:
+            directory (str): Directory of the recordings, created if missing.
+            compression (str): 'gzip' or 'zstd' (needs the zstandard package).
+
+        Raises:
+            ValueError: If the compression is unknown or zstandard is missing.
+        """
+        if compression not in _SUFFIXES:
+            raise ValueError(f"Unknown compression {compression!r}, use 'gzip' or 'zstd'.")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("RECORD_COMPRESSION=zstd needs the zstandard package.")
+        self.directory = directory
+        self.compression = compression
+        self.compressor = zstandard.ZstdCompressor(level=6) if compression == "zstd" else None
+        os.makedirs(directory, exist_ok=True)
+
+    def path_for(self, tick):
+        """Return the recording file of the local day of a tick."""
+        day = datetime.fromtimestamp(tick).date()
+        return os.path.join(self.directory, day.isoformat() + _SUFFIXES[self.compression])
+
+    def record(self, tick, payload):
+        """Append one raw payload.
+
+        Args:
+            tick (int): Snapshot time in epoch seconds.
+            payload (bytes or file): Raw API response body, or a binary file
+                object positioned at its start (e.g. the collector's spool file),
+                which is compressed chunk by chunk.
+        """
+        if isinstance(payload, (bytes, bytearray)):
+            payload = io.BytesIO(payload)
+        start = payload.tell()
+        length = payload.seek(0, io.SEEK_END) - start
+        payload.seek(start)
+        with open(self.path_for(tick), "ab") as f:
+            # one independent gzip member or zstd frame per record
+            if self.compressor is not None:
+                member = self.compressor.stream_writer(f, closefd=False)
+            else:
+                member = gzip.GzipFile(fileobj=f, mode="wb", compresslevel=6)
+            with member:
+                member.write(b"%d %d\n" % (tick, length))
+                shutil.copyfileobj(payload, member, _COPY_BYTES)
+                member.write(b"\n")
+
+
+def _open_recording(path):
+    """Open a recording for reading as a decompressed binary stream."""
+    if path.endswith(_SUFFIXES["zstd"]):
+        if zstandard is None:
+            raise ValueError(f"{path} needs the zstandard package.")
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True,
+                                                            closefd=True)
+        # the zstd reader has no readline()
+        return io.BufferedReader(reader)
+    return gzip.open(path, "rb")
+
+
+def read_recording(path):
+    """Yield the snapshots of one recording file.
+
+    A truncated last record (e.g. after a crash) is skipped with a warning.
+
+    Args:
+        path (str): Path of a .rec.gz or .rec.zst file.
+
+    Yields:
+        tuple: (tick, payload bytes).
+    """
+    with _open_recording(path) as f:
+        while True:
+            try:
+                header = f.readline()
+                if not header:
+                    return
+                tick, length = (int(value) for value in header.split())
+                payload = f.read(length)
+                f.read(1)
+            except (EOFError, ValueError, OSError, zstd_error) as e:
+                logger.warning(f"Truncated record in {path}: {e}")
+                return
+            if len(payload) < length:
+                logger.warning(f"Truncated record in {path} at tick {tick}.")
+                return
+            yield tick, payload
+
+
+def recordings(directory, start_day, end_day):
+    """Return the recording files of the days from start_day to end_day.
+
+    Args:
+        directory (str): Directory of the recordings.
+        start_day (date): First day.
+        end_day (date): Last day (inclusive).
+
+    Returns:
+        list[str]: Existing files in day order.
+    """
+    paths = []
+    day = start_day
+    while day <= end_day:
+        for suffix in _SUFFIXES.values():
+            path = os.path.join(directory, day.isoformat() + suffix)
+            if os.path.exists(path):
+                paths.append(path)
+        day += timedelta(days=1)
+    return paths
+
+
+def replay(paths, writer, speed=0.0):
+    """Feed recorded snapshots through the collector's streaming store path.
+
+    Args:
+        paths (list[str]): Recording files in day order.
+        writer (server.PositionWriter): Writer of the scratch database.
+        speed (float): Replay speed relative to the recording; 0 means no pauses.
+
+    Returns:
+        dict: snapshots, rows, stored, seconds, rows_per_second.
+    """
+    import server
+
+    snapshots = rows = stored = 0
+    started = time.perf_counter()
+    first_tick = None
+    for path in paths:
+        for tick, payload in read_recording(path):
+            if first_tick is None:
+                first_tick = tick
+            if speed > 0:
+                # keep the recorded spacing, compressed by the speed factor
+                delay = (tick - first_tick) / speed - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            received, written, _, _ = server.store_vehicle_stream(io.BytesIO(payload), writer, tick)
+            rows += received
+            stored += written
+            snapshots += 1
+    writer.commit()
+    seconds = time.perf_counter() - started
+    return {
+        "snapshots": snapshots,
+        "rows": rows,
+        "stored": stored,
+        "seconds": seconds,
+        "rows_per_second": rows / seconds if seconds else 0.0,
+    }
+
+
+def main():
+    """Command line entry point for replaying recordings."""
+    parser = argparse.ArgumentParser(description="Replay recorded API snapshots into a database.")
+    parser.add_argument("command", choices=["replay"])
+    parser.add_argument("--dir", default=RECORD_DIR or "recordings", help="Directory of the recordings.")
+    parser.add_argument("--start", required=True, type=date.fromisoformat, help="First day (YYYY-MM-DD).")
+    parser.add_argument("--end", type=date.fromisoformat, help="Last day (YYYY-MM-DD), defaults to --start.")
+    parser.add_argument("--db", required=True, help="Target database, normally a scratch file.")
+    parser.add_argument("--speed", type=float, default=0.0, help="Replay speed factor, 0 = as fast as possible.")
+    parser.add_argument("--delta", action="store_true", help="Store in delta mode.")
+    parser.add_argument("--force", action="store_true", help="Allow replaying into the collector database.")
+    args = parser.parse_args()
+
+    import server
+
+    if os.path.abspath(args.db) == os.path.abspath(server.DB_PATH) and not args.force:
+        parser.error(f"{args.db} is the collector database; use a scratch file or --force.")
+    paths = recordings(args.dir, args.start, args.end or args.start)
+    if not paths:
+        parser.error(f"No recordings in {args.dir} for the selected days.")
+
+    writer = server.PositionWriter(args.db, delta=args.delta)
+    server.create_table(writer.conn, delta=args.delta)
+    try:
+        result = replay(paths, writer, args.speed)
+    finally:
+        writer.close()
+    print(f"Replayed {result['snapshots']} snapshots ({result['rows']} rows, {result['stored']} stored) "
+          f"in {result['seconds']:.1f}s: {result['rows_per_second']:.0f} rows/s, "
+          f"{result['snapshots'] / result['seconds'] if result['seconds'] else 0:.2f} snapshots/s.")
+
+
+if __name__ == "__main__":
+    main()
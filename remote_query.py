@@ -0,0 +1,404 @@
+"""
+remote_query.py
+
+Server-side helper that runs one read-only SQL query over the collector
+database and the Parquet archive (see maintenance.py), so callers do not
+need to know which days are still stored as raw rows.
+
+Usage (the query is read from stdin):
+    python3 remote_query.py --db vehicle_positions.db --start 1716156000 --end 1716242399 < query.sql
+    python3 remote_query.py --start "2024-05-20 00:00:00" --end "2024-05-20 23:59:59" < query.sql
+    python3 remote_query.py --format arrow < query.sql > result.arrows
+    echo '{"start": "2024-05-20 00:00:00", "end": "2024-05-20 23:59:59", "min_dwell": 60}' \
+        | python3 remote_query.py --query stop_visits --format arrow > result.arrows
+    With --query, stdin holds the JSON parameters of a named query of
+    queries.py instead of SQL; queries reading positions take the range from
+    their start and end parameters.
+    python3 remote_query.py --timeout 300 --format arrow < query.sql > result.arrows
+    With --timeout, the query is stopped after that many seconds.
+
+If the range [start, end] reaches into archived days, the archived rows of
+the range are loaded into a TEMP table on disk, and TEMP views named
+vehicle_positions_full and vehicle_positions, which shadow the views of the
+same name for this connection, return them together with the raw rows of
+the database (see shadow_archived). Otherwise (or without a range) the query
+runs directly on the database.
+
+Output formats (--format):
+    text (default): the format of the sqlite3 command line tool, one row per
+        line with the columns separated by "|".
+    arrow: a zstd-compressed Arrow IPC stream with the column names of the
+        query, written in batches of ARROW_BATCH_ROWS while the rows are
+        fetched. Column types follow the values SQLite returns (INTEGER ->
+        int64, REAL -> float64, TEXT -> string, BLOB -> binary), inferred from
+        the first batch. RequestManager.server_request reads this format.
+
+The query is also stopped as soon as the reader of stdout went away (e.g.
+RequestManager closed the SSH channel because the page was left), so no
+query keeps running for a client that no longer waits. A stopped query
+exits with EXIT_STOPPED and the reason on stderr.
+"""
+
+import argparse
+import json
+import re
+import select
+import socket
+import sqlite3
+import sys
+import time
+from contextlib import contextmanager
+
+import pyarrow as pa
+
+import archive
+import queries
+import schema
+
+BUSY_TIMEOUT_MS = 5000
+# rows per record batch of the arrow format
+ARROW_BATCH_ROWS = 65536
+# SQLite virtual machine instructions between two checks of the deadline and the client
+PROGRESS_STEPS = 100000
+# exit status of a query that was stopped (see limits())
+EXIT_STOPPED = 3
+# archived rows a query may load into its TEMP table (see shadow_archived)
+LOAD_MAX_ROWS = 50_000_000
+_COLUMNS = ("vehicle_id, gtfs_trip_id, route_type, gtfs_route_short_name, bearing, delay, "
+            "latitude, longitude, state_position, zone, stop_id, parent_station, stop_distance")
+
+
+class QueryStopped(Exception):
+    """Raised when a query ran past its deadline or its client went away."""
+
+
+def open_readonly(db_path=schema.DB_PATH):
+    """Open a read-only connection to the collector database.
+
+    Args:
+        db_path (str): Path to the collector database.
+
+    Returns:
+        sqlite3.Connection: The connection; TEMP tables live in memory unless
+        shadow_archived moved them to a file.
+    """
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+def reaches_archive(conn, start):
+    """Return True if a range starting at start (epoch seconds) includes archived days."""
+    cutoff = archive.archived_before(conn)
+    return cutoff is not None and start < cutoff
+
+
+def _used_columns(sql):
+    """Return the columns of the positions views a query refers to.
+
+    Args:
+        sql (str or None): The query; None or SELECT * uses all columns.
+
+    Returns:
+        list[str]: Column names of _COLUMNS, in their order.
+    """
+    names = [name.strip() for name in _COLUMNS.split(",")]
+    if sql is None or re.search(r"SELECT\s+(DISTINCT\s+)?(\w+\.)?\*", sql, re.IGNORECASE):
+        return names
+    return [name for name in names if re.search(rf"\b{name}\b", sql)]
+
+
+def shadow_archived(conn, start, end, archive_dir=archive.ARCHIVE_DIR, sql=None, where=None,
+                    max_rows=LOAD_MAX_ROWS):
+    """Shadow the positions views with the range [start, end] of archive and database.
+
+    The archived part of the range is copied into a TEMP table, the rest is
+    read in place: the TEMP views vehicle_positions_full and vehicle_positions
+    return the archived rows followed by those of the database from the
+    archive cutoff on, so raw rows are never copied. Only the columns the
+    query refers to are read (the others stay NULL), and the range and the
+    conditions of where are applied by the Parquet reader (see archive.scan).
+    The TEMP table is written to a temporary file, not to memory; Python
+    holds one batch at a time. The inserts run in SQLite, so the progress
+    handler of limits() stops a load that runs past the deadline.
+
+    Args:
+        conn (sqlite3.Connection): Read-only connection to the collector database.
+        start (int): First epoch second of the query range.
+        end (int): Last epoch second of the query range.
+        archive_dir (str): Root directory of the archive.
+        sql (str, optional): The query that will read the TEMP views, used to
+            skip the columns it does not need; None loads all columns.
+        where (list[tuple], optional): Conditions every position the query
+            uses meets (see queries.scan_filter), to load only those.
+        max_rows (int): Archived rows that may be loaded.
+
+    Returns:
+        bool: True if archived rows were needed, False if the range is not archived.
+
+    Raises:
+        QueryStopped: If the range needs more than max_rows archived rows.
+    """
+    if not reaches_archive(conn, start):
+        return False
+    cutoff = archive.archived_before(conn)
+    columns = _used_columns(sql)
+    # the local time is only formatted if the query reads it
+    timestamp = sql is None or re.search(r"\btimestamp\b", sql) is not None
+    # changing temp_store drops TEMP objects, so it comes first
+    conn.execute("PRAGMA temp_store=FILE")
+    conn.execute(f"""CREATE TEMP TABLE archived_positions AS
+                     SELECT {_COLUMNS}, timestamp, ts FROM main.vehicle_positions_full WHERE 0""")
+    targets = ", ".join(columns + (["timestamp"] if timestamp else []) + ["ts"])
+    values = ", ".join(["?"] * len(columns) + (["datetime(?, 'unixepoch', 'localtime')"] if timestamp else []) + ["?"])
+    insert = f"INSERT INTO temp.archived_positions ({targets}) VALUES ({values})"
+    loaded = 0
+    for batch in archive.scan(conn, start, min(end, cutoff - 1), columns + ["ts"], archive_dir=archive_dir,
+                              where=where):
+        loaded += batch.num_rows
+        if loaded > max_rows:
+            raise QueryStopped(f"its range needs more than {max_rows} archived rows")
+        rows = zip(*(column.to_pylist() for column in batch.columns))
+        conn.executemany(insert, (row + row[-1:] if timestamp else row for row in rows))
+    # rows between the deletion bound and the cutoff are both archived and stored
+    conn.execute(f"""CREATE TEMP VIEW vehicle_positions_full AS
+                     SELECT {_COLUMNS}, timestamp, ts FROM temp.archived_positions
+                     UNION ALL
+                     SELECT {_COLUMNS}, timestamp, ts FROM main.vehicle_positions_full WHERE ts >= {int(cutoff)}""")
+    conn.execute(f"""CREATE TEMP VIEW vehicle_positions AS
+                     SELECT {_COLUMNS}, timestamp FROM temp.vehicle_positions_full""")
+    return True
+
+
+def execute_named(conn, name, params, archive_dir=archive.ARCHIVE_DIR, max_load_rows=LOAD_MAX_ROWS):
+    """Run a named query of queries.py with bound parameters.
+
+    Args:
+        conn (sqlite3.Connection): Read-only connection to the collector database.
+        name (str): Name of the query.
+        params (dict): Its parameters.
+        archive_dir (str): Root directory of the archive.
+        max_load_rows (int): Archived rows the query may load (see shadow_archived).
+
+    Returns:
+        sqlite3.Cursor: Cursor of the executed query.
+
+    Raises:
+        KeyError: If there is no query of this name.
+        ValueError: If parameters are missing or unknown.
+        QueryStopped: If the query needs more than max_load_rows archived rows.
+    """
+    sql, reads_positions = queries.bind(name, params)
+    if reads_positions:
+        shadow_archived(conn, archive.to_epoch(conn, params["start"]), archive.to_epoch(conn, params["end"]),
+                        archive_dir, sql, queries.scan_filter(name, params), max_load_rows)
+    return conn.execute(sql, params)
+
+
+def pipe_closed(fd):
+    """Return True if the reader of a pipe or socket we write to closed its end.
+
+    Args:
+        fd (int): File descriptor, e.g. of stdout.
+
+    Returns:
+        bool: True once writing would fail.
+    """
+    poller = select.poll()
+    # POLLERR and POLLHUP are always reported
+    poller.register(fd, 0)
+    return any(events & (select.POLLERR | select.POLLHUP) for _, events in poller.poll(0))
+
+
+def socket_closed(sock):
+    """Return True if the peer of a socket closed it (the request was read completely before).
+
+    Args:
+        sock (socket.socket): The connected socket.
+
+    Returns:
+        bool: True once the peer sent its end of stream.
+    """
+    try:
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+    except BlockingIOError:
+        return False
+    except OSError:
+        return True
+
+
+@contextmanager
+def limits(conn, timeout=None, gone=None):
+    """Stop the queries of a connection after a deadline or once the client went away.
+
+    SQLite calls a progress handler every PROGRESS_STEPS instructions, also
+    while it sorts or groups before the first row, and the handler
+    interrupts the query, so a long query ends without killing the process.
+
+    Args:
+        conn (sqlite3.Connection): The connection.
+        timeout (float, optional): Seconds the block may run, None for no deadline.
+        gone (callable, optional): Returns True if the client went away (see
+            pipe_closed and socket_closed).
+
+    Raises:
+        QueryStopped: If a query was interrupted, with the reason.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    reasons = []
+
+    def check():
+        if deadline is not None and time.monotonic() > deadline:
+            reasons.append(f"it ran longer than {timeout:g} s")
+        elif gone is not None and gone():
+            reasons.append("the client went away")
+        # non-zero interrupts the running statement
+        return len(reasons)
+
+    conn.set_progress_handler(check, PROGRESS_STEPS)
+    try:
+        yield
+    except sqlite3.OperationalError as e:
+        if reasons:
+            raise QueryStopped(reasons[0]) from e
+        raise
+    finally:
+        conn.set_progress_handler(None, PROGRESS_STEPS)
+
+
+def _column_type(values):
+    """Return the Arrow type of a result column from the values of its first batch."""
+    kinds = {type(value) for value in values if value is not None}
+    if not kinds or str in kinds:
+        return pa.string()
+    if kinds == {bytes}:
+        return pa.binary()
+    if float in kinds:
+        return pa.float64()
+    return pa.int64()
+
+
+def _column_array(values, column_type):
+    """Convert the values of one column to an array of its type."""
+    try:
+        return pa.array(values, type=column_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+        if column_type != pa.string():
+            raise
+        # TEXT column that also holds numbers (SQLite's dynamic typing)
+        return pa.array([None if value is None else str(value) for value in values], type=column_type)
+
+
+def record_batches(cursor, batch_rows=ARROW_BATCH_ROWS):
+    """Convert the rows of an executed query to Arrow record batches while they are fetched.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the executed query.
+        batch_rows (int): Rows per record batch.
+
+    Returns:
+        tuple: (pyarrow.Schema inferred from the first batch, iterator of pyarrow.RecordBatch).
+    """
+    names = [description[0] for description in cursor.description or []]
+    rows = cursor.fetchmany(batch_rows)
+    columns = list(zip(*rows)) if rows else [()] * len(names)
+    result_schema = pa.schema([(name, _column_type(values)) for name, values in zip(names, columns)])
+
+    def batches(rows, columns):
+        while rows:
+            arrays = [_column_array(list(values), field.type) for values, field in zip(columns, result_schema)]
+            yield pa.RecordBatch.from_arrays(arrays, schema=result_schema)
+            rows = cursor.fetchmany(batch_rows)
+            columns = list(zip(*rows))
+
+    return result_schema, batches(rows, columns)
+
+
+def write_arrow(cursor, out, batch_rows=ARROW_BATCH_ROWS):
+    """Write the rows of an executed query as a compressed Arrow IPC stream.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the executed query.
+        out: Binary file object to write to.
+        batch_rows (int): Rows per record batch.
+
+    Returns:
+        int: Number of rows written.
+
+    Raises:
+        pyarrow.ArrowInvalid: If a column changes its type after the first batch
+            (e.g. REAL values in a column whose first batch was INTEGER); CAST
+            such columns in the query.
+    """
+    result_schema, batches = record_batches(cursor, batch_rows)
+    options = pa.ipc.IpcWriteOptions(compression="zstd")
+    total = 0
+    with pa.ipc.new_stream(out, result_schema, options=options) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+            total += batch.num_rows
+    return total
+
+
+def read_table(cursor, batch_rows=ARROW_BATCH_ROWS):
+    """Return the rows of an executed query as a table, typed like write_arrow().
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the executed query.
+        batch_rows (int): Rows per record batch.
+
+    Returns:
+        pyarrow.Table: The result.
+    """
+    result_schema, batches = record_batches(cursor, batch_rows)
+    return pa.Table.from_batches(list(batches), schema=result_schema)
+
+
+def main():
+    """Run the query from stdin and print the rows."""
+    parser = argparse.ArgumentParser(description="Query the collector database including archived days.")
+    parser.add_argument("--db", default=schema.DB_PATH, help="Path to the collector database.")
+    parser.add_argument("--archive-dir", default=archive.ARCHIVE_DIR, help="Root directory of the archive.")
+    parser.add_argument("--start", help="Start of the query range (epoch or local time).")
+    parser.add_argument("--end", help="End of the query range (epoch or local time).")
+    parser.add_argument("--format", choices=["text", "arrow"], default="text", help="Output format.")
+    parser.add_argument("--query", help="Run this named query of queries.py; stdin holds its JSON parameters.")
+    parser.add_argument("--timeout", type=float, help="Stop the query after this many seconds.")
+    parser.add_argument("--max-load-rows", type=int, default=LOAD_MAX_ROWS,
+                        help="Stop the query if it needs more archived rows than this.")
+    args = parser.parse_args()
+    if (args.start is None) != (args.end is None):
+        parser.error("--start and --end go together.")
+
+    query = sys.stdin.read()
+    stdout = sys.stdout.fileno()
+    try:
+        conn = open_readonly(args.db)
+        with limits(conn, args.timeout, lambda: pipe_closed(stdout)):
+            if args.query is not None:
+                cursor = execute_named(conn, args.query, json.loads(query or "{}"), args.archive_dir,
+                                       args.max_load_rows)
+            else:
+                if args.start is not None:
+                    shadow_archived(conn, archive.to_epoch(conn, args.start), archive.to_epoch(conn, args.end),
+                                    args.archive_dir, query, max_rows=args.max_load_rows)
+                cursor = conn.execute(query)
+            if args.format == "arrow":
+                write_arrow(cursor, sys.stdout.buffer)
+                sys.stdout.buffer.flush()
+                return
+            out = sys.stdout
+            for row in cursor:
+                out.write("|".join("" if value is None else str(value) for value in row))
+                out.write("\n")
+    except QueryStopped as e:
+        print(f"Query stopped: {e}.", file=sys.stderr)
+        sys.exit(EXIT_STOPPED)
+    except (sqlite3.Error, OSError, pa.ArrowException, KeyError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""
+rollups.py
+
+Delay aggregates maintained by the collector while snapshots arrive, so that
+the Delay Dashboard does not have to aggregate raw positions.
+
+Table delay_rollups holds one row per
+    level (trip, route or route type), bucket width (minute, 5 minutes,
+    hour, day), bucket start, key of the trip/route/route type and delay band
+with the count, sum, min and max of the delay and the first and last
+timestamp of the rows in it. Bucket starts are epoch seconds aligned to the
+local time of the collector, like the timestamps shown by the views.
+
+Only rows the dashboard looks at are rolled up: delays between 0 and
+MAX_DELAY seconds of positions tagged with the Prague tariff zone P.
+Delay bands start at the edges in DELAY_BANDS, so every dashboard threshold
+that is a band edge (e.g. the default of 60 s) is answered exactly.
+
+Usage:
+    python rollups.py backfill --start 2025-05-01 --end 2025-05-31
+    Recomputes the rollups of whole days from the raw positions. Rows stored
+    before zone tagging only count once `python zones.py backfill` has run.
+"""
+
+import argparse
+import bisect
+import logging
+import sqlite3
+from datetime import datetime, date, timedelta
+
+import schema
+import zones
+
+logger = logging.getLogger(__name__)
+
+# upper bound of the delays the dashboard considers
+MAX_DELAY = 7200
+# lower edges of the delay bands in seconds
+DELAY_BANDS = [0, 60, 180, 300, 600, 1800, 3600]
+# bucket widths in seconds
+BUCKETS = {"minute": 60, "5min": 300, "hour": 3600, "day": 86400}
+LEVEL_TRIP = 0
+LEVEL_ROUTE = 1
+LEVEL_ROUTE_TYPE = 2
+
+
+def create_rollup_table(conn):
+    """Create the delay_rollups table if it does not exist.
+
+    Args:
+        conn (sqlite3.Connection): Writable connection.
+    """
+    conn.execute("""CREATE TABLE IF NOT EXISTS delay_rollups (
+                        level INTEGER NOT NULL,
+                        bucket INTEGER NOT NULL,
+                        start INTEGER NOT NULL,
+                        key INTEGER NOT NULL,
+                        band INTEGER NOT NULL,
+                        route INTEGER,
+                        route_type INTEGER,
+                        vehicle INTEGER,
+                        n INTEGER NOT NULL,
+                        total REAL NOT NULL,
+                        min_delay REAL,
+                        max_delay REAL,
+                        first_ts INTEGER,
+                        last_ts INTEGER,
+                        PRIMARY KEY (level, bucket, start, key, band)) WITHOUT ROWID""")
+
+
+def bucket_start(ts, width):
+    """Return the start of the local-time bucket containing ts.
+
+    Args:
+        ts (int): Epoch seconds.
+        width (int): Bucket width in seconds (60, 300, 3600 or 86400).
+
+    Returns:
+        int: Epoch seconds of the bucket start.
+    """
+    local = datetime.fromtimestamp(ts)
+    if width >= 86400:
+        local = local.replace(hour=0, minute=0, second=0, microsecond=0)
+    else:
+        seconds = local.hour * 3600 + local.minute * 60 + local.second
+        seconds -= seconds % width
+        local = local.replace(hour=seconds // 3600, minute=seconds % 3600 // 60, second=0, microsecond=0)
+    return int(local.timestamp())
+
+
+class RollupWriter:
+    """Adds every snapshot to the delay rollups.
+
+    Attributes:
+        conn (sqlite3.Connection): The collector's writer connection.
+    """
+    def __init__(self, conn):
+        """Initialize the RollupWriter.
+
+        Args:
+            conn (sqlite3.Connection): The collector's writer connection.
+        """
+        self.conn = conn
+        create_rollup_table(conn)
+
+    def add_snapshot(self, ts, rows):
+        """Aggregate one snapshot and merge it into all rollup buckets.
+
+        Args:
+            ts (int): Snapshot time in epoch seconds.
+            rows (list[tuple]): All rows of the snapshot in positions layout.
+
+        Returns:
+            int: Number of rollup rows touched.
+        """
+        groups = {}
+        self.aggregate(rows, groups)
+        return self.merge(ts, groups)
+
+    def aggregate(self, rows, groups):
+        """Add rows to the per-(level, key, band) groups of a snapshot.
+
+        Lets a snapshot that arrives in chunks be aggregated chunk by chunk
+        and merged once with merge().
+
+        Args:
+            rows (list[tuple]): Rows of the snapshot in positions layout.
+            groups (dict): Groups of the snapshot, updated in place.
+        """
+        for _, vehicle, trip, route, route_type, _, _, delay, _, _, zone, *_ in rows:
+            if zone != zones.ZONE_P or delay is None or not 0 <= delay <= MAX_DELAY:
+                continue
+            band = DELAY_BANDS[bisect.bisect_right(DELAY_BANDS, delay) - 1]
+            for level, key in ((LEVEL_TRIP, trip), (LEVEL_ROUTE, route), (LEVEL_ROUTE_TYPE, route_type)):
+                if key is None:
+                    continue
+                group = groups.get((level, key, band))
+                if group is None:
+                    groups[(level, key, band)] = [route, route_type, vehicle, 1, delay, delay, delay]
+                else:
+                    group[3] += 1
+                    group[4] += delay
+                    group[5] = min(group[5], delay)
+                    group[6] = max(group[6], delay)
+
+    def merge(self, ts, groups):
+        """Merge the groups of one snapshot into all rollup buckets.
+
+        Args:
+            ts (int): Snapshot time in epoch seconds.
+            groups (dict): Groups filled by aggregate().
+
+        Returns:
+            int: Number of rollup rows touched.
+        """
+        values = []
+        for width in BUCKETS.values():
+            start = bucket_start(ts, width)
+            for (level, key, band), (route, route_type, vehicle, n, total, low, high) in groups.items():
+                values.append((level, width, start, key, band, route, route_type, vehicle,
+                               n, total, low, high, ts, ts))
+        self.conn.executemany("""INSERT INTO delay_rollups (
+                                    level, bucket, start, key, band, route, route_type, vehicle,
+                                    n, total, min_delay, max_delay, first_ts, last_ts)
+                                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                                 ON CONFLICT (level, bucket, start, key, band) DO UPDATE SET
+                                    n = n + excluded.n,
+                                    total = total + excluded.total,
+                                    min_delay = MIN(min_delay, excluded.min_delay),
+                                    max_delay = MAX(max_delay, excluded.max_delay),
+                                    first_ts = MIN(first_ts, excluded.first_ts),
+                                    last_ts = MAX(last_ts, excluded.last_ts),
+                                    vehicle = excluded.vehicle""", values)
+        return len(values)
+
+
+def backfill(conn, start_day, end_day):
+    """Recompute the rollups of whole days from the stored positions.
+
+    Existing rollups of these days are replaced, so running it twice is safe.
+
+    Args:
+        conn (sqlite3.Connection): Writable connection to the collector database.
+        start_day (date): First day to recompute.
+        end_day (date): Last day to recompute (inclusive).
+    """
+    writer = RollupWriter(conn)
+    encoder = schema.Encoder(conn)
+    day = start_day
+    while day <= end_day:
+        day_start = int(datetime.combine(day, datetime.min.time()).timestamp())
+        day_end = int(datetime.combine(day + timedelta(days=1), datetime.min.time()).timestamp())
+        conn.execute("DELETE FROM delay_rollups WHERE start >= ? AND start < ?", (day_start, day_end))
+        # vehicle_positions_full reconstructs delta snapshots, so both storage modes work
+        snapshots = {}
+        for row in conn.execute("""SELECT vehicle_id, gtfs_trip_id, route_type, gtfs_route_short_name,
+                                          bearing, delay, latitude, longitude, state_position, ts, zone
+                                   FROM vehicle_positions_full
+                                   WHERE ts >= ? AND ts < ?""", (day_start, day_end)):
+            snapshots.setdefault(row[9], []).append(encoder.encode_row(row[:10], row[10]))
+        for ts in sorted(snapshots):
+            writer.add_snapshot(ts, snapshots[ts])
+        conn.commit()
+        print(f"{day}: rolled up {len(snapshots)} snapshots.")
+        day += timedelta(days=1)
+
+
+def main():
+    """Command line entry point for backfilling rollups."""
+    parser = argparse.ArgumentParser(description="Delay rollups of the vehicle positions database.")
+    parser.add_argument("command", choices=["backfill"])
+    parser.add_argument("--db", default=schema.DB_PATH, help="Path to the collector database.")
+    parser.add_argument("--start", required=True, type=date.fromisoformat, help="First day (YYYY-MM-DD).")
+    parser.add_argument("--end", required=True, type=date.fromisoformat, help="Last day (YYYY-MM-DD).")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    conn.execute(f"PRAGMA busy_timeout={schema.MAINTENANCE_BUSY_TIMEOUT_MS}")
+    backfill(conn, args.start, args.end)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
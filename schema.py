@@ -0,0 +1,535 @@
+"""
+schema.py
+
+Compact storage schema of the collector database (vehicle_positions.db) and
+the online migration of databases written with the original text schema.
+
+Layout:
+- positions: one row per stored vehicle position. Timestamps are epoch
+  seconds (ts), coordinates are integer micro-degrees (lat_e6, lon_e6) and
+  all repeated strings are small integer keys into dictionary tables.
+  zone is the tariff zone id of the position, tagged at ingest (see zones.py);
+  stop, station and stop_dist are the nearest stop, its parent station and
+  the distance to it in metres, assigned at ingest (see stop_index.py).
+- vehicles, trips, route_names, route_types, states, stop_ids, stations:
+  dictionary tables mapping the integer keys back to the original strings.
+- gtfs_stops, gtfs_stops_state: the static GTFS stops the nearest stop is
+  chosen from, and their version (see stop_index.py).
+- snapshots: one row per collector snapshot with its keyframe (see server.py).
+- vehicle_positions (view): the old table with the old column names, for
+  existing scripts and ad-hoc queries.
+- vehicle_positions_full (view): the complete time series with the old
+  column names plus the integer ts. Range queries should filter on ts.
+
+Indexes:
+    INDEXES lists the indexes on positions, each one serving a query of the
+    dashboard or the stops page (see PLAN_CHECKS). The collector creates them
+    on startup, and check_query_plans() raises QueryPlanError if a query no
+    longer uses its index or falls back to a full scan of positions.
+
+Migration:
+    Starting the new collector renames an old vehicle_positions table to
+    vehicle_positions_legacy (a metadata-only change) and writes new snapshots
+    in the compact layout right away. The views include legacy rows that are
+    not migrated yet, so readers see the full history at any time.
+
+    python schema.py migrate     # copy legacy rows in small batches, resumable
+    python schema.py status      # show migration progress
+    python schema.py check       # verify that the shipped queries use their indexes
+
+    Each batch is a short transaction, so the collector and the dashboard keep
+    running. Delta-mode history (STORAGE_MODE=delta) is only reconstructed
+    completely once its rows are migrated. After the migration, run VACUUM
+    once in a quiet moment to give the freed space back to the file system.
+"""
+
+import argparse
+import logging
+import sqlite3
+import time
+
+DB_PATH = "vehicle_positions.db"
+# tools that write next to the running collector wait this long for a lock;
+# the collector keeps its transaction open for up to server.COMMIT_MAX_SECONDS
+MAINTENANCE_BUSY_TIMEOUT_MS = 120000
+SCHEMA_VERSION = 4
+LEGACY_TABLE = "vehicle_positions_legacy"
+# rows copied per migration transaction
+MIGRATION_BATCH = 50000
+# state_position of tombstone rows (must match server.GONE_STATE)
+GONE_STATE = "gone"
+
+logger = logging.getLogger(__name__)
+
+# (table, column) of every dictionary-encoded attribute, keyed by the positions column
+DICTIONARIES = {
+    "vehicle": ("vehicles", "vehicle_id"),
+    "trip": ("trips", "gtfs_trip_id"),
+    "route": ("route_names", "route_short_name"),
+    "route_type": ("route_types", "route_type"),
+    "state": ("states", "state_position"),
+    "stop": ("stop_ids", "stop_id"),
+    "station": ("stations", "parent_station"),
+}
+# dictionaries with a column in the legacy table
+LEGACY_DICTIONARIES = ["vehicle", "trip", "route", "route_type", "state"]
+
+# decoded column list of the compatibility views, {ts} is the epoch expression
+_DECODED_COLUMNS = """
+    vehicles.vehicle_id AS vehicle_id,
+    trips.gtfs_trip_id AS gtfs_trip_id,
+    route_types.route_type AS route_type,
+    route_names.route_short_name AS gtfs_route_short_name,
+    p.bearing AS bearing,
+    p.delay AS delay,
+    p.lat_e6 / 1e6 AS latitude,
+    p.lon_e6 / 1e6 AS longitude,
+    states.state_position AS state_position,
+    p.zone AS zone,
+    stop_ids.stop_id AS stop_id,
+    stations.parent_station AS parent_station,
+    p.stop_dist AS stop_distance,
+    datetime({ts}, 'unixepoch', 'localtime') AS timestamp"""
+
+_DICTIONARY_JOINS = """
+    LEFT JOIN vehicles ON vehicles.id = p.vehicle
+    LEFT JOIN trips ON trips.id = p.trip
+    LEFT JOIN route_names ON route_names.id = p.route
+    LEFT JOIN route_types ON route_types.id = p.route_type
+    LEFT JOIN states ON states.id = p.state
+    LEFT JOIN stop_ids ON stop_ids.id = p.stop
+    LEFT JOIN stations ON stations.id = p.station"""
+
+_LEGACY_COLUMNS = """
+    vehicle_id, gtfs_trip_id, route_type, gtfs_route_short_name, bearing, delay,
+    latitude, longitude, state_position, NULL AS zone,
+    NULL AS stop_id, NULL AS parent_station, NULL AS stop_distance, timestamp"""
+
+# legacy rows that the migration has not copied yet
+_LEGACY_PENDING = f"""
+    FROM {LEGACY_TABLE}
+    WHERE rowid > (SELECT legacy_rowid FROM migration_state)"""
+
+
+# name -> (definition, only needed in delta mode)
+INDEXES = {
+    # time range of the stop throughput and of the dashboard trip delays, whose
+    # zone filter is tested in the index before the row is read; leading with ts
+    # keeps the plans of vehicle_positions_full independent of table statistics
+    "idx_positions_ts_zone": ("positions(ts, zone)", False),
+    # at_stop rows in a time range for the dwell time analysis
+    "idx_positions_state_ts": ("positions(state, ts)", False),
+    # latest row of a vehicle before a snapshot, used by the delta reconstruction
+    "idx_positions_vehicle": ("positions(vehicle, ts)", True),
+}
+
+# indexes of older schema versions, dropped once their replacement exists
+RETIRED_INDEXES = {
+    "idx_positions_ts": "idx_positions_ts_zone",
+}
+
+# Access patterns of the shipped queries (pages/dashboard.py and pages/stops.py)
+# and the index each of them must use. :start and :end are epoch seconds.
+PLAN_CHECKS = {
+    "dashboard trip delays": ("idx_positions_ts_zone", """
+        SELECT gtfs_trip_id, vehicle_id, route_type, gtfs_route_short_name,
+               AVG(delay) AS delay, datetime(MIN(ts), 'unixepoch', 'localtime') AS first_timestamp
+        FROM vehicle_positions_full
+        WHERE delay IS NOT NULL AND route_type <> 2
+          AND ts BETWEEN :start AND :end
+          AND zone = 1
+          AND delay BETWEEN 60 AND 7200
+        GROUP BY gtfs_trip_id"""),
+    "stops dwell time": ("idx_positions_state_ts", """
+        SELECT vehicle_id, gtfs_trip_id, route_type, latitude, longitude, parent_station, timestamp
+        FROM vehicle_positions_full
+        WHERE state_position = 'at_stop' AND ts BETWEEN :start AND :end
+        ORDER BY vehicle_id, ts"""),
+    "stops throughput": ("idx_positions_ts_zone", """
+        SELECT vehicle_id, gtfs_trip_id, route_type, latitude, longitude, parent_station, timestamp
+        FROM vehicle_positions_full
+        WHERE ts BETWEEN :start AND :end
+        ORDER BY vehicle_id, ts"""),
+}
+
+
+class QueryPlanError(RuntimeError):
+    """Raised when a shipped query no longer uses its index."""
+
+
+def _table_type(conn, name):
+    """Return 'table', 'view' or None for a schema object name."""
+    row = conn.execute("SELECT type FROM sqlite_master WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else None
+
+
+def create_tables(conn):
+    """Create the compact tables if they do not exist.
+
+    Args:
+        conn (sqlite3.Connection): Writable connection.
+    """
+    for table, column in DICTIONARIES.values():
+        conn.execute(f"""CREATE TABLE IF NOT EXISTS {table} (
+                            id INTEGER PRIMARY KEY,
+                            {column} TEXT NOT NULL UNIQUE)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS positions (
+                        ts INTEGER NOT NULL,
+                        vehicle INTEGER,
+                        trip INTEGER,
+                        route INTEGER,
+                        route_type INTEGER,
+                        state INTEGER,
+                        bearing INTEGER,
+                        delay INTEGER,
+                        lat_e6 INTEGER,
+                        lon_e6 INTEGER,
+                        zone INTEGER,
+                        stop INTEGER,
+                        station INTEGER,
+                        stop_dist INTEGER)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS snapshots (
+                        ts INTEGER PRIMARY KEY,
+                        keyframe_ts INTEGER NOT NULL,
+                        vehicles INTEGER,
+                        stored INTEGER)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS gtfs_stops (
+                        stop_id TEXT PRIMARY KEY,
+                        stop_name TEXT,
+                        parent_station TEXT,
+                        location_type INTEGER,
+                        latitude REAL,
+                        longitude REAL)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS gtfs_stops_state (
+                        version INTEGER NOT NULL,
+                        refreshed_at TEXT NOT NULL)""")
+
+
+def add_columns(conn):
+    """Add the columns of newer schema versions to an existing positions table.
+
+    ADD COLUMN only changes the table definition, existing rows read as NULL
+    until they are tagged (see zones.py and stop_index.py backfill).
+
+    Args:
+        conn (sqlite3.Connection): Writable connection.
+    """
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(positions)")}
+    if "zone" not in columns:
+        conn.execute("ALTER TABLE positions ADD COLUMN zone INTEGER")
+        logger.info("Added column positions.zone, run `python zones.py backfill` to tag old rows.")
+    if "stop" not in columns:
+        for column in ("stop", "station", "stop_dist"):
+            conn.execute(f"ALTER TABLE positions ADD COLUMN {column} INTEGER")
+        logger.info("Added columns positions.stop, station and stop_dist, "
+                    "run `python stop_index.py backfill` to assign old rows.")
+
+
+def create_views(conn):
+    """(Re)create the compatibility views.
+
+    While a legacy table is being migrated, the views also return its rows
+    that have not been copied yet.
+
+    Args:
+        conn (sqlite3.Connection): Writable connection.
+    """
+    legacy = _table_type(conn, LEGACY_TABLE) == "table"
+    conn.execute("DROP VIEW IF EXISTS vehicle_positions")
+    conn.execute("DROP VIEW IF EXISTS vehicle_positions_full")
+
+    compat = f"SELECT {_DECODED_COLUMNS.format(ts='p.ts')}\nFROM positions AS p{_DICTIONARY_JOINS}"
+    if legacy:
+        compat += f"\nUNION ALL\nSELECT {_LEGACY_COLUMNS}{_LEGACY_PENDING}"
+    conn.execute(f"CREATE VIEW vehicle_positions AS {compat}")
+
+    # rows of keyframes are complete; every delta snapshot takes the latest row
+    # of each vehicle since its keyframe, tombstones hide vehicles that left
+    full = f"""SELECT {_DECODED_COLUMNS.format(ts='p.ts')}, p.ts AS ts
+FROM positions AS p{_DICTIONARY_JOINS}
+WHERE p.ts NOT IN (SELECT ts FROM snapshots WHERE keyframe_ts <> ts)
+UNION ALL
+SELECT {_DECODED_COLUMNS.format(ts='s.ts')}, s.ts AS ts
+FROM snapshots AS s
+JOIN positions AS p ON p.ts BETWEEN s.keyframe_ts AND s.ts{_DICTIONARY_JOINS}
+WHERE s.keyframe_ts <> s.ts
+  AND states.state_position IS NOT '{GONE_STATE}'
+  AND NOT EXISTS (
+      SELECT 1 FROM positions AS n
+      WHERE n.vehicle = p.vehicle
+        AND n.ts > p.ts
+        AND n.ts <= s.ts)"""
+    if legacy:
+        full += f"""
+UNION ALL
+SELECT {_LEGACY_COLUMNS}, CAST(strftime('%s', timestamp, 'utc') AS INTEGER) AS ts{_LEGACY_PENDING}
+  AND state_position IS NOT '{GONE_STATE}'"""
+    conn.execute(f"CREATE VIEW vehicle_positions_full AS {full}")
+
+
+def ensure_schema(conn):
+    """Bring a database to the compact schema.
+
+    Creates missing tables and views. An old vehicle_positions table is renamed
+    to vehicle_positions_legacy and registered for the migration; old
+    position_snapshots are converted right away (they are small).
+
+    Args:
+        conn (sqlite3.Connection): Writable connection.
+    """
+    create_tables(conn)
+    add_columns(conn)
+    if _table_type(conn, "vehicle_positions") == "table":
+        last_rowid = conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM vehicle_positions").fetchone()[0]
+        conn.execute("DROP VIEW IF EXISTS vehicle_positions_full")
+        conn.execute(f"ALTER TABLE vehicle_positions RENAME TO {LEGACY_TABLE}")
+        conn.execute("""CREATE TABLE IF NOT EXISTS migration_state (
+                            legacy_rowid INTEGER NOT NULL,
+                            last_rowid INTEGER NOT NULL)""")
+        conn.execute("INSERT INTO migration_state (legacy_rowid, last_rowid) VALUES (0, ?)", (last_rowid,))
+        logger.info(f"Renamed vehicle_positions to {LEGACY_TABLE}, {last_rowid} rows to migrate.")
+    if _table_type(conn, "position_snapshots") == "table":
+        conn.execute("""INSERT OR IGNORE INTO snapshots (ts, keyframe_ts, vehicles, stored)
+                        SELECT CAST(strftime('%s', timestamp, 'utc') AS INTEGER),
+                               CAST(strftime('%s', keyframe_timestamp, 'utc') AS INTEGER),
+                               vehicles, stored
+                        FROM position_snapshots""")
+        conn.execute("DROP TABLE position_snapshots")
+    create_views(conn)
+    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    conn.commit()
+
+
+class Encoder:
+    """Maps the repeated strings of a snapshot to dictionary keys.
+
+    Keys are cached in memory, so only values that were never seen before
+    cost a database round trip.
+
+    Attributes:
+        conn (sqlite3.Connection): Writable connection.
+        cache (dict): Per positions column, a mapping from string to key.
+    """
+    def __init__(self, conn):
+        """Initialize the Encoder and load the existing dictionaries.
+
+        Args:
+            conn (sqlite3.Connection): Writable connection.
+        """
+        self.conn = conn
+        self.cache = {}
+        for key, (table, column) in DICTIONARIES.items():
+            self.cache[key] = dict(conn.execute(f"SELECT {column}, id FROM {table}"))
+
+    def encode(self, key, value):
+        """Return the dictionary key of a value, adding the value if it is new.
+
+        Args:
+            key (str): Column of positions, e.g. 'trip'.
+            value: The string (or number) to encode; None stays None.
+
+        Returns:
+            int or None: The dictionary key.
+        """
+        if value is None:
+            return None
+        value = str(value)
+        cache = self.cache[key]
+        ident = cache.get(value)
+        if ident is None:
+            table, column = DICTIONARIES[key]
+            self.conn.execute(f"INSERT OR IGNORE INTO {table} ({column}) VALUES (?)", (value,))
+            ident = self.conn.execute(f"SELECT id FROM {table} WHERE {column} = ?", (value,)).fetchone()[0]
+            cache[value] = ident
+        return ident
+
+    def encode_row(self, row, zone=None, stop=None):
+        """Convert a parsed row into a positions row.
+
+        Args:
+            row (tuple): (vehicle_id, gtfs_trip_id, route_type, gtfs_route_short_name,
+                bearing, delay, latitude, longitude, state_position, ts)
+            zone (int, optional): Tariff zone id of the position (see zones.py).
+            stop (tuple, optional): (stop_id, parent_station, distance in metres)
+                of the nearest stop (see stop_index.py).
+
+        Returns:
+            tuple: Values in the column order of positions.
+        """
+        vehicle_id, trip_id, route_type, short_name, bearing, delay, lat, lon, state, ts = row
+        stop_id, station, stop_dist = stop or (None, None, None)
+        return (
+            ts,
+            self.encode("vehicle", vehicle_id),
+            self.encode("trip", trip_id),
+            self.encode("route", short_name),
+            self.encode("route_type", route_type),
+            self.encode("state", state),
+            bearing,
+            delay,
+            None if lat is None else round(lat * 1e6),
+            None if lon is None else round(lon * 1e6),
+            zone,
+            self.encode("stop", stop_id),
+            self.encode("station", station),
+            stop_dist,
+        )
+
+
+def ensure_indexes(conn, delta=False):
+    """Create the managed indexes if they do not exist.
+
+    Retired indexes are dropped once their replacement exists.
+
+    Args:
+        conn (sqlite3.Connection): Writable connection.
+        delta (bool): Also create the indexes only needed in delta mode.
+    """
+    for name, (definition, delta_only) in INDEXES.items():
+        if delta or not delta_only:
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}")
+    for name, replacement in RETIRED_INDEXES.items():
+        if _table_type(conn, replacement) == "index":
+            conn.execute(f"DROP INDEX IF EXISTS {name}")
+    # refresh planner statistics where they are missing or outdated
+    conn.execute("PRAGMA optimize")
+    conn.commit()
+
+
+def check_query_plans(conn):
+    """Verify that every query in PLAN_CHECKS uses its index.
+
+    A plan fails if the expected index does not appear or if positions is
+    scanned without an index.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the collector database.
+
+    Raises:
+        QueryPlanError: Lists every query with a bad plan and its plan.
+    """
+    params = {"start": 0, "end": 86400}
+    failures = []
+    # plan on a fresh connection: cached EXPLAIN statements are not re-planned after schema changes
+    path = conn.execute("PRAGMA database_list").fetchone()[2]
+    planner = sqlite3.connect(f"file:{path}?mode=ro", uri=True) if path else conn
+    for name, (index, sql) in PLAN_CHECKS.items():
+        plan = [row[3] for row in planner.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+        full_scan = [step for step in plan if step in ("SCAN p", "SCAN positions")]
+        if full_scan or not any(f"USING INDEX {index} " in step for step in plan):
+            failures.append(f"{name} (expected {index}):\n    " + "\n    ".join(plan))
+    if planner is not conn:
+        planner.close()
+    if failures:
+        raise QueryPlanError("Queries not using their index:\n  " + "\n  ".join(failures))
+
+
+def migration_status(conn):
+    """Return (migrated rowid, last legacy rowid) or None if nothing is pending."""
+    if _table_type(conn, "migration_state") != "table":
+        return None
+    return conn.execute("SELECT legacy_rowid, last_rowid FROM migration_state").fetchone()
+
+
+def migrate_batch(conn, batch_size=MIGRATION_BATCH):
+    """Copy the next batch of legacy rows into the compact tables.
+
+    The batch and the progress marker are committed together, so an
+    interrupted migration resumes where it stopped.
+
+    Args:
+        conn (sqlite3.Connection): Writable connection.
+        batch_size (int): Legacy rowids per transaction.
+
+    Returns:
+        bool: True if more rows are left.
+    """
+    done, last = migration_status(conn)
+    upper = min(done + batch_size, last)
+    batch = f"FROM {LEGACY_TABLE} WHERE rowid > ? AND rowid <= ?"
+    for key in LEGACY_DICTIONARIES:
+        table, column = DICTIONARIES[key]
+        legacy_column = "gtfs_route_short_name" if key == "route" else column
+        conn.execute(f"""INSERT OR IGNORE INTO {table} ({column})
+                         SELECT DISTINCT CAST({legacy_column} AS TEXT) {batch} AND {legacy_column} IS NOT NULL""",
+                     (done, upper))
+    conn.execute(f"""INSERT INTO positions (ts, vehicle, trip, route, route_type, state,
+                                            bearing, delay, lat_e6, lon_e6)
+                     SELECT CAST(strftime('%s', l.timestamp, 'utc') AS INTEGER),
+                            vehicles.id, trips.id, route_names.id, route_types.id, states.id,
+                            l.bearing, l.delay,
+                            CAST(round(l.latitude * 1e6) AS INTEGER),
+                            CAST(round(l.longitude * 1e6) AS INTEGER)
+                     FROM {LEGACY_TABLE} AS l
+                     LEFT JOIN vehicles ON vehicles.vehicle_id = CAST(l.vehicle_id AS TEXT)
+                     LEFT JOIN trips ON trips.gtfs_trip_id = CAST(l.gtfs_trip_id AS TEXT)
+                     LEFT JOIN route_names ON route_names.route_short_name = CAST(l.gtfs_route_short_name AS TEXT)
+                     LEFT JOIN route_types ON route_types.route_type = CAST(l.route_type AS TEXT)
+                     LEFT JOIN states ON states.state_position = CAST(l.state_position AS TEXT)
+                     WHERE l.rowid > ? AND l.rowid <= ?""", (done, upper))
+    conn.execute("UPDATE migration_state SET legacy_rowid = ?", (upper,))
+    conn.commit()
+    return upper < last
+
+
+def finish_migration(conn):
+    """Drop the legacy table once all rows are copied and simplify the views."""
+    conn.execute(f"DROP TABLE {LEGACY_TABLE}")
+    conn.execute("DROP TABLE migration_state")
+    create_views(conn)
+    conn.commit()
+    logger.info("Migration finished, legacy table dropped.")
+
+
+def migrate(conn, batch_size=MIGRATION_BATCH, pause=0.1):
+    """Migrate all legacy rows in short transactions.
+
+    Args:
+        conn (sqlite3.Connection): Writable connection.
+        batch_size (int): Legacy rowids per transaction.
+        pause (float): Seconds to sleep between batches to let the collector write.
+    """
+    ensure_schema(conn)
+    status = migration_status(conn)
+    if status is None:
+        print("Nothing to migrate.")
+        return
+    while migrate_batch(conn, batch_size):
+        done, last = migration_status(conn)
+        print(f"Migrated {done}/{last} rows.")
+        time.sleep(pause)
+    finish_migration(conn)
+    print("Migration finished. Run `python zones.py backfill` and `python stop_index.py backfill` "
+          "to tag the migrated rows and VACUUM in a quiet moment to shrink the file.")
+
+
+def main():
+    """Command line entry point: migrate, show the migration status or check query plans."""
+    parser = argparse.ArgumentParser(description="Compact schema of the vehicle positions database.")
+    parser.add_argument("command", choices=["migrate", "status", "check"])
+    parser.add_argument("--db", default=DB_PATH, help="Path to the collector database.")
+    parser.add_argument("--batch", type=int, default=MIGRATION_BATCH, help="Rows per transaction.")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    conn.execute(f"PRAGMA busy_timeout={MAINTENANCE_BUSY_TIMEOUT_MS}")
+    if args.command == "migrate":
+        migrate(conn, args.batch)
+    elif args.command == "check":
+        try:
+            check_query_plans(conn)
+        except QueryPlanError as e:
+            print(e)
+            raise SystemExit(1)
+        print("All shipped queries use their indexes.")
+    else:
+        status = migration_status(conn)
+        if status is None:
+            print(f"Schema version {conn.execute('PRAGMA user_version').fetchone()[0]}, no migration pending.")
+        else:
+            print(f"Migrated {status[0]}/{status[1]} legacy rows.")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
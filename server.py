@@ -12,7 +12,7 @@ Intend as gather buffer for delay data.
 
 Prerequisites:
 - API_KEY stored in a .env file
-- Required libraries: requests, python-dotenv
+- Required libraries: requests, ijson, python-dotenv
 
 Usage:
 1. Save your API key in the .env file (API_KEY=your_api_key)
@@ -20,10 +20,73 @@ Usage:
 3. Stop with CTRL+C
 
 Functions:
-- create_table(): Creates the SQLite table if it doesn't exist
+- open_writer(): Opens the long-lived WAL writer connection
+- open_reader(): Opens a read-only connection that never blocks the writer
+- create_table(): Creates the SQLite tables if they don't exist (compact schema, see schema.py)
 - get_vehicle_positions(): Retrieves JSON data from the API
+- fetch_snapshot(): Streams the gzip-compressed payload into a spool file
 - store_vehicle_positions(data): Stores the data in the database
-- main(): Main loop that periodically fetches and saves data
+- store_vehicle_stream(stream): Parses a payload incrementally into chunked inserts
+- run_pipeline(): Asyncio pipeline (scheduler -> fetch -> parse and write)
+- main(): Runs the pipeline until CTRL+C
+
+Storage modes (STORAGE_MODE):
+- full (default): every snapshot stores one row per vehicle.
+- delta: only rows that changed since the vehicle's last snapshot are stored,
+  plus a full keyframe every KEYFRAME_EVERY snapshots. Query the view
+  vehicle_positions_full to get the complete time series in either mode.
+
+Zones:
+- Every row is tagged with the tariff zone of its position (column zone,
+  1 = Prague zone P), tested per chunk against the prepared polygons of
+  zones.py. Queries filter on the indexed zone instead of a bounding box.
+- Every row also gets its nearest stop, parent station and the distance to
+  the stop from a k-d tree over the static stops (table gtfs_stops, loaded
+  with `python stop_index.py refresh`). The tree is rebuilt when the stops
+  are refreshed, so analyses group by the stored stop instead of matching.
+
+Visits:
+- A per-vehicle state machine turns the at_stop rows into stop visits
+  (vehicle, trip, stop, arrival, departure, dwell time) and writes each one
+  to stop_visits once it is finished (see visits.py), so the stops analyses
+  read visits instead of sessionizing raw positions.
+
+Rollups:
+- Each snapshot also updates the delay aggregates in delay_rollups
+  (per minute, 5 minutes, hour and day; see rollups.py), which the
+  Delay Dashboard reads instead of scanning raw positions.
+
+Metrics:
+- Throughput and health metrics (API latency, payload size, parse and insert
+  time, rows per snapshot, missed ticks, database and WAL size, last tick) are
+  served in the Prometheus text format on 127.0.0.1:METRICS_PORT/metrics and
+  written to METRICS_TEXTFILE after every snapshot; see metrics.py.
+
+Recording:
+- With RECORD_DIR set, every raw API payload is appended to a compressed
+  per-day file; `python recorder.py replay` feeds recorded days into a
+  scratch database at N times the speed (see recorder.py).
+
+Retention:
+- Raw positions older than RETENTION_DAYS are moved to a Parquet archive by
+  `python maintenance.py run` (e.g. nightly from cron) while the collector
+  keeps running; see maintenance.py.
+
+Scheduling:
+- Snapshots are taken on fixed wall-clock ticks every SNAPSHOT_INTERVAL seconds
+  and stamped with the tick time, so the spacing does not drift with request
+  or write time. The stages are connected by bounded queues; if a stage falls
+  behind, ticks are dropped and logged instead of piling up.
+- The payload is fetched gzip-compressed and streamed into a spool file, then
+  parsed incrementally with ijson and inserted in chunks of INSERT_CHUNK_ROWS,
+  so memory stays flat regardless of the number of vehicles.
+
+Database:
+- The collector keeps one writer connection open for its whole lifetime.
+  The database runs in WAL mode, so readers (dashboard queries over SSH)
+  and the writer do not block each other.
+- Snapshots are committed in batches: at most COMMIT_MAX_SNAPSHOTS snapshots
+  or COMMIT_MAX_SECONDS seconds are kept in one open transaction.
 
 Logging:
 - Logs events and errors to 'vehicle_positions.log'
@@ -34,15 +97,28 @@ TODO:
 """
 
 import requests
+import asyncio
+import ijson
+import math
 import time
 import sqlite3
+import archive
+import schema
+import rollups
+import visits
+import zones
+import stop_index
+import metrics
+import recorder
 import numpy as np
 import pandas as pd
 import os
+import tempfile
 import logging
 from dotenv import load_dotenv
 from datetime import datetime
 API_URL = "https://api.golemio.cz/v2/public/vehiclepositions"
+DB_PATH = schema.DB_PATH
 
 load_dotenv()
 API_KEY = os.getenv("API_KEY")
@@ -51,6 +127,30 @@ headers = {
     "X-Access-Token": API_KEY
 }
 
+# batched commits: flush after this many snapshots or seconds, whichever comes first
+COMMIT_MAX_SNAPSHOTS = int(os.getenv("COMMIT_MAX_SNAPSHOTS", "4"))
+COMMIT_MAX_SECONDS = float(os.getenv("COMMIT_MAX_SECONDS", "60"))
+# seconds between two snapshots, ticks are aligned to the wall clock
+SNAPSHOT_INTERVAL = 30
+# upper bound for one API request
+FETCH_TIMEOUT = 20
+# capacity of the queues between the pipeline stages
+QUEUE_SIZE = 2
+# payloads up to this size are spooled in memory, larger ones in a temporary file
+SPOOL_MAX_BYTES = int(os.getenv("SPOOL_MAX_BYTES", str(1024 * 1024)))
+# bytes read from the response at a time
+STREAM_CHUNK_BYTES = 64 * 1024
+# rows parsed before they are inserted with one executemany
+INSERT_CHUNK_ROWS = 500
+# "full" stores every row of every snapshot, "delta" only rows that changed
+STORAGE_MODE = os.getenv("STORAGE_MODE", "full")
+# delta mode: snapshots between two full keyframes (20 x 30 s = 10 min)
+KEYFRAME_EVERY = int(os.getenv("KEYFRAME_EVERY", "20"))
+# state_position of the tombstone row written when a vehicle disappears in delta mode
+GONE_STATE = schema.GONE_STATE
+# how long a connection waits for a lock before raising "database is locked"
+BUSY_TIMEOUT_MS = 5000
+
 
 logging.basicConfig(
     filename='gather.log',            
@@ -68,35 +168,334 @@ def add_timestamp(data):
 
 
 
+def open_writer(db_path=DB_PATH):
+    """Open the long-lived writer connection of the collector.
+
+    Switches the database to WAL mode so that readers never block the writer
+    (and vice versa) and tunes the connection for a steady insert workload.
+
+    Args:
+        db_path (str): Path to the SQLite database file.
+
+    Returns:
+        sqlite3.Connection: The configured writer connection.
+    """
+    # the pipeline writes from a worker thread, one write at a time
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    # only takes effect on a new database; lets maintenance.py return freed pages
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    # NORMAL is durable across application crashes in WAL mode, only a power loss
+    # can roll back the last commits
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-65536")  # 64 MiB page cache
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA wal_autocheckpoint=1000")
+    conn.execute("PRAGMA journal_size_limit=67108864")  # truncate the WAL to 64 MiB after checkpoints
+    return conn
+
+
+def open_reader(db_path=DB_PATH):
+    """Open a read-only connection for queries running next to the collector.
+
+    Read-only connections on a WAL database see the last committed state and
+    never take the write lock, so long analytic queries do not stall ingestion.
+
+    Args:
+        db_path (str): Path to the SQLite database file.
+
+    Returns:
+        sqlite3.Connection: A read-only connection.
+    """
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA query_only=ON")
+    return conn
+
+
+class PositionWriter:
+    """Keeps the writer connection open and commits snapshots in batches.
+
+    In delta mode only rows that differ from the vehicle's last stored state are
+    written. Every ``keyframe_every`` snapshots (and after each restart) a full
+    keyframe is stored, and vehicles that disappear get a tombstone row with
+    state_position ``GONE_STATE``. The view ``vehicle_positions_full`` rebuilds
+    the complete time series from keyframes and changes.
+
+    Rows are stored in the compact layout of schema.py; repeated strings are
+    dictionary-encoded by an in-memory Encoder, and every row is tagged with its
+    tariff zone (see zones.py) and its nearest stop (see stop_index.py). Every
+    complete snapshot is also added to the delay rollups (see rollups.py) and
+    advances the stop visits (see visits.py) in the same transaction.
+
+    A snapshot is written either at once with write() or in chunks while the
+    payload is still being parsed: begin(), add() per chunk, then end(), or
+    abort() to drop a snapshot whose payload turned out to be broken. Each
+    snapshot runs inside a savepoint, so an aborted one leaves the other
+    pending snapshots of the batch untouched.
+
+    Attributes:
+        db_path (str): Path to the SQLite database file.
+        conn (sqlite3.Connection): The long-lived writer connection.
+        max_snapshots (int): Maximum number of snapshots per transaction.
+        max_seconds (float): Maximum age of an open transaction in seconds.
+        delta (bool): Whether only changed rows are stored.
+        keyframe_every (int): Snapshots between two full keyframes in delta mode.
+    """
+    def __init__(self, db_path=DB_PATH, max_snapshots=COMMIT_MAX_SNAPSHOTS, max_seconds=COMMIT_MAX_SECONDS,
+                 delta=STORAGE_MODE == "delta", keyframe_every=KEYFRAME_EVERY):
+        """Initialize the PositionWriter.
+
+        Args:
+            db_path (str): Path to the SQLite database file.
+            max_snapshots (int): Snapshots to collect before committing.
+            max_seconds (float): Seconds after which pending snapshots are committed.
+            delta (bool): Store only changed rows plus periodic keyframes.
+            keyframe_every (int): Snapshots between two keyframes in delta mode.
+        """
+        self.db_path = db_path
+        self.conn = open_writer(db_path)
+        self.encoder = None
+        self.rollups = None
+        self.zones = None
+        self.stops = None
+        self.visits = None
+        self.max_snapshots = max_snapshots
+        self.max_seconds = max_seconds
+        self.pending = 0
+        self.first_pending = None
+        self.delta = delta
+        self.keyframe_every = max(1, keyframe_every)
+        self.last_state = {}
+        self.keyframe_ts = None
+        self.since_keyframe = 0
+        # state of the snapshot between begin() and end()
+        self.snapshot = None
+
+    def begin(self, ts):
+        """Start a snapshot that is written chunk by chunk with add().
+
+        Args:
+            ts (int): Snapshot time in epoch seconds, the same as in the rows.
+        """
+        if self.encoder is None:
+            self.encoder = schema.Encoder(self.conn)
+            self.rollups = rollups.RollupWriter(self.conn)
+            self.zones = zones.ZoneTagger()
+            self.stops = stop_index.StopIndex(self.conn)
+            self.visits = visits.VisitTracker(self.conn)
+        else:
+            # pick up refreshed static stops
+            self.stops.reload_if_changed()
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN")
+        self.conn.execute("SAVEPOINT snapshot")
+        keyframe = not self.delta or self.keyframe_ts is None or self.since_keyframe >= self.keyframe_every
+        self.snapshot = {"ts": ts, "keyframe": keyframe, "current": {}, "groups": {}, "visits": {},
+                         "received": 0, "stored": 0, "open_visits": self.visits.open}
+
+    def add(self, rows):
+        """Insert one chunk of rows of the current snapshot.
+
+        Args:
+            rows (list[tuple]): Rows as returned by parse_vehicle_positions.
+        """
+        snapshot = self.snapshot
+        encoded = [self.encoder.encode_row(row, zone, stop)
+                   for row, zone, stop in zip(rows, self.zones.tag_rows(rows), self.stops.assign_rows(rows))]
+        if self.delta:
+            current = snapshot["current"]
+            for row in rows:
+                current[row[0]] = row[1:9]
+        if snapshot["keyframe"]:
+            changed = encoded
+        else:
+            changed = [values for row, values in zip(rows, encoded) if self.last_state.get(row[0]) != row[1:9]]
+        self._insert(changed)
+        self.rollups.aggregate(encoded, snapshot["groups"])
+        self.visits.observe(rows, encoded, snapshot["visits"])
+        snapshot["received"] += len(rows)
+        snapshot["stored"] += len(changed)
+
+    def end(self):
+        """Finish the current snapshot and commit if the batch is due.
+
+        The writer only moves on to the next keyframe and vehicle state once
+        the snapshot is stored; if a step fails, abort() rolls it back and the
+        next snapshot is computed against the last stored one.
+
+        Returns:
+            int: Number of rows actually written.
+        """
+        snapshot = self.snapshot
+        ts = snapshot["ts"]
+        stored = snapshot["stored"]
+        if not snapshot["keyframe"]:
+            # tombstones for vehicles that left since the last snapshot
+            gone = [(vehicle_id, None, None, None, None, None, None, None, GONE_STATE, ts)
+                    for vehicle_id in self.last_state.keys() - snapshot["current"].keys()]
+            self._insert([self.encoder.encode_row(row) for row in gone])
+            stored += len(gone)
+        keyframe_ts = ts if snapshot["keyframe"] else self.keyframe_ts
+        since_keyframe = (0 if snapshot["keyframe"] else self.since_keyframe) + 1
+        self.rollups.merge(ts, snapshot["groups"])
+        self.visits.advance(ts, snapshot["visits"])
+        self.conn.execute('''INSERT OR REPLACE INTO snapshots (
+                            ts, keyframe_ts, vehicles, stored)
+                          VALUES (?, ?, ?, ?)''', (ts, keyframe_ts, snapshot["received"], stored))
+        self.conn.execute("RELEASE snapshot")
+        self.snapshot = None
+        self.keyframe_ts = keyframe_ts
+        self.since_keyframe = since_keyframe
+        if self.delta:
+            self.last_state = snapshot["current"]
+        if self.pending == 0:
+            self.first_pending = time.monotonic()
+        self.pending += 1
+        if self.pending >= self.max_snapshots or time.monotonic() - self.first_pending >= self.max_seconds:
+            self.commit()
+        return stored
+
+    def abort(self):
+        """Drop the rows of the current snapshot, keeping earlier pending snapshots."""
+        if self.snapshot is None:
+            return
+        snapshot, self.snapshot = self.snapshot, None
+        self.conn.execute("ROLLBACK TO snapshot")
+        self.conn.execute("RELEASE snapshot")
+        # the open visits as they were before the snapshot, advance() may have replaced them
+        self.visits.open = snapshot["open_visits"]
+        # the encoder may have cached dictionary ids that were just rolled back
+        self.encoder = schema.Encoder(self.conn)
+
+    def write(self, rows, ts):
+        """Insert the rows of one snapshot and commit if the batch is due.
+
+        Args:
+            rows (list[tuple]): Rows as returned by parse_vehicle_positions.
+            ts (int): Snapshot time in epoch seconds, the same as in the rows.
+
+        Returns:
+            int: Number of rows actually written.
+        """
+        self.begin(ts)
+        try:
+            self.add(rows)
+            return self.end()
+        except BaseException:
+            self.abort()
+            raise
+
+    def _insert(self, encoded):
+        """Insert encoded rows into the positions table."""
+        self.conn.executemany('''INSERT INTO positions (
+                            ts, vehicle, trip, route, route_type, state, bearing, delay, lat_e6, lon_e6, zone,
+                            stop, station, stop_dist)
+                          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', encoded)
+
+    def commit(self):
+        """Commit all pending snapshots."""
+        if self.pending:
+            self.conn.commit()
+            metrics.COMMITS.inc()
+            logger.info(f"Committed {self.pending} snapshot(s).")
+        self.pending = 0
+        self.first_pending = None
+
+    def close(self):
+        """Commit pending snapshots and close the connection."""
+        self.commit()
+        self.conn.close()
+
+
+_writer = None
+
+def get_writer():
+    """Return the process-wide PositionWriter, opening it on first use."""
+    global _writer
+    if _writer is None:
+        _writer = PositionWriter()
+    return _writer
+
+
 #todo "gtfs_route_short_name"
-def create_table():
-    """Create the vehicle_positions table in the local SQLite database if it does not exist.
-
-    The table stores vehicle_id, trip IDs, route types, delays, coordinates, and timestamps.
-    """
-    conn = sqlite3.connect('vehicle_positions.db')
-    cursor = conn.cursor()
-    cursor.execute('''CREATE TABLE IF NOT EXISTS vehicle_positions (
-                        vehicle_id TEXT,
-                        gtfs_trip_id TEXT,
-                        route_type TEXT,
-                        gtfs_route_short_name TEXT,
-                        bearing REAL,
-                        delay REAL,
-                        latitude REAL,
-                        longitude REAL,
-                        "state_position" TEXT,
-                        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+def create_table(conn=None, delta=STORAGE_MODE == "delta"):
+    """Create the vehicle position tables in the local SQLite database if they do not exist.
+
+    The compact positions table stores vehicle_id, trip IDs, route types, delays,
+    coordinates, and timestamps (see schema.py). An existing database with the
+    old text layout is switched over and its rows are migrated with
+    ``python schema.py migrate``. Readers should query the view vehicle_positions_full.
+
+    Args:
+        conn (sqlite3.Connection, optional): Connection to use, defaults to the collector's writer.
+        delta (bool): Whether the collector stores only changed rows.
+    """
+    if conn is None:
+        conn = get_writer().conn
+    schema.ensure_schema(conn)
+    schema.ensure_indexes(conn, delta=delta)
+    rollups.create_rollup_table(conn)
+    # readers such as the local mirror (mirror.py) expect it before the first maintenance run
+    archive.create_archive_table(conn)
+    try:
+        schema.check_query_plans(conn)
+    except schema.QueryPlanError as e:
+        # keep collecting, but make the regression impossible to miss in the log
+        logger.critical(str(e))
+        print(e)
 
     conn.commit()
-    conn.close()
     logger.info("Database table checked/created.")
 
 
 
-def get_vehicle_positions():
+def fetch_snapshot(timeout=None):
+    """Stream the vehicle positions payload from the Golemio API into a spool file.
+
+    The response is requested gzip-compressed and decompressed chunk by chunk
+    while it is read, so the full body never has to sit in memory: payloads
+    larger than SPOOL_MAX_BYTES are spooled to a temporary file.
+
+    The timeout bounds every connect and read, and the whole download is
+    abandoned once it ran longer than timeout, so a slowly trickling
+    response cannot hold the fetch stage; the spool is closed on every error.
+
+    Args:
+        timeout (float, optional): Connect/read timeout and upper bound of the download in seconds.
+
+    Returns:
+        tempfile.SpooledTemporaryFile: The JSON body, positioned at the start.
+        The caller closes it.
+
+    Raises:
+        TimeoutError: If the download took longer than timeout.
+        requests.exceptions.RequestException: If the HTTP request fails.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    try:
+        with requests.get(API_URL, headers={**headers, "Accept-Encoding": "gzip"}, timeout=timeout,
+                          stream=True) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=STREAM_CHUNK_BYTES):
+                if deadline is not None and time.monotonic() > deadline:
+                    raise TimeoutError(f"download took longer than {timeout}s")
+                spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+def get_vehicle_positions(timeout=None):
     """Fetch real-time vehicle position data from the Golemio API.
 
+    Args:
+        timeout (float, optional): Connect/read timeout in seconds.
+
     Returns:
         dict or None: JSON response containing features if successful, otherwise None.
 
@@ -104,7 +503,7 @@ def get_vehicle_positions():
         requests.exceptions.RequestException: If the HTTP request fails.
     """
     try:
-        response = requests.get(API_URL, headers=headers)
+        response = requests.get(API_URL, headers=headers, timeout=timeout)
         logger.info("Successfully fetched vehicle positions.")
         return response.json()
     except requests.exceptions.RequestException as e:
@@ -112,27 +511,17 @@ def get_vehicle_positions():
         return None
 
 
-def store_vehicle_positions(data):
-    """Store vehicle position features into the local SQLite database.
+def iter_vehicle_positions(features, ts):
+    """Convert vehicle position features into database rows one at a time.
 
     Args:
-        data (dict): JSON response with a 'features' list of vehicle position dicts.
+        features (iterable[dict]): GeoJSON features of vehicle positions.
+        ts (int): Snapshot time in epoch seconds stored with every row.
 
-    Returns:
-        None
+    Yields:
+        tuple: One row in the column order of the vehicle_positions view,
+        with the epoch ts in place of the formatted timestamp.
     """
-    if not data or "features" not in data:
-        print("No data to store.")
-        return
-    
-    #db setup
-    conn = sqlite3.connect('vehicle_positions.db')
-    cursor = conn.cursor()
-
-    features = data.get("features", [])
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-    rows = []
     for feature in features:
 
         #get highlevel structure of the data
@@ -140,7 +529,7 @@ def store_vehicle_positions(data):
         properties = feature.get("properties", {})
         coordinates = geometry.get("coordinates", [None, None])
 
-        rows.append((
+        yield (
             properties.get("vehicle_id", ""),
             properties.get("gtfs_trip_id", ""),
             properties.get("route_type", ""),
@@ -150,36 +539,309 @@ def store_vehicle_positions(data):
             coordinates[1],  # latitude
             coordinates[0],  # longitude
             properties.get("state_position", ""),
-            timestamp
-        ))
+            ts
+        )
 
-    cursor.executemany('''INSERT INTO vehicle_positions (
-                            vehicle_id, gtfs_trip_id, route_type, gtfs_route_short_name, bearing, delay,
-                            latitude, longitude, state_position, timestamp)
-                          VALUES (?, ?, ?, ?, ?, ?,?, ?, ?, ?)''', rows)
 
-    conn.commit()
-    conn.close()
-    logger.info(f"Stored {len(rows)} vehicle positions to DB.")
+def parse_vehicle_positions(data, ts):
+    """Convert the features of one API response into database rows.
 
+    Args:
+        data (dict): JSON response with a 'features' list of vehicle position dicts.
+        ts (int): Snapshot time in epoch seconds stored with every row.
 
-def main():
-    """Continuously fetch and store vehicle position data at 30-second intervals.
+    Returns:
+        list[tuple]: Rows in the column order of the vehicle_positions view,
+        with the epoch ts in place of the formatted timestamp.
+    """
+    return list(iter_vehicle_positions(data.get("features", []), ts))
 
-    Creates the database table if needed, then loops to fetch, store, and log data.
+
+def parse_vehicle_stream(stream, ts, chunk_rows=INSERT_CHUNK_ROWS):
+    """Incrementally parse a raw payload into chunks of database rows.
+
+    Only one feature is decoded at a time, so memory stays bounded by the
+    chunk size instead of growing with the payload.
+
+    Args:
+        stream (file): Binary file object with the JSON response body.
+        ts (int): Snapshot time in epoch seconds stored with every row.
+        chunk_rows (int): Rows per yielded chunk.
+
+    Yields:
+        list[tuple]: Up to chunk_rows rows as returned by parse_vehicle_positions.
+
+    Raises:
+        ijson.JSONError: If the payload is not valid JSON.
     """
-    create_table() 
+    features = ijson.items(stream, "features.item", use_float=True)
+    chunk = []
+    for row in iter_vehicle_positions(features, ts):
+        chunk.append(row)
+        if len(chunk) >= chunk_rows:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def store_vehicle_positions(data, writer=None, ts=None):
+    """Store vehicle position features into the local SQLite database.
+
+    Args:
+        data (dict): JSON response with a 'features' list of vehicle position dicts.
+        writer (PositionWriter, optional): Writer to use, defaults to the collector's writer.
+        ts (int, optional): Snapshot time in epoch seconds, defaults to now.
 
+    Returns:
+        int or None: Number of rows written, None if there was nothing to store.
+    """
+    if not data or "features" not in data:
+        print("No data to store.")
+        return
     
+    #db setup
+    if writer is None:
+        writer = get_writer()
+    if ts is None:
+        ts = int(time.time())
+
+    rows = parse_vehicle_positions(data, ts)
+    stored = writer.write(rows, ts)
+    logger.info(f"Stored {stored} of {len(rows)} vehicle positions to DB.")
+    return stored
+
+
+def store_vehicle_stream(stream, writer, ts):
+    """Parse a raw payload incrementally and insert it chunk by chunk.
+
+    A payload that turns out to be broken halfway is rolled back completely.
+
+    Args:
+        stream (file): Binary file object with the JSON response body.
+        writer (PositionWriter): Writer to use.
+        ts (int): Snapshot time in epoch seconds.
+
+    Returns:
+        tuple: (rows received, rows stored, parse seconds, insert seconds).
+    """
+    started = time.perf_counter()
+    insert_seconds = 0.0
+    received = 0
+    writer.begin(ts)
+    try:
+        for chunk in parse_vehicle_stream(stream, ts):
+            chunk_started = time.perf_counter()
+            writer.add(chunk)
+            insert_seconds += time.perf_counter() - chunk_started
+            received += len(chunk)
+        chunk_started = time.perf_counter()
+        stored = writer.end()
+        insert_seconds += time.perf_counter() - chunk_started
+    except BaseException:
+        writer.abort()
+        raise
+    return received, stored, time.perf_counter() - started - insert_seconds, insert_seconds
+
+
+async def schedule_ticks(fetch_queue, interval=SNAPSHOT_INTERVAL):
+    """Emit snapshot times aligned to the wall clock (e.g. :00 and :30).
+
+    The next tick is computed from the schedule, not from the end of the
+    previous snapshot, so slow requests or writes never shift later snapshots.
+    If the fetch stage is still busy, the tick is dropped instead of queued.
+
+    Args:
+        fetch_queue (asyncio.Queue): Queue of tick times for the fetch stage.
+        interval (int): Seconds between snapshots.
+    """
+    next_tick = math.ceil(time.time() / interval) * interval
     while True:
-        print("Fetching Data...")
-        data = get_vehicle_positions()
-        logger.info("Fetching data...")
-        if data:
-            store_vehicle_positions(data)
-            print("Data Saved.")
-        
-        time.sleep(30)
+        await asyncio.sleep(max(0.0, next_tick - time.time()))
+        try:
+            fetch_queue.put_nowait(next_tick)
+        except asyncio.QueueFull:
+            metrics.TICKS_MISSED.inc(reason="busy")
+            logger.warning(f"Missed tick {format_tick(next_tick)}: previous snapshot is still being fetched.")
+        next_tick += interval
+        # after a stall (e.g. a suspended VM) skip the ticks that are already in the past
+        late = time.time() - next_tick
+        if late >= interval:
+            skipped = int(late // interval)
+            metrics.TICKS_MISSED.inc(skipped, reason="late")
+            logger.warning(f"Collector is {late:.0f}s late, skipping {skipped} tick(s).")
+            next_tick += skipped * interval
+
+
+async def fetch_stage(fetch_queue, store_queue, timeout=FETCH_TIMEOUT, snapshot_recorder=None):
+    """Download one payload per tick and pass it to the store stage.
+
+    Args:
+        fetch_queue (asyncio.Queue): Tick times from the scheduler.
+        store_queue (asyncio.Queue): Queue of (tick, spooled payload) for the store stage.
+        timeout (float): Upper bound for one request in seconds.
+        snapshot_recorder (recorder.Recorder, optional): Archives every raw payload.
+    """
+    while True:
+        tick = await fetch_queue.get()
+        started = time.perf_counter()
+        try:
+            # the thread stops itself at the timeout and closes its spool, a cancelled await would not stop it
+            spool = await asyncio.to_thread(fetch_snapshot, timeout)
+        except (TimeoutError, requests.exceptions.Timeout):
+            metrics.API_ERRORS.inc(reason="timeout")
+            logger.error(f"API Error: request for tick {format_tick(tick)} timed out after {timeout}s.")
+            continue
+        except requests.exceptions.RequestException as e:
+            metrics.API_ERRORS.inc(reason="http")
+            logger.error(f"API Error: {e}") #log errors
+            continue
+        except Exception:
+            # e.g. an OSError of the spool file; skip the tick, keep collecting
+            metrics.API_ERRORS.inc(reason="other")
+            logger.exception(f"Could not fetch tick {format_tick(tick)}")
+            continue
+        finally:
+            fetch_queue.task_done()
+        metrics.API_LATENCY.observe(time.perf_counter() - started)
+        spool.seek(0, os.SEEK_END)
+        metrics.PAYLOAD_BYTES.observe(spool.tell())
+        spool.seek(0)
+        logger.info("Successfully fetched vehicle positions.")
+        if snapshot_recorder is not None:
+            try:
+                await asyncio.to_thread(snapshot_recorder.record, tick, spool)
+            except OSError as e:
+                logger.error(f"Could not record tick {format_tick(tick)}: {e}")
+            spool.seek(0)
+        await store_queue.put((tick, spool))
+
+
+async def store_stage(store_queue, writer):
+    """Parse spooled payloads incrementally and insert them through the long-lived writer.
+
+    Parsing and inserting run interleaved in one worker thread, chunk by chunk,
+    so a snapshot never exists as a full list of rows in memory.
+
+    Args:
+        store_queue (asyncio.Queue): Queue of (tick, spooled payload) from the fetch stage.
+        writer (PositionWriter): The collector's writer.
+    """
+    while True:
+        tick, spool = await store_queue.get()
+        started = time.perf_counter()
+        work = asyncio.ensure_future(asyncio.to_thread(store_vehicle_stream, spool, writer, tick))
+        try:
+            try:
+                received, stored, parse_seconds, insert_seconds = await asyncio.shield(work)
+            except asyncio.CancelledError:
+                # the thread keeps using the writer and the spool, wait for it before they are closed
+                await asyncio.wait([work])
+                raise
+            lag = time.time() - tick
+            metrics.PARSE_SECONDS.observe(parse_seconds)
+            record_write(writer, tick, received, stored, insert_seconds, lag)
+            logger.info(f"Stored {stored} of {received} vehicle positions to DB "
+                        f"({lag:.1f}s after tick, {time.perf_counter() - started:.2f}s).")
+        except (ijson.JSONError, ValueError, AttributeError) as e:
+            metrics.API_ERRORS.inc(reason="parse")
+            logger.error(f"Could not parse payload of tick {format_tick(tick)}: {e}")
+        except sqlite3.Error as e:
+            metrics.WRITE_ERRORS.inc()
+            logger.error(f"DB Error while storing tick {format_tick(tick)}: {e}")
+        except Exception:
+            # e.g. a KeyError or TypeError of a malformed feed; skip the snapshot, keep collecting
+            if writer.snapshot is not None:
+                writer.abort()
+            metrics.WRITE_ERRORS.inc()
+            logger.exception(f"Could not store tick {format_tick(tick)}")
+        finally:
+            spool.close()
+            store_queue.task_done()
+        try:
+            await asyncio.to_thread(metrics.write_textfile)
+        except OSError as e:
+            logger.warning(f"Could not write {metrics.METRICS_TEXTFILE}: {e}")
+
+
+def record_write(writer, tick, received, stored, seconds, lag):
+    """Update the collector metrics after a snapshot was written.
+
+    Args:
+        writer (PositionWriter): The collector's writer.
+        tick (int): Snapshot time in epoch seconds.
+        received (int): Rows in the snapshot.
+        stored (int): Rows actually written.
+        seconds (float): Duration of the write.
+        lag (float): Seconds between the tick and the end of the write.
+    """
+    metrics.INSERT_SECONDS.observe(seconds)
+    metrics.SNAPSHOT_ROWS.set(received, kind="received")
+    metrics.SNAPSHOT_ROWS.set(stored, kind="stored")
+    metrics.ROWS_STORED.inc(stored)
+    metrics.WRITE_LAG.set(lag)
+    metrics.LAST_TICK.set(tick)
+    for kind, path in (("db", writer.db_path), ("wal", writer.db_path + "-wal")):
+        if os.path.exists(path):
+            metrics.DB_BYTES.set(os.path.getsize(path), file=kind)
+
+
+def format_tick(tick):
+    """Format a tick (epoch seconds) as the local timestamp shown by the views."""
+    return datetime.fromtimestamp(tick).strftime("%Y-%m-%d %H:%M:%S")
+
+
+async def run_pipeline(writer, interval=SNAPSHOT_INTERVAL, snapshot_recorder=None):
+    """Run the scheduler and the fetch and store stages until cancelled.
+
+    The stages are connected by bounded queues, so a slow stage blocks the one
+    before it and finally makes the scheduler drop ticks instead of piling up work.
+
+    Args:
+        writer (PositionWriter): The collector's writer.
+        interval (int): Seconds between snapshots.
+        snapshot_recorder (recorder.Recorder, optional): Archives every raw payload.
+    """
+    fetch_queue = asyncio.Queue(maxsize=1)
+    store_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    tasks = [
+        asyncio.create_task(schedule_ticks(fetch_queue, interval)),
+        asyncio.create_task(fetch_stage(fetch_queue, store_queue, min(FETCH_TIMEOUT, interval), snapshot_recorder)),
+        asyncio.create_task(store_stage(store_queue, writer)),
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        # the store stage finishes the snapshot it is writing before main() closes the writer
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def main():
+    """Continuously fetch and store vehicle position data at 30-second intervals.
+
+    Creates the database table if needed, then runs the asyncio pipeline that
+    takes one snapshot per wall-clock tick.
+    """
+    writer = get_writer()
+    create_table(writer.conn, delta=writer.delta)
+    try:
+        metrics.start_http_server()
+    except OSError as e:
+        logger.warning(f"Metrics endpoint not started on port {metrics.METRICS_PORT}: {e}")
+
+    snapshot_recorder = recorder.Recorder() if recorder.RECORD_DIR else None
+    if snapshot_recorder is not None:
+        print(f"Recording raw snapshots to {snapshot_recorder.directory}.")
+
+    print("Collecting vehicle positions, stop with CTRL+C...")
+    try:
+        asyncio.run(run_pipeline(writer, snapshot_recorder=snapshot_recorder))
+    except KeyboardInterrupt:
+        print("Stopped.")
+    finally:
+        writer.close()
 
 if __name__ == "__main__":
     main()   
@@ -0,0 +1,329 @@
+"""
+stop_index.py
+
+Nearest-stop assignment of the vehicle positions.
+
+The collector stores with every row the nearest GTFS stop (platform) of its
+position, the stop's parent station and the distance to the stop (columns
+stop, station and stop_dist of positions, see schema.py; the views decode
+them as stop_id, parent_station and stop_distance in metres). Stops without
+a parent station are their own station, so parent_station is set whenever
+stop_id is. NULL means no coordinates (tombstones), no stop within
+STOP_MAX_DISTANCE (e.g. depots, open track) or not assigned yet.
+
+The stops come from the table gtfs_stops of the collector database, a copy
+of the static GTFS stops (the Streamlit app keeps its own copy in
+database.db, which the collector cannot see). A k-d tree over the stop
+coordinates, projected to metres around Prague, is built once and matches
+each chunk of rows with one vectorized query. `refresh` replaces the stops
+in one transaction and bumps gtfs_stops_state.version; the collector checks
+the version before every snapshot and rebuilds the tree when it changed.
+
+The stops page groups by the stored parent_station instead of matching
+every position against all stops on each run.
+
+Usage:
+    python stop_index.py refresh                  # fetch the stops from the Golemio GTFS API
+    python stop_index.py refresh --from-db database.db
+                                                  # or copy the app's stops table
+    python stop_index.py backfill
+    Assigns stops to rows stored before the stop columns existed (or migrated
+    from the legacy table) in short transactions, while the collector keeps running.
+"""
+
+import argparse
+import logging
+import math
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+import numpy as np
+import requests
+from dotenv import load_dotenv
+from scipy.spatial import cKDTree
+
+import schema
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+GTFS_API_URL = os.getenv("GTFS_API_URL", "https://api.golemio.cz/v2/gtfs")
+# stops fetched per API request
+PAGE_SIZE = 10000
+# rows assigned per backfill transaction
+BACKFILL_BATCH = 100000
+# equirectangular projection around Prague; below 0.1 % error within the city
+REFERENCE_LATITUDE = 50.08
+METRES_PER_DEGREE = 111195.0
+# positions farther from every stop than this (metres) get no stop
+STOP_MAX_DISTANCE = float(os.getenv("STOP_MAX_DISTANCE", "150"))
+
+
+def project(lon, lat):
+    """Project coordinates in degrees to metres around REFERENCE_LATITUDE.
+
+    Args:
+        lon (array-like): Longitudes in degrees.
+        lat (array-like): Latitudes in degrees.
+
+    Returns:
+        numpy.ndarray: (n, 2) array of x, y in metres.
+    """
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    x = lon * METRES_PER_DEGREE * math.cos(math.radians(REFERENCE_LATITUDE))
+    y = lat * METRES_PER_DEGREE
+    return np.column_stack((x, y))
+
+
+def stops_version(conn):
+    """Return the version of the stored stops, None if none were loaded."""
+    row = conn.execute("SELECT version FROM gtfs_stops_state").fetchone()
+    return row[0] if row else None
+
+
+class StopIndex:
+    """Finds the nearest stop of positions with a k-d tree.
+
+    Attributes:
+        conn (sqlite3.Connection): Connection to the collector database.
+        version (int): Version of gtfs_stops the tree was built from.
+        stop_ids (numpy.ndarray): Stop id per tree point.
+        stations (numpy.ndarray): Parent station (or the stop itself) per tree point.
+        tree (scipy.spatial.cKDTree): Tree over the projected stop coordinates,
+            None if no stops are loaded.
+    """
+    def __init__(self, conn):
+        """Initialize the StopIndex and build the tree.
+
+        Args:
+            conn (sqlite3.Connection): Connection to the collector database.
+        """
+        self.conn = conn
+        self.version = None
+        self.stop_ids = np.array([], dtype=object)
+        self.stations = np.array([], dtype=object)
+        self.tree = None
+        self.reload()
+
+    def reload(self):
+        """(Re)build the tree from gtfs_stops.
+
+        Only stops and platforms (location_type 0) are indexed; stations,
+        entrances and nodes are not places where vehicles stop.
+        """
+        self.version = stops_version(self.conn)
+        rows = self.conn.execute("""SELECT stop_id, COALESCE(NULLIF(parent_station, ''), stop_id),
+                                           longitude, latitude
+                                    FROM gtfs_stops
+                                    WHERE COALESCE(location_type, 0) = 0
+                                      AND longitude IS NOT NULL AND latitude IS NOT NULL
+                                    ORDER BY stop_id""").fetchall()
+        if not rows:
+            self.tree = None
+            logger.warning("No stops in gtfs_stops, run `python stop_index.py refresh`; "
+                           "positions are stored without a stop.")
+            return
+        stop_ids, stations, lon, lat = zip(*rows)
+        self.stop_ids = np.array(stop_ids, dtype=object)
+        self.stations = np.array(stations, dtype=object)
+        self.tree = cKDTree(project(lon, lat))
+        logger.info(f"Built the stop index from {len(rows)} stops (version {self.version}).")
+
+    def reload_if_changed(self):
+        """Rebuild the tree if the stops were refreshed since it was built.
+
+        Returns:
+            bool: True if the tree was rebuilt.
+        """
+        if stops_version(self.conn) == self.version:
+            return False
+        self.reload()
+        return True
+
+    def nearest(self, lon, lat, max_distance=STOP_MAX_DISTANCE):
+        """Return the nearest stop of many points.
+
+        Args:
+            lon (array-like): Longitudes in degrees, NaN for missing values.
+            lat (array-like): Latitudes in degrees, NaN for missing values.
+            max_distance (float): Points farther than this (metres) from every stop get none.
+
+        Returns:
+            tuple: (index into stop_ids, -1 where no stop is assigned;
+            distance in metres, NaN where no stop is assigned).
+        """
+        lon = np.asarray(lon, dtype=float)
+        lat = np.asarray(lat, dtype=float)
+        index = np.full(lon.shape, -1)
+        distance = np.full(lon.shape, np.nan)
+        valid = ~(np.isnan(lon) | np.isnan(lat))
+        if self.tree is not None and valid.any():
+            found, nearest = self.tree.query(project(lon[valid], lat[valid]), distance_upper_bound=max_distance)
+            # the tree reports a miss as an infinite distance and index len(stop_ids)
+            hit = np.isfinite(found)
+            found[~hit] = np.nan
+            nearest[~hit] = -1
+            distance[valid], index[valid] = found, nearest
+        return index, distance
+
+    def assign_rows(self, rows):
+        """Return the nearest stop of parsed rows.
+
+        Args:
+            rows (list[tuple]): Rows as returned by server.parse_vehicle_positions.
+
+        Returns:
+            list: (stop_id, parent_station, distance in metres) or None per row.
+        """
+        if not rows:
+            return []
+        lat = [np.nan if row[6] is None else row[6] for row in rows]
+        lon = [np.nan if row[7] is None else row[7] for row in rows]
+        index, distance = self.nearest(lon, lat)
+        return [None if i < 0 else (self.stop_ids[i], self.stations[i], round(d))
+                for i, d in zip(index.tolist(), distance.tolist())]
+
+
+def fetch_stops(api_url=GTFS_API_URL, api_key=None):
+    """Fetch all stops from the Golemio GTFS API.
+
+    Args:
+        api_url (str): Base URL of the GTFS API.
+        api_key (str, optional): API key, defaults to API_KEY from the environment.
+
+    Returns:
+        list[tuple]: (stop_id, stop_name, parent_station, location_type, latitude, longitude).
+
+    Raises:
+        requests.HTTPError: If a request fails.
+    """
+    headers = {"X-Access-Token": api_key or os.getenv("API_KEY")}
+    stops = []
+    offset = 0
+    while True:
+        response = requests.get(f"{api_url}/stops", params={"limit": PAGE_SIZE, "offset": offset},
+                                headers=headers, timeout=60)
+        response.raise_for_status()
+        features = response.json().get("features", [])
+        if not features:
+            break
+        for feature in features:
+            props = feature["properties"]
+            lon, lat = feature["geometry"]["coordinates"][:2]
+            stops.append((props.get("stop_id"), props.get("stop_name"), props.get("parent_station"),
+                          props.get("location_type"), lat, lon))
+        offset += PAGE_SIZE
+    return stops
+
+
+def read_stops_db(path):
+    """Read the stops of the Streamlit app's static database (see StopManager).
+
+    Args:
+        path (str): Path to database.db.
+
+    Returns:
+        list[tuple]: (stop_id, stop_name, parent_station, location_type, latitude, longitude).
+    """
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        return conn.execute("""SELECT stop_id, stop_name, parent_station, location_type, latitude, longitude
+                               FROM stops WHERE stop_id IS NOT NULL""").fetchall()
+    finally:
+        conn.close()
+
+
+def refresh(conn, stops):
+    """Replace the stored stops and bump their version.
+
+    Runs in one transaction, so the collector either sees the old or the new
+    stops and rebuilds its index before its next snapshot.
+
+    Args:
+        conn (sqlite3.Connection): Writable connection to the collector database.
+        stops (list[tuple]): Rows as returned by fetch_stops().
+
+    Returns:
+        int: The new version.
+    """
+    version = (stops_version(conn) or 0) + 1
+    with conn:
+        conn.execute("DELETE FROM gtfs_stops")
+        conn.executemany("""INSERT OR REPLACE INTO gtfs_stops (
+                                stop_id, stop_name, parent_station, location_type, latitude, longitude)
+                            VALUES (?, ?, ?, ?, ?, ?)""", stops)
+        conn.execute("DELETE FROM gtfs_stops_state")
+        conn.execute("INSERT INTO gtfs_stops_state (version, refreshed_at) VALUES (?, ?)",
+                     (version, datetime.now().isoformat(timespec="seconds")))
+    return version
+
+
+def backfill(conn, batch_size=BACKFILL_BATCH, pause=0.1):
+    """Assign the nearest stop to all positions without one that have coordinates.
+
+    Walks positions in rowid order, one short transaction per batch, so it
+    can run next to the collector and be interrupted at any time. Positions
+    without a stop within STOP_MAX_DISTANCE stay unassigned.
+
+    Args:
+        conn (sqlite3.Connection): Writable connection to the collector database.
+        batch_size (int): Rows per transaction.
+        pause (float): Seconds to sleep between batches to let the collector write.
+
+    Returns:
+        int: Number of rows assigned.
+    """
+    index = StopIndex(conn)
+    if index.tree is None:
+        return 0
+    encoder = schema.Encoder(conn)
+    last_rowid = 0
+    assigned = 0
+    while True:
+        rows = conn.execute("""SELECT rowid, lon_e6, lat_e6 FROM positions
+                               WHERE rowid > ? AND stop IS NULL AND lat_e6 IS NOT NULL
+                               ORDER BY rowid LIMIT ?""", (last_rowid, batch_size)).fetchall()
+        if not rows:
+            break
+        rowids, lon, lat = np.array(rows, dtype=float).T
+        nearest, distance = index.nearest(lon / 1e6, lat / 1e6)
+        conn.executemany("UPDATE positions SET stop = ?, station = ?, stop_dist = ? WHERE rowid = ?",
+                         ((encoder.encode("stop", index.stop_ids[i]), encoder.encode("station", index.stations[i]),
+                           round(d), rowid)
+                          for i, d, rowid in zip(nearest.tolist(), distance.tolist(), rowids.astype(int).tolist())
+                          if i >= 0))
+        conn.commit()
+        last_rowid = int(rowids[-1])
+        assigned += int((nearest >= 0).sum())
+        print(f"Assigned {assigned} rows (rowid {last_rowid}).")
+        time.sleep(pause)
+    return assigned
+
+
+def main():
+    """Command line entry point for loading the stops and assigning old positions."""
+    parser = argparse.ArgumentParser(description="Nearest-stop assignment of the vehicle positions.")
+    parser.add_argument("command", choices=["refresh", "backfill"])
+    parser.add_argument("--db", default=schema.DB_PATH, help="Path to the collector database.")
+    parser.add_argument("--from-db", help="Copy the stops table of this database (refresh) instead of the API.")
+    parser.add_argument("--batch", type=int, default=BACKFILL_BATCH, help="Rows per transaction (backfill).")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    conn.execute(f"PRAGMA busy_timeout={schema.MAINTENANCE_BUSY_TIMEOUT_MS}")
+    schema.ensure_schema(conn)
+    if args.command == "refresh":
+        stops = read_stops_db(args.from_db) if args.from_db else fetch_stops()
+        version = refresh(conn, stops)
+        print(f"Loaded {len(stops)} stops (version {version}).")
+    else:
+        assigned = backfill(conn, args.batch)
+        print(f"Done, {assigned} rows assigned.")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
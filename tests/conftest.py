@@ -0,0 +1,40 @@
+import logging
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# with a root handler in place, the basicConfig of server.py does not append to the repository's gather.log
+logging.getLogger().addHandler(logging.NullHandler())
+
+import server  # noqa: E402
+
+
+def position(vehicle, ts, delay=0, lat=50.08, lon=14.42, state="at_stop", trip=None):
+    """Return a parsed row like server.parse_vehicle_positions."""
+    return (vehicle, trip or f"trip_{vehicle}", "3", "22", 90, delay, lat, lon, state, ts)
+
+
+@pytest.fixture
+def repo_dir(monkeypatch):
+    """Run in the repository root, where the collector finds tariff_zones.wkt."""
+    monkeypatch.chdir(ROOT)
+    return ROOT
+
+
+@pytest.fixture
+def make_writer(tmp_path, repo_dir):
+    """Return a factory of PositionWriters on a fresh database with all tables."""
+    writers = []
+
+    def make(name="positions.db", **kwargs):
+        writer = server.PositionWriter(str(tmp_path / name), **kwargs)
+        server.create_table(writer.conn, delta=writer.delta)
+        writers.append(writer)
+        return writer
+
+    yield make
+    for writer in writers:
+        writer.conn.close()
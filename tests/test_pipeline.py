@@ -0,0 +1,119 @@
+import asyncio
+import io
+import threading
+import time
+
+import pytest
+
+import metrics
+import server
+from conftest import position
+
+
+class SlowResponse:
+    """Stands in for a streamed requests response whose chunks arrive one by one."""
+    def __init__(self, chunks, clock):
+        self.chunks = chunks
+        self.clock = clock
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for chunk in self.chunks:
+            self.clock[0] += 1
+            yield chunk
+
+
+def test_fetch_snapshot_stops_at_the_timeout_and_closes_its_spool(monkeypatch):
+    clock = [0.0]
+    spools = []
+    spooled = server.tempfile.SpooledTemporaryFile
+    monkeypatch.setattr(server.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(server.requests, "get", lambda *args, **kwargs: SlowResponse([b"x"] * 10, clock))
+    monkeypatch.setattr(server.tempfile, "SpooledTemporaryFile",
+                        lambda **kwargs: spools.append(spooled(**kwargs)) or spools[-1])
+
+    with pytest.raises(TimeoutError):
+        server.fetch_snapshot(timeout=3)
+    assert spools[0].closed
+
+
+def test_store_stage_skips_a_malformed_snapshot(make_writer, monkeypatch):
+    writer = make_writer(max_snapshots=1, max_seconds=3600)
+    monkeypatch.setattr(metrics, "write_textfile", lambda: None)
+
+    def parse(stream, ts):
+        if ts == 1000:
+            yield [position("v1", ts)]
+            raise KeyError("geometry")
+        yield [position("v1", ts)]
+
+    monkeypatch.setattr(server, "parse_vehicle_stream", parse)
+
+    async def run():
+        queue = asyncio.Queue()
+        task = asyncio.create_task(server.store_stage(queue, writer))
+        for tick in (1000, 1030):
+            await queue.put((tick, io.BytesIO(b"{}")))
+        await queue.join()
+        task.cancel()
+
+    asyncio.run(run())
+    assert writer.snapshot is None
+    assert [row[0] for row in writer.conn.execute("SELECT ts FROM snapshots")] == [1030]
+
+
+def test_fetch_stage_skips_a_tick_that_fails_unexpectedly(monkeypatch):
+    spool = io.BytesIO(b"{}")
+    results = [OSError("no space left for the spool"), spool]
+
+    def fetch(timeout):
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    monkeypatch.setattr(server, "fetch_snapshot", fetch)
+
+    async def run():
+        fetch_queue, store_queue = asyncio.Queue(), asyncio.Queue()
+        task = asyncio.create_task(server.fetch_stage(fetch_queue, store_queue))
+        for tick in (1000, 1030):
+            await fetch_queue.put(tick)
+        stored = await asyncio.wait_for(store_queue.get(), 5)
+        task.cancel()
+        return stored
+
+    assert asyncio.run(run()) == (1030, spool)
+
+
+def test_cancelling_the_pipeline_waits_for_the_snapshot_being_stored(make_writer, monkeypatch):
+    writer = make_writer(max_snapshots=1, max_seconds=3600)
+    monkeypatch.setattr(metrics, "write_textfile", lambda: None)
+    started = threading.Event()
+
+    def parse(stream, ts):
+        started.set()
+        time.sleep(0.3)
+        yield [position("v1", ts)]
+
+    monkeypatch.setattr(server, "parse_vehicle_stream", parse)
+
+    async def run():
+        queue = asyncio.Queue()
+        task = asyncio.create_task(server.store_stage(queue, writer))
+        await queue.put((1000, io.BytesIO(b"{}")))
+        await asyncio.to_thread(started.wait, 5)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        # the write finished before the task ended, so closing the writer now is safe
+        return [row[0] for row in writer.conn.execute("SELECT ts FROM snapshots")]
+
+    assert asyncio.run(run()) == [1000]
@@ -0,0 +1,88 @@
+import sqlite3
+
+import pytest
+
+import rollups
+from conftest import position
+
+
+def stored_snapshots(writer):
+    return [row[0] for row in writer.conn.execute("SELECT ts FROM snapshots ORDER BY ts")]
+
+
+def test_snapshots_are_committed_in_batches(make_writer):
+    writer = make_writer(max_snapshots=2, max_seconds=3600)
+    writer.write([position("v1", 1000)], 1000)
+    assert writer.pending == 1
+    writer.write([position("v1", 1030)], 1030)
+    assert writer.pending == 0
+    reader = sqlite3.connect(writer.db_path)
+    assert [row[0] for row in reader.execute("SELECT ts FROM snapshots ORDER BY ts")] == [1000, 1030]
+
+
+def test_abort_keeps_earlier_pending_snapshots(make_writer):
+    writer = make_writer(max_snapshots=10, max_seconds=3600)
+    writer.write([position("v1", 1000)], 1000)
+    writer.begin(1030)
+    writer.add([position("v1", 1030), position("v2", 1030)])
+    writer.abort()
+    assert writer.snapshot is None
+    assert not writer.conn.execute("SELECT 1 FROM positions WHERE ts = 1030").fetchall()
+    writer.commit()
+    assert stored_snapshots(writer) == [1000]
+
+
+def test_failing_merge_rolls_the_snapshot_back(make_writer, monkeypatch):
+    writer = make_writer(max_snapshots=10, max_seconds=3600, delta=True, keyframe_every=5)
+    writer.write([position("v1", 1000), position("v2", 1000)], 1000)
+    state = (writer.keyframe_ts, writer.since_keyframe, writer.last_state, writer.visits.open)
+
+    def fail(self, ts, groups):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    monkeypatch.setattr(rollups.RollupWriter, "merge", fail)
+    with pytest.raises(sqlite3.OperationalError):
+        # v2 left, so a tombstone is written before the merge fails
+        writer.write([position("v1", 1030, delay=60)], 1030)
+    assert writer.snapshot is None
+    assert (writer.keyframe_ts, writer.since_keyframe, writer.last_state, writer.visits.open) == state
+    assert not writer.conn.execute("SELECT 1 FROM positions WHERE ts = 1030").fetchall()
+    # the savepoint was released: the next snapshot is not nested in it and commits normally
+    monkeypatch.undo()
+    writer.write([position("v1", 1060, delay=60)], 1060)
+    writer.commit()
+    assert not writer.conn.in_transaction
+    assert stored_snapshots(writer) == [1000, 1060]
+    assert writer.conn.execute("SELECT COUNT(*) FROM positions WHERE ts = 1030").fetchone()[0] == 0
+
+
+def full_series(writer):
+    rows = writer.conn.execute("""SELECT ts, vehicle_id, gtfs_trip_id, delay, latitude, longitude, state_position
+                                  FROM vehicle_positions_full ORDER BY ts, vehicle_id""")
+    return rows.fetchall()
+
+
+def test_delta_snapshots_read_back_like_full_snapshots(make_writer):
+    snapshots = [
+        (1000, [position("v1", 1000), position("v2", 1000, delay=30)]),
+        # v1 unchanged, v2 moved
+        (1030, [position("v1", 1030), position("v2", 1030, delay=30, lat=50.081)]),
+        # v2 left, v3 appeared
+        (1060, [position("v1", 1060, delay=10), position("v3", 1060)]),
+        # keyframe
+        (1090, [position("v1", 1090, delay=10), position("v3", 1090)]),
+        (1120, [position("v1", 1120, delay=10), position("v2", 1120, delay=90), position("v3", 1120)]),
+    ]
+    full = make_writer("full.db", delta=False)
+    delta = make_writer("delta.db", delta=True, keyframe_every=3)
+    for ts, rows in snapshots:
+        full.write(rows, ts)
+        delta.write(rows, ts)
+    full.commit()
+    delta.commit()
+
+    assert delta.conn.execute("SELECT ts FROM snapshots WHERE keyframe_ts = ts").fetchall() == [(1000,), (1090,)]
+    # fewer rows are stored, the same series is read
+    assert (delta.conn.execute("SELECT COUNT(*) FROM positions").fetchone()[0]
+            < full.conn.execute("SELECT COUNT(*) FROM positions").fetchone()[0])
+    assert full_series(delta) == full_series(full)
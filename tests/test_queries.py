@@ -0,0 +1,81 @@
+from datetime import date
+
+import pyarrow as pa
+
+import queries
+
+
+def trip_day(trips, delays, counts, first):
+    return pa.table({"gtfs_trip_id": trips, "vehicle_id": ["v"] * len(trips), "route_type": ["3"] * len(trips),
+                     "gtfs_route_short_name": ["22"] * len(trips), "delay": delays,
+                     "first_timestamp": first, "n": counts})
+
+
+def test_merge_days_weights_the_trip_means_by_their_positions():
+    # trip t1 runs across midnight
+    first = trip_day(["t1", "t2"], [60.0, 10.0], [3, 2], ["2025-05-18 23:50:00", "2025-05-18 08:00:00"])
+    second = trip_day(["t1", "t3"], [120.0, 30.0], [1, 4], ["2025-05-19 00:00:00", "2025-05-19 07:00:00"])
+
+    merged = queries.merge_days("trip_delays", [first, second]).to_pylist()
+
+    assert merged == [
+        {"gtfs_trip_id": "t1", "vehicle_id": "v", "route_type": "3", "gtfs_route_short_name": "22",
+         "delay": 75.0, "first_timestamp": "2025-05-18 23:50:00", "n": 4},
+        {"gtfs_trip_id": "t2", "vehicle_id": "v", "route_type": "3", "gtfs_route_short_name": "22",
+         "delay": 10.0, "first_timestamp": "2025-05-18 08:00:00", "n": 2},
+        {"gtfs_trip_id": "t3", "vehicle_id": "v", "route_type": "3", "gtfs_route_short_name": "22",
+         "delay": 30.0, "first_timestamp": "2025-05-19 07:00:00", "n": 4},
+    ]
+
+
+def test_merge_days_skips_empty_days_and_types_null_columns():
+    empty = trip_day([], [], [], []).cast(trip_day(["t"], [1.0], [1], ["x"]).schema)
+    # a day whose delays are all NULL has no type for the column
+    untyped = trip_day(["t1"], [None], [1], ["2025-05-18 10:00:00"])
+    typed = trip_day(["t2"], [20.0], [1], ["2025-05-19 10:00:00"])
+
+    merged = queries.merge_days("trip_delays", [empty, untyped, typed])
+
+    assert merged.column("gtfs_trip_id").to_pylist() == ["t1", "t2"]
+    assert merged.column("delay").to_pylist() == [None, 20.0]
+
+
+def test_merge_days_combines_the_trip_aggregates_of_service_days():
+    stats = [pa.table({"route_type": ["3"], "trips": [2], "mean_delay": [90.0], "max_delay": [120.0],
+                       "total_delay": [180.0], "vehicles": [2], "first_timestamp": ["2025-05-18 05:00:00"],
+                       "last_timestamp": ["2025-05-18 23:00:00"], "vehicle_ids": ['["v1","v2"]']}),
+             pa.table({"route_type": ["3"], "trips": [1], "mean_delay": [300.0], "max_delay": [300.0],
+                       "total_delay": [300.0], "vehicles": [1], "first_timestamp": ["2025-05-19 06:00:00"],
+                       "last_timestamp": ["2025-05-19 06:00:00"], "vehicle_ids": ['["v2"]']})]
+    # the vehicle of both days counts once
+    assert queries.merge_days("delay_stats", stats).to_pylist() == [
+        {"route_type": "3", "trips": 3, "mean_delay": 160.0, "max_delay": 300.0, "total_delay": 480.0,
+         "vehicles": 2, "first_timestamp": "2025-05-18 05:00:00", "last_timestamp": "2025-05-19 06:00:00",
+         "vehicle_ids": '["v1", "v2"]'}]
+
+    histogram = queries.merge_days("delay_histogram", [pa.table({"bin": [300], "trips": [1]}),
+                                                       pa.table({"bin": [60, 300], "trips": [2, 3]})])
+    assert histogram.to_pylist() == [{"bin": 60, "trips": 2}, {"bin": 300, "trips": 4}]
+
+    name, params = queries.top_delays("2025-05-18 00:00:00", "2025-05-19 23:59:59", 45, k=2)
+    top = queries.merge_days(name, [pa.table({"gtfs_trip_id": ["t1", "t2"], "delay": [500.0, 100.0]}),
+                                    pa.table({"gtfs_trip_id": ["t1", "t3"], "delay": [700.0, 50.0]})], params)
+    assert top.to_pylist() == [{"gtfs_trip_id": "t1", "delay": 700.0}, {"gtfs_trip_id": "t1", "delay": 500.0}]
+
+
+def test_trip_aggregates_are_split_into_service_days():
+    parts = queries.split(*queries.delay_histogram("2025-05-18 00:00:00", "2025-05-19 12:00:00", 45))
+    assert [(day, params["start"], params["end"]) for day, params in parts] == [
+        (date(2025, 5, 18), "2025-05-18 00:00:00", "2025-05-18 03:59:59"),
+        (date(2025, 5, 19), "2025-05-18 04:00:00", "2025-05-19 03:59:59"),
+        (date(2025, 5, 19), "2025-05-19 04:00:00", "2025-05-19 12:00:00"),
+    ]
+    # the rollups are per local day
+    days = queries.split(*queries.delay_histogram("2025-05-18 00:00:00", "2025-05-19 12:00:00", 60))
+    assert [day for day, _ in days] == [date(2025, 5, 18), date(2025, 5, 19)]
+    days = queries.split(*queries.trip_delays("2025-05-18 12:00:00", "2025-05-20 12:00:00", 45))
+    assert [(params["start"], params["end"]) for _, params in days] == [
+        ("2025-05-18 12:00:00", "2025-05-18 23:59:59"),
+        ("2025-05-19 00:00:00", "2025-05-19 23:59:59"),
+        ("2025-05-20 00:00:00", "2025-05-20 12:00:00"),
+    ]
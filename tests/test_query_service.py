@@ -0,0 +1,154 @@
+import http.client
+import json
+import threading
+import time
+from datetime import date, datetime
+from zoneinfo import ZoneInfo
+
+import pyarrow as pa
+import pytest
+
+import archive
+import mirror
+import queries
+import query_service
+import remote_query
+import schema
+from conftest import position
+from managers import query_cache, query_client
+
+DAY = date(2025, 5, 18)
+START, _ = archive.day_bounds(DAY)
+# a value for every parameter of the named queries
+PARAMS = {"start": "2025-05-18 00:00:00", "end": "2025-05-18 23:59:59", "min_delay": 45, "bucket": 3600,
+          "k": 5, "min_dwell": 0, "since": 0, "after": 0, "until": 2 ** 31, **dict.fromkeys(schema.DICTIONARIES, 0)}
+
+
+@pytest.fixture
+def service(make_writer, tmp_path):
+    """Run a query service on a fresh database in a thread; yields (address, writer)."""
+    writer = make_writer(max_snapshots=1, max_seconds=3600)
+    writer.write([position("v1", START + 600, delay=120), position("v2", START + 600, delay=300, trip="t2")],
+                 START + 600)
+    writer.write([position("v1", START + 630, delay=180), position("v2", START + 630, delay=20, trip="t2")],
+                 START + 630)
+    pool = query_service.ConnectionPool(writer.db_path)
+    server = query_service.QueryServer(("127.0.0.1", 0), pool, str(tmp_path / "archive"))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address, writer
+    server.shutdown()
+    server.server_close()
+    pool.close()
+
+
+def run(address, name, params, guard=None):
+    sock = query_client.connect(address)
+    try:
+        return query_client.query(sock, name, params, guard)
+    finally:
+        sock.close()
+
+
+def test_every_named_query_returns_the_rows_of_the_database(service):
+    address, writer = service
+    sock = query_client.connect(address)
+    try:
+        assert query_client.list_queries(sock) == {name: list(spec[1]) for name, spec in queries.QUERIES.items()}
+    finally:
+        sock.close()
+
+    for name, (_, names, _, _) in queries.QUERIES.items():
+        params = {key: PARAMS[key] for key in names}
+        if name == "mirror_archived_days":
+            params["since"] = DAY.isoformat()
+        expected = remote_query.read_table(remote_query.execute_named(remote_query.open_readonly(writer.db_path),
+                                                                      name, dict(params)))
+        assert run(address, name, params).to_pylist() == expected.to_pylist(), name
+
+    trips = run(address, *queries.trip_delays(PARAMS["start"], PARAMS["end"], 45))
+    assert sorted(zip(trips["gtfs_trip_id"].to_pylist(), trips["delay"].to_pylist(), trips["n"].to_pylist())) == [
+        ("t2", 300.0, 1), ("trip_v1", 150.0, 2)]
+
+
+def test_the_arrow_stream_keeps_the_column_types(service):
+    address, _ = service
+    received = []
+    sock = query_client.connect(address)
+    try:
+        batches = list(query_client.stream(sock, *queries.trip_delays(PARAMS["start"], PARAMS["end"], 45),
+                                           on_bytes=received.append))
+    finally:
+        sock.close()
+
+    result_schema = batches[0].schema
+    assert result_schema.field("delay").type == pa.float64()
+    assert result_schema.field("n").type == pa.int64()
+    assert result_schema.field("gtfs_trip_id").type == pa.string()
+    assert sum(received) > 0
+    # an empty result still has its columns
+    empty = run(address, *queries.trip_delays(PARAMS["start"], PARAMS["end"], 3000))
+    assert empty.num_rows == 0 and empty.column_names == result_schema.names
+
+
+def test_queries_over_a_limit_are_stopped(service, monkeypatch):
+    address, _ = service
+    name, params = queries.trip_delays(PARAMS["start"], PARAMS["end"], 45)
+    with pytest.raises(query_client.QueryStoppedError, match="rows"):
+        run(address, name, params, query_client.QueryGuard(max_rows=1))
+    with pytest.raises(query_client.QueryStoppedError, match="MB"):
+        run(address, name, params, query_client.QueryGuard(max_bytes=100))
+
+    # the server checks its deadline at every step and answers 504
+    monkeypatch.setattr(remote_query, "PROGRESS_STEPS", 1)
+    conn = http.client.HTTPConnection(*address, timeout=10)
+    conn.request("POST", "/query", json.dumps({"query": name, "params": params, "timeout": 0}))
+    response = conn.getresponse()
+    assert response.status == 504
+    assert "ran longer" in response.read().decode()
+    conn.close()
+
+
+def test_cached_days_expire_unless_they_are_complete(service, tmp_path, monkeypatch):
+    address, _ = service
+    cache = query_cache.QueryCache(str(tmp_path / "cache"))
+    name, params = queries.trip_delays(PARAMS["start"], PARAMS["end"], 45)
+    table = run(address, name, params)
+    past = cache.key("gather", name, params)
+    today = cache.key("gather", name, dict(params, min_delay=46))
+    cache.put(past, table, query_cache.expires_at(DAY, "Europe/Prague"))
+    # the day of the collector, which can differ from the local one
+    current = datetime.now(ZoneInfo("Europe/Prague")).date()
+    cache.put(today, table, query_cache.expires_at(current, "Europe/Prague"))
+
+    assert cache.get(past) == table
+    assert cache.get(today) == table
+    later = time.time() + query_cache.QUERY_CACHE_TTL_SECONDS + 1
+    monkeypatch.setattr(query_cache.time, "time", lambda: later)
+    assert cache.get(past) == table
+    assert cache.get(today) is None
+
+
+def test_the_mirror_transfers_only_rows_past_its_high_water_mark(service, tmp_path):
+    address, writer = service
+    calls = []
+
+    def fetch(name, params):
+        calls.append((name, params))
+        return run(address, name, params)
+
+    local = mirror.Mirror(str(tmp_path / "mirror" / "positions.db"), "gather", "Europe/Prague")
+    try:
+        assert local.sync(fetch, None, since=DAY) == 4
+        assert local.synced_until() == START + 630
+
+        writer.write([position("v1", START + 660, delay=240)], START + 660)
+        calls.clear()
+        assert local.sync(fetch, None) == 1
+        assert {params["after"] for name, params in calls if name == "mirror_positions"} == {START + 630}
+        assert local.synced_until() == START + 660
+        name, params = queries.trip_delays(PARAMS["start"], PARAMS["end"], 45)
+        assert sorted(local.query(name, params).to_pylist(), key=str) == sorted(
+            run(address, name, params).to_pylist(), key=str)
+    finally:
+        local.close()
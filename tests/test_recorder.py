@@ -0,0 +1,48 @@
+import json
+import time
+from datetime import date
+
+import recorder
+
+
+def payload(*vehicles, delay=0):
+    """Return a raw API body with one feature per vehicle."""
+    return json.dumps({"features": [
+        {"geometry": {"coordinates": [14.42, 50.08]},
+         "properties": {"vehicle_id": vehicle, "gtfs_trip_id": f"trip_{vehicle}", "route_type": "3",
+                        "gtfs_route_short_name": "22", "bearing": 90, "delay": delay,
+                        "state_position": "at_stop"}}
+        for vehicle in vehicles]}).encode()
+
+
+def test_replay_stores_the_recorded_snapshots(tmp_path, make_writer):
+    tick = int(time.mktime((2025, 5, 20, 12, 0, 0, 0, 0, -1)))
+    rec = recorder.Recorder(str(tmp_path / "rec"))
+    rec.record(tick, payload("v1", "v2"))
+    rec.record(tick + 30, payload("v1", "v2", "v3", delay=60))
+    day = date(2025, 5, 20)
+    paths = recorder.recordings(rec.directory, day, day)
+    assert [tick for tick, _ in recorder.read_recording(paths[0])] == [tick, tick + 30]
+
+    writer = make_writer(max_snapshots=10, max_seconds=3600)
+    report = recorder.replay(paths, writer)
+
+    assert (report["snapshots"], report["rows"], report["stored"]) == (2, 5, 5)
+    assert not writer.conn.in_transaction
+    rows = writer.conn.execute("""SELECT ts, COUNT(*), MAX(delay) FROM vehicle_positions_full
+                                  GROUP BY ts ORDER BY ts""").fetchall()
+    assert rows == [(tick, 2, 0), (tick + 30, 3, 60)]
+
+
+def test_truncated_last_record_is_skipped(tmp_path):
+    rec = recorder.Recorder(str(tmp_path))
+    rec.record(1000, payload("v1"))
+    rec.record(1030, payload("v1"))
+    path = rec.path_for(1000)
+    with open(path, "rb") as f:
+        data = f.read()
+    # a crash while the last member was written
+    with open(path, "wb") as f:
+        f.write(data[:-10])
+
+    assert [tick for tick, _ in recorder.read_recording(path)] == [1000]
@@ -0,0 +1,55 @@
+from datetime import date
+
+import pytest
+
+import archive
+import queries
+import remote_query
+from conftest import position
+
+DAY = date(2025, 5, 18)
+
+
+def store_two_days(writer):
+    """Store positions on DAY and the day after."""
+    start, end = archive.day_bounds(DAY)
+    writer.write([position("v1", start + 3600, delay=120), position("v2", start + 3600, delay=10),
+                  # outside Prague: not a trip of the dashboard
+                  position("v3", start + 3600, delay=300, lat=49.0, lon=16.0)], start + 3600)
+    writer.write([position("v1", end + 3600, delay=240)], end + 3600)
+
+
+def archive_first_day(writer, archive_dir):
+    """Archive DAY; its rows stay in the database until the retention deletes them."""
+    archive.write_day(writer.conn, DAY, archive_dir)
+    archive.create_archive_table(writer.conn)
+    writer.conn.execute("INSERT INTO archived_days VALUES (?, 3, NULL, '')", (DAY.isoformat(),))
+    writer.conn.commit()
+
+
+def trip_delays(conn, archive_dir, **kwargs):
+    name, params = queries.trip_delays("2025-05-18 00:00:00", "2025-05-19 23:59:59", 45)
+    cursor = remote_query.execute_named(conn, name, params, archive_dir, **kwargs)
+    return sorted(cursor.fetchall())
+
+
+def test_archived_days_load_only_the_positions_the_query_uses(tmp_path, make_writer):
+    writer = make_writer(max_snapshots=1, max_seconds=3600)
+    store_two_days(writer)
+    expected = trip_delays(remote_query.open_readonly(writer.db_path), str(tmp_path))
+    assert [(row[0], row[-1]) for row in expected] == [("trip_v1", 2)]
+    archive_first_day(writer, str(tmp_path))
+
+    conn = remote_query.open_readonly(writer.db_path)
+    assert trip_delays(conn, str(tmp_path)) == expected
+    # v2 is below min_delay and v3 outside zone P; the day after is read in place
+    assert conn.execute("SELECT vehicle_id FROM temp.archived_positions").fetchall() == [("v1",)]
+
+
+def test_loading_more_archived_rows_than_allowed_stops_the_query(tmp_path, make_writer):
+    writer = make_writer(max_snapshots=1, max_seconds=3600)
+    store_two_days(writer)
+    archive_first_day(writer, str(tmp_path))
+
+    with pytest.raises(remote_query.QueryStopped):
+        trip_delays(remote_query.open_readonly(writer.db_path), str(tmp_path), max_load_rows=0)
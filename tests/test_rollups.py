@@ -0,0 +1,43 @@
+import sqlite3
+
+import rollups
+from conftest import position
+
+
+def rollup_rows(conn, level, bucket):
+    return conn.execute("""SELECT start, key, band, n, total, min_delay, max_delay, first_ts, last_ts
+                           FROM delay_rollups WHERE level = ? AND bucket = ?
+                           ORDER BY start, key, band""", (level, bucket)).fetchall()
+
+
+def test_merge_adds_snapshots_to_every_bucket_width():
+    conn = sqlite3.connect(":memory:")
+    writer = rollups.RollupWriter(conn)
+    # (level, key, band) -> [route, route_type, vehicle, n, total, min, max]
+    touched = writer.merge(3600, {(rollups.LEVEL_TRIP, 7, 0): [1, 2, 3, 2, 50.0, 20.0, 30.0]})
+    writer.merge(3690, {(rollups.LEVEL_TRIP, 7, 0): [1, 2, 4, 1, 40.0, 40.0, 40.0],
+                        (rollups.LEVEL_TRIP, 7, 60): [1, 2, 4, 1, 75.0, 75.0, 75.0]})
+
+    assert touched == len(rollups.BUCKETS)
+    hour = rollups.bucket_start(3600, 3600)
+    assert rollup_rows(conn, rollups.LEVEL_TRIP, 3600) == [
+        (hour, 7, 0, 3, 90.0, 20.0, 40.0, 3600, 3690),
+        (hour, 7, 60, 1, 75.0, 75.0, 75.0, 3690, 3690),
+    ]
+    # both snapshots fall into different minutes
+    assert [row[0] for row in rollup_rows(conn, rollups.LEVEL_TRIP, 60) if row[2] == 0] == [
+        rollups.bucket_start(3600, 60), rollups.bucket_start(3690, 60)]
+    assert conn.execute("SELECT vehicle FROM delay_rollups WHERE band = 0 AND bucket = 3600").fetchone() == (4,)
+
+
+def test_writer_rolls_up_the_delays_of_zone_p(make_writer):
+    writer = make_writer(max_snapshots=1, max_seconds=3600)
+    writer.write([position("v1", 1000, delay=30), position("v2", 1000, delay=90, trip="t2"),
+                  # outside Prague and past MAX_DELAY: not rolled up
+                  position("v3", 1000, delay=30, lat=49.0, lon=16.0),
+                  position("v4", 1000, delay=rollups.MAX_DELAY + 1)], 1000)
+
+    rows = writer.conn.execute("""SELECT band, n, total FROM delay_rollups
+                                  WHERE level = ? AND bucket = 86400 ORDER BY band""",
+                               (rollups.LEVEL_ROUTE_TYPE,)).fetchall()
+    assert rows == [(0, 1, 30.0), (60, 1, 90.0)]
@@ -0,0 +1,121 @@
+import threading
+import time
+
+import pytest
+
+from managers.single_flight import FlightCancelled, SingleFlight
+
+
+def start_leader(flights, key, function):
+    """Run flights.do(key, function) in a thread; return it and its outcome dict once it runs."""
+    running = threading.Event()
+    outcome = {}
+
+    def leader():
+        def call():
+            running.set()
+            return function()
+        try:
+            outcome["result"] = flights.do(key, call)
+        except Exception as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=leader)
+    thread.start()
+    assert running.wait(5)
+    return thread, outcome
+
+
+def wait_for_calls(flights, calls):
+    """Block until flights counted this many calls, i.e. the waiting call joined the running one."""
+    deadline = time.monotonic() + 5
+    while flights.stats()["calls"] < calls:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_waiting_call_gets_the_result_of_the_running_call():
+    flights = SingleFlight()
+    release = threading.Event()
+    thread, outcome = start_leader(flights, "q", lambda: release.wait(5) and "rows")
+
+    follower = {}
+    waiter = threading.Thread(target=lambda: follower.update(result=flights.do("q", lambda: "own")))
+    waiter.start()
+    wait_for_calls(flights, 2)
+    release.set()
+    thread.join(5)
+    waiter.join(5)
+
+    assert outcome["result"] == ("rows", False)
+    assert follower["result"] == ("rows", True)
+    assert flights.stats() == {"calls": 2, "deduplicated": 1, "running": 0}
+    # a finished call is not reused
+    assert flights.do("q", lambda: "again") == ("again", False)
+
+
+def test_error_of_the_running_call_reaches_the_waiting_call():
+    flights = SingleFlight()
+    release = threading.Event()
+
+    def fail():
+        release.wait(5)
+        raise ValueError("broken")
+
+    thread, outcome = start_leader(flights, "q", fail)
+    follower = {}
+
+    def wait():
+        try:
+            flights.do("q", lambda: "own")
+        except ValueError as e:
+            follower["error"] = e
+
+    waiter = threading.Thread(target=wait)
+    waiter.start()
+    wait_for_calls(flights, 2)
+    release.set()
+    thread.join(5)
+    waiter.join(5)
+
+    assert str(outcome["error"]) == "broken"
+    assert follower["error"] is outcome["error"]
+    assert flights.stats()["running"] == 0
+
+
+def test_waiting_call_times_out_without_stopping_the_running_call():
+    flights = SingleFlight()
+    release = threading.Event()
+    thread, outcome = start_leader(flights, "q", lambda: release.wait(5) and "rows")
+
+    with pytest.raises(TimeoutError):
+        flights.do("q", lambda: "own", timeout=0.05)
+    release.set()
+    thread.join(5)
+
+    assert outcome["result"] == ("rows", False)
+
+
+def test_waiting_call_stops_once_cancelled():
+    flights = SingleFlight()
+    release = threading.Event()
+    thread, outcome = start_leader(flights, "q", lambda: release.wait(5) and "rows")
+    cancelled = threading.Event()
+    threading.Timer(0.05, cancelled.set).start()
+
+    with pytest.raises(FlightCancelled):
+        flights.do("q", lambda: "own", cancelled=cancelled.is_set)
+    release.set()
+    thread.join(5)
+
+    assert outcome["result"] == ("rows", False)
+
+
+def test_different_keys_do_not_share():
+    flights = SingleFlight()
+    release = threading.Event()
+    thread, _ = start_leader(flights, ("q", 300, 10), lambda: release.wait(5) and "capped")
+
+    assert flights.do(("q", 300, 20), lambda: "own") == ("own", False)
+    release.set()
+    thread.join(5)
@@ -0,0 +1,57 @@
+import threading
+import time
+
+import pytest
+
+from managers import query_client, ssh_pool
+
+
+def busy_connection():
+    """Return an unconnected SSHConnection whose only channel is in use."""
+    connection = ssh_pool.SSHConnection.__new__(ssh_pool.SSHConnection)
+    connection.hostname = "gather"
+    connection.channels = threading.BoundedSemaphore(1)
+    connection.channels.acquire()
+    return connection
+
+
+def test_waiting_for_a_channel_ends_with_the_query_timeout():
+    with pytest.raises(ssh_pool.ChannelLimitError) as info:
+        busy_connection()._acquire(query_client.QueryGuard(timeout=0.3))
+    # named_request shows stopped queries instead of dropping them
+    assert isinstance(info.value, query_client.QueryStoppedError)
+
+
+def test_cancelling_the_request_stops_the_wait_for_a_channel():
+    connection = busy_connection()
+    guard = query_client.QueryGuard(timeout=30)
+    threading.Timer(0.1, guard.cancel).start()
+    with pytest.raises(query_client.QueryCancelledError):
+        connection._acquire(guard)
+
+
+def test_a_slow_connect_does_not_block_other_servers(monkeypatch):
+    release = threading.Event()
+
+    class Connection:
+        def __init__(self, hostname, username, key_path, max_channels):
+            if hostname == "slow":
+                release.wait(5)
+
+        def idle_for(self):
+            return 0.0
+
+    monkeypatch.setattr(ssh_pool, "SSHConnection", Connection)
+    pool = ssh_pool.SSHPool()
+    slow = threading.Thread(target=pool.get, args=("slow", "u", "k"))
+    slow.start()
+    while ("slow", "u", "k") not in pool.connecting:
+        time.sleep(0.01)
+    try:
+        fast = pool.get("fast", "u", "k")
+        assert pool.get("fast", "u", "k") is fast
+        assert ("slow", "u", "k") not in pool.connections
+    finally:
+        release.set()
+        slow.join()
+    assert ("slow", "u", "k") in pool.connections
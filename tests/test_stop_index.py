@@ -0,0 +1,36 @@
+import math
+import sqlite3
+
+import numpy as np
+
+import schema
+import stop_index
+
+# 100 m north and 300 m north of the platform, in degrees of latitude
+NEAR = 100 / stop_index.METRES_PER_DEGREE
+FAR = 300 / stop_index.METRES_PER_DEGREE
+
+
+def make_index():
+    conn = sqlite3.connect(":memory:")
+    schema.create_tables(conn)
+    stop_index.refresh(conn, [("U1Z1P", "Muzeum", "U1S1", 0, 50.08, 14.43),
+                              ("U1S1", "Muzeum", "", 1, 50.08, 14.43)])
+    return stop_index.StopIndex(conn)
+
+
+def test_nearest_stop_within_the_maximum_distance():
+    index = make_index()
+    nearest, distance = index.nearest([14.43, 14.43, np.nan], [50.08 + NEAR, 50.08 + FAR, np.nan])
+    assert nearest.tolist() == [0, -1, -1]
+    assert math.isclose(distance[0], 100, abs_tol=1)
+    assert np.isnan(distance[1:]).all()
+
+
+def test_assign_rows_leaves_distant_positions_without_a_stop():
+    index = make_index()
+    rows = [("v1", "t1", "3", "22", 90, 0, 50.08 + NEAR, 14.43, "at_stop", 1000),
+            ("v2", "t2", "3", "22", 90, 0, 50.08 + FAR, 14.43, "on_track", 1000)]
+    assigned = index.assign_rows(rows)
+    assert assigned[0] == ("U1Z1P", "U1S1", 100)
+    assert assigned[1] is None
@@ -0,0 +1,218 @@
+"""
+visits.py
+
+Stop visits materialized by the collector while snapshots arrive, so that
+the dwell time and stop throughput analyses do not have to sessionize raw
+positions.
+
+A visit is a run of at_stop positions of one vehicle at the same station
+(the parent_station assigned at ingest, see stop_index.py) without a gap of
+more than VISIT_GAP seconds. The collector keeps the open visit of every
+vehicle in memory and writes a visit to table stop_visits once it is
+finished: the vehicle leaves the stop (a row that is not at_stop or at
+another station) or is not seen at the stop for more than VISIT_GAP seconds.
+
+Table stop_visits holds one row per visit with the dictionary keys of the
+vehicle, trip, route, route type, stop and station of its first position,
+the first (arrival) and last (departure) snapshot time in epoch seconds,
+the dwell time (departure - arrival) and the number of snapshots. A vehicle
+seen at a stop in one snapshot only has a dwell time of 0.
+
+Visits still open when the collector stops are lost; the next snapshots
+open a new visit. Rebuild whole days from the raw positions to get them back.
+
+Usage:
+    python visits.py backfill --start 2025-05-01 --end 2025-05-31
+    Recomputes the visits of whole days from the raw positions. Rows stored
+    before the stop assignment only count once `python stop_index.py backfill` has run.
+"""
+
+import argparse
+import logging
+import sqlite3
+from datetime import datetime, date, timedelta
+
+import schema
+
+logger = logging.getLogger(__name__)
+
+# longest gap in seconds between two at_stop positions of one visit
+VISIT_GAP = 300
+AT_STOP = "at_stop"
+
+
+def create_visit_table(conn):
+    """Create the stop_visits table and its index if they do not exist.
+
+    Args:
+        conn (sqlite3.Connection): Writable connection.
+    """
+    conn.execute("""CREATE TABLE IF NOT EXISTS stop_visits (
+                        vehicle INTEGER NOT NULL,
+                        arrival INTEGER NOT NULL,
+                        departure INTEGER NOT NULL,
+                        dwell INTEGER NOT NULL,
+                        trip INTEGER,
+                        route INTEGER,
+                        route_type INTEGER,
+                        stop INTEGER,
+                        station INTEGER NOT NULL,
+                        snapshots INTEGER NOT NULL,
+                        PRIMARY KEY (vehicle, arrival)) WITHOUT ROWID""")
+    # visits in a time range, for both stops analyses
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stop_visits_arrival ON stop_visits(arrival)")
+
+
+class VisitTracker:
+    """Turns the snapshots into finished stop visits.
+
+    Attributes:
+        conn (sqlite3.Connection): The collector's writer connection.
+        open (dict): Vehicle key -> [trip, route, route_type, stop, station,
+            arrival, last seen, snapshots] of its open visit.
+    """
+    def __init__(self, conn):
+        """Initialize the VisitTracker.
+
+        Args:
+            conn (sqlite3.Connection): The collector's writer connection.
+        """
+        self.conn = conn
+        self.open = {}
+        create_visit_table(conn)
+
+    def observe(self, rows, encoded, observations):
+        """Collect the stop of every vehicle in a chunk of a snapshot.
+
+        Lets a snapshot that arrives in chunks be observed chunk by chunk and
+        applied once with advance().
+
+        Args:
+            rows (list[tuple]): Parsed rows (see server.parse_vehicle_positions).
+            encoded (list[tuple]): The same rows in positions layout.
+            observations (dict): Observations of the snapshot, updated in place:
+                vehicle key -> (trip, route, route_type, stop, station), or None
+                if the vehicle is not at a stop.
+        """
+        for row, values in zip(rows, encoded):
+            vehicle, trip, route, route_type = values[1:5]
+            stop, station = values[11:13]
+            if row[8] == AT_STOP and station is not None:
+                observations[vehicle] = (trip, route, route_type, stop, station)
+            else:
+                observations[vehicle] = None
+
+    def advance(self, ts, observations):
+        """Apply the observations of one snapshot and store the finished visits.
+
+        The open visits are only replaced once the finished ones are written,
+        so a failed write leaves the tracker as it was before the snapshot.
+
+        Args:
+            ts (int): Snapshot time in epoch seconds.
+            observations (dict): Observations filled by observe().
+
+        Returns:
+            int: Number of visits written.
+        """
+        still_open = {}
+        finished = []
+        for vehicle, visit in self.open.items():
+            observed = observations.get(vehicle)
+            if vehicle not in observations:
+                # not in this snapshot; the visit goes on unless the gap is too long
+                if ts - visit[6] > VISIT_GAP:
+                    finished.append((vehicle, visit))
+                else:
+                    still_open[vehicle] = visit
+            elif observed is None or observed[4] != visit[4] or ts - visit[6] > VISIT_GAP:
+                finished.append((vehicle, visit))
+            else:
+                still_open[vehicle] = visit[:6] + [ts, visit[7] + 1]
+        for vehicle, observed in observations.items():
+            if observed is not None and vehicle not in still_open:
+                still_open[vehicle] = list(observed) + [ts, ts, 1]
+        self._insert(finished)
+        self.open = still_open
+        return len(finished)
+
+    def flush(self):
+        """Store all open visits as finished, e.g. at the end of a backfill.
+
+        Returns:
+            int: Number of visits written.
+        """
+        finished = list(self.open.items())
+        self._insert(finished)
+        self.open = {}
+        return len(finished)
+
+    def _insert(self, finished):
+        """Write finished visits to stop_visits."""
+        self.conn.executemany("""INSERT OR REPLACE INTO stop_visits (
+                                    vehicle, arrival, departure, dwell, trip, route, route_type,
+                                    stop, station, snapshots)
+                                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                              [(vehicle, arrival, last, last - arrival, trip, route, route_type,
+                                stop, station, snapshots)
+                               for vehicle, (trip, route, route_type, stop, station, arrival, last, snapshots)
+                               in finished])
+
+
+def backfill(conn, start_day, end_day):
+    """Recompute the visits of whole days from the stored positions.
+
+    Existing visits arriving on these days are replaced, so running it twice
+    is safe. Visits still open at the end of end_day are cut there.
+
+    Args:
+        conn (sqlite3.Connection): Writable connection to the collector database.
+        start_day (date): First day to recompute.
+        end_day (date): Last day to recompute (inclusive).
+    """
+    tracker = VisitTracker(conn)
+    encoder = schema.Encoder(conn)
+    day = start_day
+    while day <= end_day:
+        day_start = int(datetime.combine(day, datetime.min.time()).timestamp())
+        day_end = int(datetime.combine(day + timedelta(days=1), datetime.min.time()).timestamp())
+        conn.execute("DELETE FROM stop_visits WHERE arrival >= ? AND arrival < ?", (day_start, day_end))
+        # vehicle_positions_full reconstructs delta snapshots, so both storage modes work
+        snapshots = {}
+        for row in conn.execute("""SELECT vehicle_id, gtfs_trip_id, route_type, gtfs_route_short_name,
+                                          bearing, delay, latitude, longitude, state_position, ts,
+                                          stop_id, parent_station, stop_distance
+                                   FROM vehicle_positions_full
+                                   WHERE ts >= ? AND ts < ?""", (day_start, day_end)):
+            snapshots.setdefault(row[9], []).append(row)
+        written = 0
+        for ts in sorted(snapshots):
+            rows = [row[:10] for row in snapshots[ts]]
+            encoded = [encoder.encode_row(row[:10], stop=row[10:13]) for row in snapshots[ts]]
+            observations = {}
+            tracker.observe(rows, encoded, observations)
+            written += tracker.advance(ts, observations)
+        if day == end_day:
+            written += tracker.flush()
+        conn.commit()
+        print(f"{day}: {written} visits from {len(snapshots)} snapshots.")
+        day += timedelta(days=1)
+
+
+def main():
+    """Command line entry point for backfilling stop visits."""
+    parser = argparse.ArgumentParser(description="Stop visits of the vehicle positions database.")
+    parser.add_argument("command", choices=["backfill"])
+    parser.add_argument("--db", default=schema.DB_PATH, help="Path to the collector database.")
+    parser.add_argument("--start", required=True, type=date.fromisoformat, help="First day (YYYY-MM-DD).")
+    parser.add_argument("--end", required=True, type=date.fromisoformat, help="Last day (YYYY-MM-DD).")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    conn.execute(f"PRAGMA busy_timeout={schema.MAINTENANCE_BUSY_TIMEOUT_MS}")
+    backfill(conn, args.start, args.end)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+zones.py
+
+Tariff zone tagging of the vehicle positions.
+
+The collector tags every stored row with the id of the tariff zone its
+position lies in (column zone of positions, see schema.py):
+    ZONE_P (1)        inside the Prague zone P polygon of tariff_zones.wkt
+    ZONE_OUTSIDE (0)  outside of all known zones
+    NULL              no coordinates (tombstones) or not tagged yet
+The polygons are loaded and prepared once; each chunk of rows is tested with
+one vectorized point-in-polygon call instead of a Python loop.
+
+Queries filter with `zone = 1`, which is exact, unlike the bounding box of
+the polygon used before, and is tested inside the index idx_positions_ts_zone
+instead of four range predicates on the coordinates of every row.
+
+Usage:
+    python zones.py backfill
+    Tags rows stored before the zone column existed (or migrated from the
+    legacy table) in short transactions, while the collector keeps running.
+"""
+
+import argparse
+import logging
+import sqlite3
+import time
+
+import numpy as np
+import shapely
+import shapely.wkt as wkt
+
+import schema
+
+logger = logging.getLogger(__name__)
+
+ZONE_WKT = "tariff_zones.wkt"
+ZONE_OUTSIDE = 0
+ZONE_P = 1
+# zone id -> (name, WKT file of its polygon); the first match wins
+ZONES = {
+    ZONE_P: ("P", ZONE_WKT),
+}
+# rows tagged per backfill transaction
+BACKFILL_BATCH = 100000
+
+
+class ZoneTagger:
+    """Assigns zone ids to coordinates with prepared polygons.
+
+    Attributes:
+        polygons (dict): Zone id -> prepared shapely geometry.
+    """
+    def __init__(self, zones=None):
+        """Initialize the ZoneTagger and prepare the polygons.
+
+        Args:
+            zones (dict, optional): Zone id -> (name, WKT file), defaults to ZONES.
+        """
+        self.polygons = {}
+        for zone_id, (_, path) in (zones or ZONES).items():
+            with open(path, "r") as f:
+                polygon = wkt.loads(f.read().strip())
+            shapely.prepare(polygon)
+            self.polygons[zone_id] = polygon
+
+    def tag(self, lon, lat):
+        """Return the zone ids of many points.
+
+        Args:
+            lon (array-like): Longitudes in degrees, NaN for missing values.
+            lat (array-like): Latitudes in degrees, NaN for missing values.
+
+        Returns:
+            numpy.ndarray: Zone ids as float, NaN where a coordinate is missing.
+        """
+        lon = np.asarray(lon, dtype=float)
+        lat = np.asarray(lat, dtype=float)
+        zones = np.full(lon.shape, float(ZONE_OUTSIDE))
+        for zone_id, polygon in self.polygons.items():
+            free = zones == ZONE_OUTSIDE
+            zones[free & shapely.contains_xy(polygon, lon, lat)] = zone_id
+        zones[np.isnan(lon) | np.isnan(lat)] = np.nan
+        return zones
+
+    def tag_rows(self, rows):
+        """Return the zone ids of parsed rows.
+
+        Args:
+            rows (list[tuple]): Rows as returned by server.parse_vehicle_positions.
+
+        Returns:
+            list: Zone id or None per row.
+        """
+        if not rows:
+            return []
+        lat = [np.nan if row[6] is None else row[6] for row in rows]
+        lon = [np.nan if row[7] is None else row[7] for row in rows]
+        return [None if np.isnan(zone) else int(zone) for zone in self.tag(lon, lat)]
+
+
+def backfill(conn, batch_size=BACKFILL_BATCH, pause=0.1):
+    """Tag all positions without a zone that have coordinates.
+
+    Walks positions in rowid order, one short transaction per batch, so it
+    can run next to the collector and be interrupted at any time.
+
+    Args:
+        conn (sqlite3.Connection): Writable connection to the collector database.
+        batch_size (int): Rows per transaction.
+        pause (float): Seconds to sleep between batches to let the collector write.
+
+    Returns:
+        int: Number of rows tagged.
+    """
+    tagger = ZoneTagger()
+    last_rowid = 0
+    tagged = 0
+    while True:
+        rows = conn.execute("""SELECT rowid, lon_e6, lat_e6 FROM positions
+                               WHERE rowid > ? AND zone IS NULL AND lat_e6 IS NOT NULL
+                               ORDER BY rowid LIMIT ?""", (last_rowid, batch_size)).fetchall()
+        if not rows:
+            break
+        rowids, lon, lat = np.array(rows, dtype=float).T
+        zones = tagger.tag(lon / 1e6, lat / 1e6)
+        conn.executemany("UPDATE positions SET zone = ? WHERE rowid = ?",
+                         zip(zones.astype(int).tolist(), rowids.astype(int).tolist()))
+        conn.commit()
+        last_rowid = int(rowids[-1])
+        tagged += len(rows)
+        print(f"Tagged {tagged} rows (rowid {last_rowid}).")
+        time.sleep(pause)
+    return tagged
+
+
+def main():
+    """Command line entry point for tagging untagged positions."""
+    parser = argparse.ArgumentParser(description="Tariff zone tagging of the vehicle positions.")
+    parser.add_argument("command", choices=["backfill"])
+    parser.add_argument("--db", default=schema.DB_PATH, help="Path to the collector database.")
+    parser.add_argument("--batch", type=int, default=BACKFILL_BATCH, help="Rows per transaction.")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    conn.execute(f"PRAGMA busy_timeout={schema.MAINTENANCE_BUSY_TIMEOUT_MS}")
+    schema.ensure_schema(conn)
+    tagged = backfill(conn, args.batch)
+    conn.close()
+    print(f"Done, {tagged} rows tagged.")
+
+
+if __name__ == "__main__":
+    main()